@@ -1,7 +1,7 @@
 # app.py
 from flask import (
     Flask, render_template, request, redirect, url_for,
-    flash, jsonify, session
+    flash, jsonify, session, Response, stream_with_context
 )
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
@@ -12,7 +12,8 @@ import pandas as pd
 from datetime import datetime, timedelta
 import os
 import random
-from sqlalchemy.orm import joinedload
+from sqlalchemy import or_
+from sqlalchemy.orm import joinedload, selectinload
 from flask import render_template, request, redirect, url_for, flash
 from datetime import datetime, timedelta
 from collections import defaultdict
@@ -23,11 +24,23 @@ from models import db
 from models import (
     Site, Group, Lecturer, Student, Machine, Module, MiniTask,
     StudentMiniTaskProgress, Attempt, StudentModuleProgress, ErrorLog, Inventory, InventoryUsage,
-    OverheadCost, MachineMaintenance, MacroPlan, Schedule
+    OverheadCost, MachineMaintenance, MacroPlan, Schedule, ScheduleParticipant, ScheduleRun,
+    MachineUsageDaily, StudentMachineUsage, ConsumableUsageDaily, StudentSpend, ImportJob
 )
 from auth_models import User, Role, Permission, DynamicField, DynamicFieldValue
 from auth import auth_bp
 from reports import reports_bp
+from dynamic_values import load_dynamic_values, dynamic_values_for, save_dynamic_values
+from exports import student_export_rows, iter_csv, write_xlsx, iter_file
+from jobs import create_job, submit_job, fail_if_stale
+from conflicts import ConflictIndex, audit_schedule, AUDIT_KINDS, WEEKDAYS
+from sheet_reader import read_rows, read_frame, count_rows
+from scheduler import (
+    WorkCalendar, dispatch_order, normalize_level, plan_round_robin, plan_parallel, plan_gap_fill,
+    optimize_parallel, booked_until, students_booked_until, existing_bookings, schedule_stats, schedule_scope,
+    stage_run, publish_run, rollback_run, simulate_many, repair_outage,
+    SCHEDULE_RUNS_KEPT, MAX_SCENARIOS, MAX_TIME_BUDGET, REPAIR_HORIZON_DAYS
+)
 import json
 
 app = Flask(__name__)
@@ -174,8 +187,9 @@ def index():
     site_id = get_active_site_id()
 
     # Admins see all sites, regular users see only their site
+    # Usage and spend widgets read the rollup tables maintained by rollups.py
     total_machines = apply_site_filter(Machine.query, Machine).count()
-    machines_in_use = apply_site_filter(Schedule.query, Schedule).with_entities(Schedule.machine_name).distinct().count()
+    machines_in_use = apply_site_filter(StudentMachineUsage.query, StudentMachineUsage).with_entities(StudentMachineUsage.machine_name).distinct().count()
     active_modules = apply_site_filter(Module.query, Module).count()
     
     # For pending tasks, need to join with Student
@@ -188,14 +202,12 @@ def index():
 
     # 1. Total machine usage (in hours) - admins see all sites
     usage_query = db.session.query(
-        Schedule.machine_name,
-        db.func.sum(
-            db.func.strftime('%s', Schedule.end_time) - db.func.strftime('%s', Schedule.start_time)
-        ).label("total_seconds")
+        MachineUsageDaily.machine_name,
+        db.func.sum(MachineUsageDaily.total_seconds).label("total_seconds")
     )
     if should_filter_by_site():
-        usage_query = usage_query.filter(Schedule.site_id == site_id)
-    usage_summary = usage_query.group_by(Schedule.machine_name).all()
+        usage_query = usage_query.filter(MachineUsageDaily.site_id == site_id)
+    usage_summary = usage_query.group_by(MachineUsageDaily.machine_name).all()
 
     usage_data = {
         "labels": [row.machine_name for row in usage_summary],
@@ -204,9 +216,9 @@ def index():
 
     # 📦 2. Inventory totals
     inv_summary = db.session.query(
-        InventoryUsage.consumable,
-        db.func.sum(InventoryUsage.quantity)
-    ).group_by(InventoryUsage.consumable).all()
+        ConsumableUsageDaily.consumable,
+        db.func.sum(ConsumableUsageDaily.quantity)
+    ).group_by(ConsumableUsageDaily.consumable).all()
 
     inv_data = {
         "labels": [row[0] for row in inv_summary],
@@ -216,7 +228,7 @@ def index():
     # 💰 3. Cost Analytics
     # Total spent on inventory
     total_spent = db.session.query(
-        db.func.sum(InventoryUsage.quantity * InventoryUsage.unit_cost)
+        db.func.sum(ConsumableUsageDaily.cost)
     ).scalar() or 0
 
     # Average spend per student
@@ -224,33 +236,31 @@ def index():
 
     # Total inventory used (quantity)
     total_inventory_used = db.session.query(
-        db.func.sum(InventoryUsage.quantity)
+        db.func.sum(ConsumableUsageDaily.quantity)
     ).scalar() or 0
 
     # Spending breakdown by student
     spending_by_student = db.session.query(
-        InventoryUsage.student_name,
-        db.func.sum(InventoryUsage.quantity * InventoryUsage.unit_cost).label("total_cost")
-    ).group_by(InventoryUsage.student_name).order_by(db.text("total_cost DESC")).all()
+        StudentSpend.student_name,
+        db.func.sum(StudentSpend.cost).label("total_cost")
+    ).group_by(StudentSpend.student_name).order_by(db.text("total_cost DESC")).all()
 
     # Spending breakdown by item
     spending_by_item = db.session.query(
-        InventoryUsage.consumable,
-        db.func.sum(InventoryUsage.quantity).label("qty"),
-        db.func.sum(InventoryUsage.quantity * InventoryUsage.unit_cost).label("cost")
-    ).group_by(InventoryUsage.consumable).order_by(db.text("cost DESC")).all()
+        ConsumableUsageDaily.consumable,
+        db.func.sum(ConsumableUsageDaily.quantity).label("qty"),
+        db.func.sum(ConsumableUsageDaily.cost).label("cost")
+    ).group_by(ConsumableUsageDaily.consumable).order_by(db.text("cost DESC")).all()
 
     # 📈 4. Last 7 days – machine usage trends
     today = datetime.utcnow().date()
     last_7_days = today - timedelta(days=6)
 
     trend_raw = db.session.query(
-        db.func.date(Schedule.start_time).label("day"),
-        Schedule.machine_name,
-        db.func.sum(
-            db.func.strftime('%s', Schedule.end_time) - db.func.strftime('%s', Schedule.start_time)
-        ).label("total_seconds")
-    ).filter(Schedule.start_time >= last_7_days).group_by("day", Schedule.machine_name).all()
+        MachineUsageDaily.day,
+        MachineUsageDaily.machine_name,
+        db.func.sum(MachineUsageDaily.total_seconds).label("total_seconds")
+    ).filter(MachineUsageDaily.day >= last_7_days).group_by(MachineUsageDaily.day, MachineUsageDaily.machine_name).all()
 
     machine_trend_data = defaultdict(lambda: defaultdict(float))
     for day, machine, seconds in trend_raw:
@@ -258,10 +268,10 @@ def index():
 
     # 📉 5. Last 7 days – inventory usage trends
     inv_trend = db.session.query(
-        db.func.date(InventoryUsage.date_issued).label("day"),
-        InventoryUsage.consumable,
-        db.func.sum(InventoryUsage.quantity)
-    ).filter(InventoryUsage.date_issued >= last_7_days).group_by("day", InventoryUsage.consumable).all()
+        ConsumableUsageDaily.day,
+        ConsumableUsageDaily.consumable,
+        db.func.sum(ConsumableUsageDaily.quantity)
+    ).filter(ConsumableUsageDaily.day >= last_7_days).group_by(ConsumableUsageDaily.day, ConsumableUsageDaily.consumable).all()
 
     inventory_trend_data = defaultdict(lambda: defaultdict(int))
     for day, item, qty in inv_trend:
@@ -277,10 +287,10 @@ def index():
         })
 
     # ✅ NEW: Group-based analytics (admins see all sites)
-    # Spending by group - Fixed to handle student name mismatches (InventoryUsage has student number prefix)
+    # Spending by group - joined on the resolved student_id (see resolvers.py)
     spending_query = db.session.query(
         Group.name,
-        db.func.coalesce(db.func.sum(InventoryUsage.quantity * InventoryUsage.unit_cost), 0).label("total_cost"),
+        db.func.coalesce(db.func.sum(StudentSpend.cost), 0).label("total_cost"),
         db.func.count(db.func.distinct(Student.id)).label("student_count")
     ).select_from(Group)
     
@@ -289,17 +299,17 @@ def index():
     
     spending_by_group = spending_query\
      .outerjoin(Student, Group.id == Student.group_id)\
-     .outerjoin(InventoryUsage, InventoryUsage.student_name.like('%' + Student.student_name + '%'))\
+     .outerjoin(StudentSpend, StudentSpend.student_id == Student.id)\
      .group_by(Group.name)\
-     .having(db.func.sum(InventoryUsage.quantity * InventoryUsage.unit_cost) > 0)\
+     .having(db.func.sum(StudentSpend.cost) > 0)\
      .order_by(db.text("total_cost DESC")).all()
 
-    # Item usage by group - Fixed to handle student name mismatches (admins see all sites)
+    # Item usage by group - joined on the resolved student_id (admins see all sites)
     item_usage_query = db.session.query(
         Group.name,
-        InventoryUsage.consumable,
-        db.func.sum(InventoryUsage.quantity).label("qty"),
-        db.func.sum(InventoryUsage.quantity * InventoryUsage.unit_cost).label("cost")
+        StudentSpend.consumable,
+        db.func.sum(StudentSpend.quantity).label("qty"),
+        db.func.sum(StudentSpend.cost).label("cost")
     ).select_from(Group)
     
     if should_filter_by_site():
@@ -307,8 +317,8 @@ def index():
     
     item_usage_by_group = item_usage_query\
      .join(Student, Group.id == Student.group_id)\
-     .join(InventoryUsage, InventoryUsage.student_name.like('%' + Student.student_name + '%'))\
-     .group_by(Group.name, InventoryUsage.consumable)\
+     .join(StudentSpend, StudentSpend.student_id == Student.id)\
+     .group_by(Group.name, StudentSpend.consumable)\
      .order_by(Group.name, db.text("cost DESC")).all()
 
     # Group item usage structured
@@ -320,14 +330,12 @@ def index():
             "cost": cost
         })
 
-    # Machine usage by group - Fixed to handle student name mismatches (admins see all sites)
+    # Machine usage by group - joined on the resolved student_id (admins see all sites)
     machine_usage_query = db.session.query(
         Group.name,
-        Schedule.machine_name,
-        db.func.count(Schedule.id).label("slot_count"),
-        db.func.sum(
-            db.func.strftime('%s', Schedule.end_time) - db.func.strftime('%s', Schedule.start_time)
-        ).label("total_seconds")
+        StudentMachineUsage.machine_name,
+        db.func.sum(StudentMachineUsage.slot_count).label("slot_count"),
+        db.func.sum(StudentMachineUsage.total_seconds).label("total_seconds")
     ).select_from(Group)
     
     if should_filter_by_site():
@@ -335,13 +343,13 @@ def index():
     
     machine_usage_by_group = machine_usage_query\
      .join(Student, Group.id == Student.group_id)\
-     .join(Schedule, Schedule.student_name.like('%' + Student.student_name + '%'))
+     .join(StudentMachineUsage, StudentMachineUsage.student_id == Student.id)
     
     if should_filter_by_site():
-        machine_usage_by_group = machine_usage_by_group.filter(Schedule.site_id == site_id)
+        machine_usage_by_group = machine_usage_by_group.filter(StudentMachineUsage.site_id == site_id)
     
     machine_usage_by_group = machine_usage_by_group\
-     .group_by(Group.name, Schedule.machine_name)\
+     .group_by(Group.name, StudentMachineUsage.machine_name)\
      .order_by(Group.name).all()
 
     # Total groups (admins see all sites)
@@ -384,14 +392,22 @@ def index():
 # Export to Excel route
 @app.route("/download_schedule")
 def download_schedule():
-    data = [{
-        "Student": s.student_name,
-        "Group": s.group_name,
-        "Machine": s.machine_name,
-        "Start Time": s.start_time.strftime("%Y-%m-%d %H:%M"),
-        "End Time": s.end_time.strftime("%Y-%m-%d %H:%M"),
-        "Extra Time": s.extra_time
-    } for s in Schedule.query.all()]
+    slots = Schedule.query.options(
+        selectinload(Schedule.participants).joinedload(ScheduleParticipant.student).joinedload(Student.group)
+    ).all()
+
+    # One line per slot; a shared session lists all its students and their groups
+    data = []
+    for s in slots:
+        groups = [s.group_name] + [p.student.group.name for p in s.participants if p.student.group]
+        data.append({
+            "Student": ", ".join(s.student_names),
+            "Group": ", ".join(dict.fromkeys(g for g in groups if g)),
+            "Machine": s.machine_name,
+            "Start Time": s.start_time.strftime("%Y-%m-%d %H:%M"),
+            "End Time": s.end_time.strftime("%Y-%m-%d %H:%M"),
+            "Extra Time": s.extra_time
+        })
     
     df = pd.DataFrame(data)
     output = BytesIO()
@@ -426,16 +442,7 @@ def machines_add():
         
         # Handle dynamic fields
         dynamic_fields = DynamicField.query.filter_by(model_name='Machine').all()
-        for field in dynamic_fields:
-            field_value = request.form.get(f'dynamic_{field.field_name}', '').strip()
-            
-            if field_value:  # Only save if there's a value
-                new_value = DynamicFieldValue(
-                    field_id=field.id,
-                    record_id=new_machine.id,
-                    value=field_value
-                )
-                db.session.add(new_value)
+        save_dynamic_values('Machine', new_machine.id, dynamic_fields, request.form)
         
         db.session.commit()
         flash("Machine added successfully!", "success")
@@ -454,29 +461,9 @@ def machines_edit(machine_id):
         machine.machine_name = request.form["machine_name"].strip()
         machine.level = request.form["level"].strip()
         
-        # Handle dynamic fields
+        # Handle dynamic fields (blank inputs clear the stored value)
         dynamic_fields = DynamicField.query.filter_by(model_name='Machine').all()
-        for field in dynamic_fields:
-            field_value = request.form.get(f'dynamic_{field.field_name}', '').strip()
-            
-            # Find or create dynamic field value
-            existing_value = DynamicFieldValue.query.filter_by(
-                field_id=field.id,
-                record_id=machine.id
-            ).first()
-            
-            if field_value:  # If there's a value
-                if existing_value:
-                    existing_value.value = field_value
-                else:
-                    new_value = DynamicFieldValue(
-                        field_id=field.id,
-                        record_id=machine.id,
-                        value=field_value
-                    )
-                    db.session.add(new_value)
-            elif existing_value:  # If no value but existing record, delete it
-                db.session.delete(existing_value)
+        save_dynamic_values('Machine', machine.id, dynamic_fields, request.form)
         
         db.session.commit()
         flash("Machine updated!", "success")
@@ -486,13 +473,7 @@ def machines_edit(machine_id):
     dynamic_fields = DynamicField.query.filter_by(model_name='Machine').all()
     
     # Get current dynamic field values
-    dynamic_values = {}
-    for field in dynamic_fields:
-        field_value = DynamicFieldValue.query.filter_by(
-            field_id=field.id,
-            record_id=machine.id
-        ).first()
-        dynamic_values[field.field_name] = field_value.value if field_value else ""
+    dynamic_values = dynamic_values_for('Machine', machine.id, dynamic_fields, default="")
     
     return render_template("machines/edit.html", 
                          machine=machine,
@@ -540,26 +521,22 @@ def upload_machines_preview():
         os.makedirs('temp_uploads', exist_ok=True)
         file.save(temp_path)
         
-        # Read Excel file without assuming header row
-        df_raw = pd.read_excel(temp_path, header=None)
+        # Read only the rows the preview shows; the sheet is streamed, never loaded whole
+        preview_rows = read_rows(temp_path, 10)
         
         # Try to detect header row
         header_row = 0
-        for idx in range(min(10, len(df_raw))):
-            row = df_raw.iloc[idx]
+        for idx, row in enumerate(preview_rows):
             text_count = sum(isinstance(val, str) and val.strip() != '' for val in row)
             if text_count >= 1:  # At least 1 column with text
                 header_row = idx
                 break
         
-        # Show first 10 rows for user to select header row
-        preview_rows = df_raw.head(10).values.tolist()
-        
         return render_template('machines/upload_machines_select_header.html',
                              preview_rows=preview_rows,
                              detected_header_row=header_row,
                              filename=filename,
-                             total_rows=len(df_raw))
+                             total_rows=count_rows(temp_path))
     except Exception as e:
         flash(f"Error reading Excel file: {str(e)}", "error")
         return redirect(url_for("machines_upload_form"))
@@ -583,8 +560,8 @@ def upload_machines_analyze():
         return redirect(url_for("machines_upload_form"))
     
     try:
-        # Read Excel file with specified header row
-        df = pd.read_excel(temp_path, header=header_row)
+        # Read the header and the preview rows only
+        df = read_frame(temp_path, header_row, limit=5)
         columns = df.columns.tolist()
         
         # Built-in machine fields
@@ -617,6 +594,7 @@ def upload_machines_analyze():
             cleaned_row = {col: clean_preview_value(row[col]) for col in columns}
             preview_data.append(cleaned_row)
         
+        total = sheet_rows(temp_path)
         return render_template('machines/upload_machines_preview.html',
                              columns=columns,
                              custom_columns=custom_columns,
@@ -624,7 +602,8 @@ def upload_machines_analyze():
                              preview_data=preview_data,
                              filename=filename,
                              header_row=header_row,
-                             total_rows=len(df))
+                             sheet_rows=total,
+                             total_rows=max(total - header_row - 1, 0))
     except Exception as e:
         flash(f"Error reading Excel file: {str(e)}", "error")
         return redirect(url_for("machines_upload_form"))
@@ -648,138 +627,60 @@ def upload_machines_confirm():
         flash("Upload file not found", "error")
         return redirect(url_for("machines_upload_form"))
     
-    try:
-        # Get selected fields to create as dynamic fields
-        selected_fields = request.form.getlist('dynamic_fields')
-        field_types = {}
-        for field in selected_fields:
-            field_types[field] = request.form.get(f'field_type_{field}', 'text')
-        
-        # Create dynamic fields if they don't exist
-        for field_name in selected_fields:
-            existing = DynamicField.query.filter_by(model_name='Machine', field_name=field_name).first()
-            if not existing:
-                new_field = DynamicField(
-                    model_name='Machine',
-                    field_name=field_name,
-                    field_type=field_types.get(field_name, 'text'),
-                    required=False
-                )
-                db.session.add(new_field)
-        db.session.commit()
-        
-        # Import the machines
-        df = pd.read_excel(temp_path, header=header_row)
-        machines_added = 0
-        machines_updated = 0
-        
-        # Helper function to clean values
-        def clean_value(value):
-            if pd.isna(value):
-                return None
-            if isinstance(value, str):
-                cleaned = value.strip()
-                if cleaned.lower() in ['nan', 'none', 'null', '', '-', 'n/a', 'na']:
-                    return None
-                return cleaned
-            return value
-        
-        for _, row in df.iterrows():
-            # Get machine name (required)
-            machine_name = (clean_value(row.get("Machine Name")) or 
-                          clean_value(row.get("machine_name")) or
-                          clean_value(row.get("MACHINE NAME")) or
-                          clean_value(row.get("Machine_Name")))
-            
-            # Skip rows without machine name
-            if not machine_name:
-                continue
-            
-            # Get level (optional)
-            level = (clean_value(row.get("Level")) or 
-                    clean_value(row.get("level")) or
-                    clean_value(row.get("LEVEL")))
-            
-            # Check if machine exists (by name and site)
-            existing_machine = Machine.query.filter_by(
-                machine_name=str(machine_name),
-                site_id=site_id
-            ).first()
-            
-            if existing_machine:
-                # Update existing machine
-                if level:
-                    existing_machine.level = str(level)
-                machine = existing_machine
-                machines_updated += 1
-            else:
-                # Create new machine
-                machine = Machine(
-                    machine_name=str(machine_name),
-                    level=str(level) if level else None,
-                    site_id=site_id
-                )
-                db.session.add(machine)
-                machines_added += 1
-            
-            db.session.flush()
-            
-            # Add or update dynamic field values
-            for field_name in selected_fields:
-                cleaned_value = clean_value(row.get(field_name))
-                if cleaned_value is not None:
-                    field_def = DynamicField.query.filter_by(model_name='Machine', field_name=field_name).first()
-                    if field_def:
-                        # Check if this machine already has a value for this field
-                        existing_field_value = DynamicFieldValue.query.filter_by(
-                            field_id=field_def.id,
-                            record_id=machine.id
-                        ).first()
-                        
-                        if existing_field_value:
-                            # Update existing value
-                            existing_field_value.value = str(cleaned_value)
-                        else:
-                            # Create new value
-                            field_value = DynamicFieldValue(
-                                field_id=field_def.id,
-                                record_id=machine.id,
-                                value=str(cleaned_value)
-                            )
-                            db.session.add(field_value)
-        
-        db.session.commit()
-        
-        # Clean up temp file
-        os.remove(temp_path)
-        
-        # Create success message
-        message_parts = []
-        if machines_added > 0:
-            message_parts.append(f"{machines_added} new machine(s) added")
-        if machines_updated > 0:
-            message_parts.append(f"{machines_updated} existing machine(s) updated")
-        
-        if message_parts:
-            success_message = f"Successfully processed: {' and '.join(message_parts)} with {len(selected_fields)} custom field(s)!"
-        else:
-            success_message = "No machines were added or updated."
-        
-        flash(success_message, "success")
-        return redirect(url_for("machines_list"))
-        
-    except Exception as e:
-        db.session.rollback()
-        flash(f"Error importing data: {str(e)}", "error")
-        return redirect(url_for("machines_upload_form"))
-
+    # Get selected fields to create as dynamic fields
+    selected_fields = request.form.getlist('dynamic_fields')
+    field_types = {}
+    for field in selected_fields:
+        field_types[field] = request.form.get(f'field_type_{field}', 'text')
+    
+    # Import runs in the background; the job page polls its progress
+    job = create_job('machines', site_id, current_user.id, filename,
+                     {'header_row': header_row, 'field_types': field_types,
+                      'rows_total': data_rows(header_row)})
+    submit_job(app, job.id)
+    return redirect(url_for("import_job_page", job_id=job.id))
+
+
+def sheet_rows(path=None):
+    """Non-blank rows of an uploaded sheet. Counted on the first upload
+    step and carried through the wizard forms as ``sheet_rows``, so only
+    the import itself reads the sheet again. Counts ``path`` when the form
+    has none; None without a path."""
+    value = request.form.get('sheet_rows', '')
+    if value.isdigit():
+        return int(value)
+    return count_rows(path) if path else None
+
+def data_rows(header_row):
+    """Import job row total from the carried ``sheet_rows``; None leaves the count to the job"""
+    total = sheet_rows()
+    return None if total is None else max(total - header_row - 1, 0)
 
 # app.py (add this to support summary views)
 
+def name_ids(column, names, site_id=None):
+    """Record id per name for a name column such as Student.student_name,
+    optionally within one site; the oldest record wins a duplicate name"""
+    model = column.class_
+    query = db.session.query(column, model.id).filter(column.in_(list(names)))
+    if site_id is not None:
+        query = query.filter(model.site_id == site_id)
+    ids = {}
+    for name, record_id in query.order_by(model.id):
+        ids.setdefault(name, record_id)
+    return ids
+
+def booked_slots(student):
+    """Query for a student's slots, shared sessions they take part in included"""
+    return Schedule.query.filter(or_(
+        Schedule.student_id == student.id,
+        Schedule.participants.any(student_id=student.id)
+    ))
+
 @app.route("/api/summary/student/<int:student_id>")
 def api_summary_student(student_id):
     student = Student.query.get_or_404(student_id)
-    schedules = Schedule.query.filter(Schedule.student_name == student.student_name).all()
+    schedules = booked_slots(student).all()
     tasks = StudentMiniTaskProgress.query.filter_by(student_id=student.id).all()
     total_hours = sum((s.end_time - s.start_time).seconds for s in schedules) / 3600
 
@@ -799,7 +700,7 @@ def api_summary_student(student_id):
 @app.route("/summary/student/<int:student_id>")
 def summary_student(student_id):
     student = Student.query.get_or_404(student_id)
-    schedules = Schedule.query.filter(Schedule.student_name == student.student_name).all()
+    schedules = booked_slots(student).all()
     tasks = StudentMiniTaskProgress.query.filter_by(student_id=student.id).all()
     total_hours = sum((s.end_time - s.start_time).seconds for s in schedules) / 3600
 
@@ -808,9 +709,10 @@ def summary_student(student_id):
 @app.route("/api/summary/machine/<machine_name>")
 def api_summary_machine(machine_name):
     site_id = get_active_site_id()
-    schedules = Schedule.query.filter(Schedule.machine_name == machine_name, Schedule.site_id == site_id).all()
-    macro_entries = MacroPlan.query.filter(MacroPlan.machine_name == machine_name, MacroPlan.site_id == site_id).all()
-    maintenance_logs = MachineMaintenance.query.filter(MachineMaintenance.machine_name == machine_name, MachineMaintenance.site_id == site_id).all()
+    machine = Machine.query.filter_by(machine_name=machine_name, site_id=site_id).order_by(Machine.id).first_or_404()
+    schedules = Schedule.query.filter(Schedule.machine_id == machine.id).all()
+    macro_entries = MacroPlan.query.filter(MacroPlan.machine_id == machine.id).all()
+    maintenance_logs = MachineMaintenance.query.filter(MachineMaintenance.machine_id == machine.id).all()
 
     return jsonify({
         "machine_name": machine_name,
@@ -829,9 +731,10 @@ def api_summary_machine(machine_name):
 @app.route("/summary/machine/<machine_name>")
 def summary_machine(machine_name):
     site_id = get_active_site_id()
-    schedules = Schedule.query.filter(Schedule.machine_name == machine_name, Schedule.site_id == site_id).all()
-    macro_entries = MacroPlan.query.filter(MacroPlan.machine_name == machine_name, MacroPlan.site_id == site_id).all()
-    maintenance_logs = MachineMaintenance.query.filter(MachineMaintenance.machine_name == machine_name, MachineMaintenance.site_id == site_id).all()
+    machine = Machine.query.filter_by(machine_name=machine_name, site_id=site_id).order_by(Machine.id).first_or_404()
+    schedules = Schedule.query.filter(Schedule.machine_id == machine.id).all()
+    macro_entries = MacroPlan.query.filter(MacroPlan.machine_id == machine.id).all()
+    maintenance_logs = MachineMaintenance.query.filter(MachineMaintenance.machine_id == machine.id).all()
     total_hours = sum((s.end_time - s.start_time).seconds for s in schedules) / 3600
 
     return render_template("summary_machine.html", machine_name=machine_name, schedules=schedules, macros=macro_entries, maintenance=maintenance_logs, total_hours=total_hours)
@@ -858,6 +761,7 @@ def maintenance_add():
     
     new_log = MachineMaintenance(
         machine_name=machine_name,
+        machine_id=name_ids(Machine.machine_name, [machine_name], site_id).get(machine_name),
         task=task,
         performed_by=performed_by,
         notes=notes,
@@ -876,6 +780,7 @@ def maintenance_edit(log_id):
     
     if request.method == "POST":
         log.machine_name = request.form.get("machine_name", "").strip()
+        log.machine_id = name_ids(Machine.machine_name, [log.machine_name], site_id).get(log.machine_name)
         log.task = request.form.get("task", "").strip()
         log.performed_by = request.form.get("performed_by", "").strip()
         log.notes = request.form.get("notes", "").strip()
@@ -983,11 +888,15 @@ def assign_inventory():
             })
     
     # Add tasks from schedule (for students who may not have progress yet)
-    schedules = Schedule.query.all()
+    schedules = Schedule.query.options(
+        selectinload(Schedule.participants).joinedload(ScheduleParticipant.student)
+    ).all()
     for sched in schedules:
-        # Find student by name
-        student = Student.query.filter_by(student_name=sched.student_name).first()
-        if student:
+        # Find student by name; the other students of a shared session are linked
+        lead = Student.query.filter_by(student_name=sched.student_name).first()
+        for student in [lead] + [p.student for p in sched.participants]:
+            if not student:
+                continue
             # Check if this combination already exists in task_list
             existing = any(t.get('student_id') == student.id and t.get('schedule_id') == sched.id for t in task_list)
             if not existing and sched.machine_name:
@@ -1021,6 +930,8 @@ def assign_inventory():
         usage = InventoryUsage(
             consumable=item.item_name,
             student_name=student.student_name,
+            student_id=student.id,
+            inventory_id=item.id,
             quantity=quantity,
             unit_cost=item.cost_per_unit,
             student_task_id=student_task_id
@@ -1109,6 +1020,7 @@ def macroplan_add():
     
     new_plan = MacroPlan(
         machine_name=machine_name,
+        machine_id=name_ids(Machine.machine_name, [machine_name], site_id).get(machine_name),
         date=date_obj,
         planned_maintenance=planned_maintenance,
         breakdown=breakdown,
@@ -1128,6 +1040,7 @@ def macroplan_edit(plan_id):
     plan = MacroPlan.query.filter_by(id=plan_id, site_id=site_id).first_or_404()
     if request.method == "POST":
         plan.machine_name = request.form.get("machine_name", "").strip()
+        plan.machine_id = name_ids(Machine.machine_name, [plan.machine_name], site_id).get(plan.machine_name)
         date_str = request.form.get("date")
         plan.date = datetime.strptime(date_str, "%Y-%m-%d").date()
         plan.planned_maintenance = float(request.form.get("planned_maintenance", 0))
@@ -1422,41 +1335,138 @@ def remove_user_from_site(site_id, user_id):
 ##############################################
 from sqlalchemy.orm import joinedload
 
+# Page size for the students list; the client may ask for up to STUDENT_PAGE_MAX
+STUDENT_PAGE_SIZE = 50
+STUDENT_PAGE_MAX = 200
+
 @app.route("/students")
 @require_site_access
 def list_students():
-    site_id = get_active_site_id()
-    # Admins see all sites, regular users see only their site
-    students = apply_site_filter(Student.query, Student).options(
-        joinedload(Student.group),
-        joinedload(Student.progress).joinedload(StudentMiniTaskProgress.mini_task)
-    ).all()
-    
-    # Get dynamic fields for Student model
+    # Rows are fetched page by page from /students/data
     dynamic_fields = DynamicField.query.filter_by(model_name='Student').all()
     
-    # Add dynamic field values to each student
-    for student in students:
-        student.dynamic_fields = {}
-        for field in dynamic_fields:
-            field_value = DynamicFieldValue.query.filter_by(
-                field_id=field.id,
-                record_id=student.id
-            ).first()
-            student.dynamic_fields[field.field_name] = field_value.value if field_value else None
-    
     # Get all groups for filtering (admins see all sites)
     groups = apply_site_filter(Group.query, Group).all()
     
-    return render_template("students/list.html", students=students, dynamic_fields=dynamic_fields, groups=groups)
+    return render_template("students/list.html", dynamic_fields=dynamic_fields, groups=groups,
+                           page_size=STUDENT_PAGE_SIZE)
+
+def _student_sort_key(sort, dynamic_fields):
+    """SQL expression the students list is ordered by (id breaks ties)"""
+    if sort == 'student_number':
+        return db.func.lower(db.func.coalesce(Student.student_number, ''))
+    if sort == 'student_name':
+        # Plain column so (site_id, student_name) can serve the ordering
+        return Student.student_name
+    if sort == 'group':
+        return db.func.lower(db.func.coalesce(Group.name, ''))
+    field = dynamic_fields.get(sort)
+    if field:
+        value = db.select(DynamicFieldValue.value).where(
+            DynamicFieldValue.field_id == field.id,
+            DynamicFieldValue.record_id == Student.id
+        ).scalar_subquery()
+        return db.func.lower(db.func.coalesce(value, ''))
+    return None
+
+@app.route("/students/data")
+@require_site_access
+def students_data():
+    """One page of the students list as JSON.
+
+    Query args: q (name/number search), group_id, f_<field> (custom field
+    contains), sort (id, student_number, student_name, group or a custom
+    field name), dir (asc/desc), limit, and after_key/after_id from the
+    previous page's ``next`` cursor.
+    """
+    dynamic_fields = {f.field_name: f for f in DynamicField.query.filter_by(model_name='Student').all()}
+    
+    search = request.args.get('q', '').strip()
+    group_id = request.args.get('group_id', type=int)
+    sort = request.args.get('sort', 'id')
+    descending = request.args.get('dir') == 'desc'
+    limit = min(max(request.args.get('limit', STUDENT_PAGE_SIZE, type=int), 1), STUDENT_PAGE_MAX)
+    after_id = request.args.get('after_id', type=int)
+    after_key = request.args.get('after_key', '')
+    
+    # Site filter goes first: filter_by applies to the last joined entity
+    query = apply_site_filter(Student.query, Student).outerjoin(Group, Student.group_id == Group.id)
+    
+    if search:
+        pattern = f"%{search}%"
+        query = query.filter(db.or_(Student.student_name.ilike(pattern),
+                                    Student.student_number.ilike(pattern)))
+    if group_id:
+        query = query.filter(Student.group_id == group_id)
+    
+    # Custom field filters
+    for name, field in dynamic_fields.items():
+        value = request.args.get(f'f_{name}', '').strip()
+        if value:
+            query = query.filter(db.exists().where(
+                DynamicFieldValue.field_id == field.id,
+                DynamicFieldValue.record_id == Student.id,
+                DynamicFieldValue.value.ilike(f"%{value}%")
+            ))
+    
+    # Total only on the first page; later pages reuse it
+    total = query.count() if after_id is None else None
+    
+    sort_key = _student_sort_key(sort, dynamic_fields)
+    if sort_key is None:
+        sort = 'id'
+    
+    # Keyset pagination: continue strictly after the last row of the previous page
+    if after_id is not None:
+        if sort_key is None:
+            query = query.filter(Student.id < after_id if descending else Student.id > after_id)
+        elif descending:
+            query = query.filter(db.or_(sort_key < after_key,
+                                        db.and_(sort_key == after_key, Student.id < after_id)))
+        else:
+            query = query.filter(db.or_(sort_key > after_key,
+                                        db.and_(sort_key == after_key, Student.id > after_id)))
+    
+    order = [Student.id.desc() if descending else Student.id]
+    if sort_key is not None:
+        order.insert(0, sort_key.desc() if descending else sort_key)
+        query = query.add_columns(sort_key)
+    
+    rows = query.add_columns(Group.name).order_by(*order).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    
+    # Custom field values for this page only
+    values = load_dynamic_values('Student', [r[0].id for r in rows], list(dynamic_fields.values()))
+    
+    students = []
+    for row in rows:
+        student = row[0]
+        students.append({
+            'id': student.id,
+            'student_number': student.student_number,
+            'student_name': student.student_name,
+            'group': row[-1],
+            'dynamic_fields': values.get(student.id, {}),
+        })
+    
+    next_cursor = None
+    if has_more:
+        last = rows[-1]
+        next_cursor = {'after_id': last[0].id, 'after_key': last[1] if sort_key is not None else ''}
+    
+    return jsonify({
+        'students': students,
+        'total': total,
+        'sort': sort,
+        'dir': 'desc' if descending else 'asc',
+        'next': next_cursor,
+    })
 
 @app.route("/students/export")
 @login_required
 @require_site_access
 def export_students():
-    import pandas as pd
-    from io import BytesIO, StringIO
-    
     site_id = get_active_site_id()
     
     # Get parameters
@@ -1466,7 +1476,7 @@ def export_students():
     export_format = request.args.get('format', 'excel')
     
     # Get students (site-specific)
-    query = Student.query.filter_by(site_id=site_id).options(joinedload(Student.group))
+    query = Student.query.filter_by(site_id=site_id)
     
     if student_ids != 'all' and student_ids:
         student_ids = [int(id) for id in student_ids.split(',')]
@@ -1479,66 +1489,22 @@ def export_students():
             )
         )
     
-    students = query.all()
-    
-    # Get dynamic fields
-    dynamic_fields = DynamicField.query.filter_by(model_name='Student').all()
-    dynamic_field_names = [f.field_name for f in dynamic_fields]
-    
-    # Build data for export
-    data = []
-    for student in students:
-        row = {}
-        
-        # Standard fields
-        if 'student_number' in fields:
-            row['Student Number'] = student.student_number or ''
-        if 'student_name' in fields:
-            row['Name'] = student.student_name
-        if 'group' in fields:
-            row['Group'] = student.group.name if student.group else 'No Group'
-        
-        # Dynamic fields
-        for field_name in fields:
-            if field_name in dynamic_field_names:
-                field = next((f for f in dynamic_fields if f.field_name == field_name), None)
-                if field:
-                    field_value = DynamicFieldValue.query.filter_by(
-                        field_id=field.id,
-                        record_id=student.id
-                    ).first()
-                    row[field_name.replace('_', ' ').title()] = field_value.value if field_value else ''
-        
-        data.append(row)
-    
-    # Create DataFrame
-    df = pd.DataFrame(data)
+    # Rows are streamed from the database, never loaded all at once
+    headers, rows = student_export_rows(query, fields)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     
     if export_format == 'csv':
-        # Export as CSV
-        output = StringIO()
-        df.to_csv(output, index=False)
-        output.seek(0)
-        
-        return send_file(
-            BytesIO(output.getvalue().encode('utf-8')),
-            mimetype='text/csv',
-            as_attachment=True,
-            download_name=f'students_export_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
-        )
+        filename = f'students_export_{timestamp}.csv'
+        body = stream_with_context(iter_csv(headers, rows))
+        mimetype = 'text/csv'
     else:
-        # Export as Excel
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Students', index=False)
-        output.seek(0)
-        
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=f'students_export_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
-        )
+        # XLSX is a zip, so the workbook is spooled to a temp file before sending
+        filename = f'students_export_{timestamp}.xlsx'
+        body = iter_file(write_xlsx(headers, rows))
+        mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    
+    return Response(body, mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
 
 @app.route("/students/add", methods=["GET", "POST"])
 @require_site_access
@@ -1561,16 +1527,7 @@ def students_add():
         
         # Handle dynamic fields
         dynamic_fields = DynamicField.query.filter_by(model_name='Student').all()
-        for field in dynamic_fields:
-            field_value = request.form.get(f'dynamic_{field.field_name}', '').strip()
-            
-            if field_value:  # Only save if there's a value
-                new_value = DynamicFieldValue(
-                    field_id=field.id,
-                    record_id=new_student.id,
-                    value=field_value
-                )
-                db.session.add(new_value)
+        save_dynamic_values('Student', new_student.id, dynamic_fields, request.form)
         
         db.session.commit()
         flash("Student added successfully!", "success")
@@ -1592,29 +1549,9 @@ def students_edit(student_id):
         group_id = request.form.get("group_id")
         student.group_id = group_id if group_id else None
         
-        # Handle dynamic fields
+        # Handle dynamic fields (blank inputs clear the stored value)
         dynamic_fields = DynamicField.query.filter_by(model_name='Student').all()
-        for field in dynamic_fields:
-            field_value = request.form.get(f'dynamic_{field.field_name}', '').strip()
-            
-            # Find or create dynamic field value
-            existing_value = DynamicFieldValue.query.filter_by(
-                field_id=field.id,
-                record_id=student.id
-            ).first()
-            
-            if field_value:  # If there's a value
-                if existing_value:
-                    existing_value.value = field_value
-                else:
-                    new_value = DynamicFieldValue(
-                        field_id=field.id,
-                        record_id=student.id,
-                        value=field_value
-                    )
-                    db.session.add(new_value)
-            elif existing_value:  # If no value but existing record, delete it
-                db.session.delete(existing_value)
+        save_dynamic_values('Student', student.id, dynamic_fields, request.form)
         
         db.session.commit()
         flash("Student updated successfully!", "success")
@@ -1625,13 +1562,7 @@ def students_edit(student_id):
     dynamic_fields = DynamicField.query.filter_by(model_name='Student').all()
     
     # Get current dynamic field values
-    dynamic_values = {}
-    for field in dynamic_fields:
-        field_value = DynamicFieldValue.query.filter_by(
-            field_id=field.id,
-            record_id=student.id
-        ).first()
-        dynamic_values[field.field_name] = field_value.value if field_value else ""
+    dynamic_values = dynamic_values_for('Student', student.id, dynamic_fields, default="")
     
     return render_template("students/edit.html", 
                          student=student, 
@@ -1834,7 +1765,7 @@ def student_dashboard():
         return redirect(url_for("student_login"))
 
     student = Student.query.get_or_404(session["student_id"])
-    schedules = Schedule.query.filter_by(student_name=student.student_name).order_by(Schedule.start_time).all()
+    schedules = booked_slots(student).order_by(Schedule.start_time).all()
     progress = StudentMiniTaskProgress.query.filter_by(student_id=student.id).all()
     
     # Calculate total training hours
@@ -1852,8 +1783,8 @@ def student_dashboard():
     completed_tasks = sum(1 for p in progress if p.attempt_1 or p.attempt_2 or p.attempt_3)
     completion_rate = (completed_tasks / total_tasks * 100) if total_tasks > 0 else 0
     
-    # Get inventory usage for this student (use LIKE to match partial names)
-    inventory_usage = InventoryUsage.query.filter(InventoryUsage.student_name.like(f'%{student.student_name}%')).all()
+    # Get inventory usage for this student
+    inventory_usage = InventoryUsage.query.filter_by(student_id=student.id).all()
     total_inventory_cost = sum(i.quantity * i.unit_cost for i in inventory_usage)
     
     # Get modules and mini-tasks
@@ -1893,19 +1824,12 @@ def student_dashboard():
 def profile_student(student_id):
     student = Student.query.get_or_404(student_id)
     progress = StudentMiniTaskProgress.query.filter_by(student_id=student.id).all()
-    # Use LIKE query to match partial student names (e.g., "Maila Frans" matches "AGT21006 Maila Frans")
-    inventory = InventoryUsage.query.filter(InventoryUsage.student_name.like(f'%{student.student_name}%')).all()
-    schedule = Schedule.query.filter(Schedule.student_name.like(f'%{student.student_name}%')).all()
+    inventory = InventoryUsage.query.filter_by(student_id=student.id).all()
+    # Joined on the resolved student_id (see resolvers.py)
+    schedule = booked_slots(student).all()
     
     # Get dynamic field values
-    dynamic_fields = DynamicField.query.filter_by(model_name='Student').all()
-    dynamic_data = {}
-    for field in dynamic_fields:
-        field_value = DynamicFieldValue.query.filter_by(
-            field_id=field.id,
-            record_id=student.id
-        ).first()
-        dynamic_data[field.field_name] = field_value.value if field_value else ""
+    dynamic_data = dynamic_values_for('Student', student.id, default="")
 
     response_data = {
         "full_name": student.student_name,
@@ -1979,27 +1903,23 @@ def upload_students_preview():
         os.makedirs('temp_uploads', exist_ok=True)
         file.save(temp_path)
         
-        # Read Excel file without assuming header row
-        df_raw = pd.read_excel(temp_path, header=None)
+        # Read only the rows the preview shows; the sheet is streamed, never loaded whole
+        preview_rows = read_rows(temp_path, 10)
         
         # Try to detect header row (look for rows with text-heavy content)
         header_row = 0
-        for idx in range(min(10, len(df_raw))):  # Check first 10 rows
-            row = df_raw.iloc[idx]
+        for idx, row in enumerate(preview_rows):  # Check first 10 rows
             # Count how many cells are non-empty strings
             text_count = sum(isinstance(val, str) and val.strip() != '' for val in row)
             if text_count >= 2:  # If at least 2 columns have text
                 header_row = idx
                 break
         
-        # Show first 10 rows for user to select header row
-        preview_rows = df_raw.head(10).values.tolist()
-        
         return render_template('upload_students_select_header.html',
                              preview_rows=preview_rows,
                              detected_header_row=header_row,
                              filename=filename,
-                             total_rows=len(df_raw),
+                             total_rows=count_rows(temp_path),
                              intake_group_id=intake_group_id,
                              intake_group_name=intake_group.name)
     except Exception as e:
@@ -2035,8 +1955,8 @@ def upload_students_analyze():
         return redirect(url_for("students_upload_form"))
     
     try:
-        # Read Excel file with specified header row
-        df = pd.read_excel(temp_path, header=header_row)
+        # Read the header and the preview rows only
+        df = read_frame(temp_path, header_row, limit=5)
         columns = df.columns.tolist()
         
         # Built-in student fields
@@ -2073,6 +1993,7 @@ def upload_students_analyze():
             cleaned_row = {col: clean_preview_value(row[col]) for col in columns}
             preview_data.append(cleaned_row)
         
+        total = sheet_rows(temp_path)
         return render_template('upload_students_preview.html',
                              columns=columns,
                              custom_columns=custom_columns,
@@ -2080,7 +2001,8 @@ def upload_students_analyze():
                              preview_data=preview_data,
                              filename=filename,
                              header_row=header_row,
-                             total_rows=len(df),
+                             sheet_rows=total,
+                             total_rows=max(total - header_row - 1, 0),
                              intake_group_id=intake_group_id,
                              intake_group_name=intake_group.name)
     except Exception as e:
@@ -2088,6 +2010,7 @@ def upload_students_analyze():
         return redirect(url_for("students_upload_form"))
 
 @app.route("/students/upload_confirm", methods=["POST"])
+@require_site_access
 def upload_students_confirm():
     """Step 2: Create dynamic fields and import data"""
     filename = request.form.get('filename')
@@ -2115,158 +2038,36 @@ def upload_students_confirm():
         flash("Upload file not found", "error")
         return redirect(url_for("students_upload_form"))
     
-    try:
-        # Get selected fields to create as dynamic fields
-        selected_fields = request.form.getlist('dynamic_fields')
-        field_types = {}
-        for field in selected_fields:
-            field_types[field] = request.form.get(f'field_type_{field}', 'text')
-        
-        # Create dynamic fields if they don't exist
-        for field_name in selected_fields:
-            existing = DynamicField.query.filter_by(model_name='Student', field_name=field_name).first()
-            if not existing:
-                new_field = DynamicField(
-                    model_name='Student',
-                    field_name=field_name,
-                    field_type=field_types.get(field_name, 'text'),
-                    required=False
-                )
-                db.session.add(new_field)
-        db.session.commit()
-        
-        # Now import the students with specified header row
-        df = pd.read_excel(temp_path, header=header_row)
-        students_added = 0
-        students_updated = 0
-        
-        # Helper function to clean and validate cell values
-        def clean_value(value):
-            """Clean cell value and return None if invalid"""
-            if pd.isna(value):
-                return None
-            if isinstance(value, str):
-                cleaned = value.strip()
-                # Check for common invalid values
-                if cleaned.lower() in ['nan', 'none', 'null', '', '-', 'n/a', 'na']:
-                    return None
-                return cleaned
-            return value
-        
-        for _, row in df.iterrows():
-            # Handle built-in fields with multiple possible column names
-            student_number = (clean_value(row.get("Student Number")) or 
-                            clean_value(row.get("student_number")) or
-                            clean_value(row.get("STUDENT NUMBER")) or
-                            clean_value(row.get("Student_Number")) or
-                            clean_value(row.get("ID NUMBER")) or
-                            clean_value(row.get("ID_NUMBER")))
-            
-            # Try to get student name from different possible columns
-            student_name = (clean_value(row.get("Student Name")) or 
-                          clean_value(row.get("student_name")) or
-                          clean_value(row.get("STUDENT NAME")) or
-                          clean_value(row.get("Student_Name")))
-            
-            # If no combined name, try NAME and SURNAME columns
-            if not student_name:
-                name_part = clean_value(row.get("NAME")) or clean_value(row.get("Name")) or clean_value(row.get("name"))
-                surname_part = clean_value(row.get("SURNAME")) or clean_value(row.get("Surname")) or clean_value(row.get("surname"))
-                
-                if name_part and surname_part:
-                    student_name = f"{name_part} {surname_part}"
-                elif name_part:
-                    student_name = name_part
-                elif surname_part:
-                    student_name = surname_part
-            
-            # Skip rows without valid student name
-            if not student_name:
-                continue
-            
-            # ====== CHECK FOR EXISTING STUDENT ======
-            existing_student = None
-            
-            # Try to find by student_number first (most reliable)
-            if student_number:
-                existing_student = Student.query.filter_by(student_number=str(student_number)).first()
-            
-            # If not found by number, try by name (fallback)
-            if not existing_student:
-                existing_student = Student.query.filter_by(student_name=str(student_name)).first()
-            
-            # If student exists, UPDATE them
-            if existing_student:
-                # Update basic fields if they have new values
-                if student_number and not existing_student.student_number:
-                    existing_student.student_number = str(student_number)
-                
-                # Update group if specified (optional - you can remove this if you don't want to change groups)
-                if intake_group.id:
-                    existing_student.group_id = intake_group.id
-                
-                student = existing_student
-                students_updated += 1
-            else:
-                # Create NEW student with the selected intake group
-                student = Student(
-                    student_number=str(student_number) if student_number else None,
-                    student_name=str(student_name),
-                    group_id=intake_group.id
-                )
-                db.session.add(student)
-                students_added += 1
-            
-            db.session.flush()
-            
-            # Add or UPDATE dynamic field values
-            for field_name in selected_fields:
-                cleaned_value = clean_value(row.get(field_name))
-                if cleaned_value is not None:
-                    field_def = DynamicField.query.filter_by(model_name='Student', field_name=field_name).first()
-                    if field_def:
-                        # Check if this student already has a value for this field
-                        existing_field_value = DynamicFieldValue.query.filter_by(
-                            field_id=field_def.id,
-                            record_id=student.id
-                        ).first()
-                        
-                        if existing_field_value:
-                            # UPDATE existing value
-                            existing_field_value.value = str(cleaned_value)
-                        else:
-                            # CREATE new value
-                            field_value = DynamicFieldValue(
-                                field_id=field_def.id,
-                                record_id=student.id,
-                                value=str(cleaned_value)
-                            )
-                            db.session.add(field_value)
-        
-        db.session.commit()
-        
-        # Clean up temp file
-        os.remove(temp_path)
-        
-        # Create detailed success message
-        message_parts = []
-        if students_added > 0:
-            message_parts.append(f"{students_added} new student(s) added")
-        if students_updated > 0:
-            message_parts.append(f"{students_updated} existing student(s) updated")
-        
-        if message_parts:
-            success_message = f"Successfully processed: {' and '.join(message_parts)} to '{intake_group.name}' with {len(selected_fields)} custom field(s)!"
-        else:
-            success_message = "No students were added or updated."
-        
-        flash(success_message, "success")
-        return redirect(url_for("list_students"))
-        
-    except Exception as e:
-        db.session.rollback()
-        flash(f"Error importing data: {str(e)}", "error")
-        return redirect(url_for("students_upload_form"))
+    # Get selected fields to create as dynamic fields
+    selected_fields = request.form.getlist('dynamic_fields')
+    field_types = {}
+    for field in selected_fields:
+        field_types[field] = request.form.get(f'field_type_{field}', 'text')
+    
+    # Import runs in the background; the job page polls its progress
+    job = create_job('students', get_active_site_id(), current_user.id, filename,
+                     {'header_row': header_row, 'intake_group_id': intake_group.id, 'field_types': field_types,
+                      'rows_total': data_rows(header_row)})
+    submit_job(app, job.id)
+    return redirect(url_for("import_job_page", job_id=job.id))
+
+##############################################
+# IMPORT JOBS
+##############################################
+@app.route("/jobs/<int:job_id>")
+@require_site_access
+def import_job_status(job_id):
+    """Job progress as JSON, polled by the job page"""
+    job = ImportJob.query.filter_by(id=job_id, site_id=get_active_site_id()).first_or_404()
+    return jsonify(fail_if_stale(job).to_dict())
+
+@app.route("/jobs/<int:job_id>/view")
+@require_site_access
+def import_job_page(job_id):
+    job = fail_if_stale(ImportJob.query.filter_by(id=job_id, site_id=get_active_site_id()).first_or_404())
+    return_url = url_for("list_students") if job.kind == 'students' else url_for("machines_list")
+    return render_template("import_job.html", job=job, return_url=return_url)
+
 # LECTURERS
 ##############################################
 @app.route("/lecturers")
@@ -2337,6 +2138,7 @@ def add_module():
     category = request.form.get("module_category", "").strip()
     status_type = request.form.get("module_status_type", "P/NYP").strip()
     credits = request.form.get("module_credits", "").strip()
+    level = request.form.get("module_level", "").strip()
     
     m = Module(
         name=name,
@@ -2344,6 +2146,7 @@ def add_module():
         category=category if category else None,
         status_type=status_type,
         credits=credits if credits else None,
+        level=level if level else None,
         site_id=site_id
     )
     db.session.add(m)
@@ -2363,6 +2166,7 @@ def edit_module(mod_id):
         module.category = request.form.get("module_category", "").strip() or None
         module.status_type = request.form.get("module_status_type", "P/NYP").strip()
         module.credits = request.form.get("module_credits", "").strip() or None
+        module.level = request.form.get("module_level", "").strip() or None
         db.session.commit()
         flash("Module updated!", "success")
         return redirect(url_for("modules_page"))
@@ -2602,7 +2406,9 @@ def student_module_form(mini_task_id, student_id):
 # SCHEDULE GENERATION
 ##############################################
 @app.route("/generate_schedule", methods=["POST"])
+@require_site_access
 def generate_schedule():
+    site_id = get_active_site_id()
     try:
         session["schedule_form"] = {
             "slot_duration": request.form["slot_duration"],
@@ -2631,69 +2437,40 @@ def generate_schedule():
         allowance_time = int(request.form.get("allowance_time", 0))
         priority_rule = request.form.get("priority_rule", "FIFO")
 
-        lunch_start_dt = datetime.combine(start_date_obj, lunch_start_obj)
-        lunch_end_dt = lunch_start_dt + timedelta(minutes=lunch_duration)
-
-        current_dt = datetime.combine(start_date_obj, start_time_obj)
-        final_dt = datetime.combine(end_date_obj, end_time_obj)
+        calendar = WorkCalendar(start_date_obj, end_date_obj, start_time_obj, end_time_obj,
+                                lunch_start_obj, lunch_duration)
 
-        all_students = Student.query.all()
+        # Get the site's students with their group names in one query
+        students = db.session.query(Student.id, Student.student_name, Group.name).outerjoin(
+            Group, Student.group_id == Group.id
+        ).filter(Student.site_id == site_id).order_by(Student.id).all()
         orders = []
-        for s in all_students:
+        for student_id, student_name, group_name in students:
             # No mark-based extra time anymore, just use base duration
-            total_time = base_slot_duration
             orders.append({
-                "Student": s.student_name,
-                "Group": s.group.name if s.group else "",
-                "processing_time": total_time,
+                "student_id": student_id,
+                "student_name": student_name,
+                "group_name": group_name or "",
+                "site_id": site_id,
+                "processing_time": base_slot_duration,
                 "extra_time": 0
             })
 
-        if priority_rule == "SPT":
-            orders.sort(key=lambda x: x["processing_time"])
-        elif priority_rule == "LPT":
-            orders.sort(key=lambda x: x["processing_time"], reverse=True)
+        orders = dispatch_order(orders, priority_rule)
 
-        Schedule.query.delete()
-        db.session.commit()
+        machine_names = [name for (name,) in db.session.query(Machine.machine_name).filter(
+            Machine.site_id == site_id).order_by(Machine.id)]
+        rows, unscheduled = plan_round_robin(orders, machine_names, calendar, allowance_time)
 
-        machines = Machine.query.all()
-
-        while orders and current_dt < final_dt:
-            order = orders.pop(0)
-            working_day_end = datetime.combine(current_dt.date(), end_time_obj)
-
-            if current_dt >= working_day_end:
-                current_dt = datetime.combine(current_dt.date() + timedelta(days=1), start_time_obj)
-                continue
-
-            slot_end_dt = current_dt + timedelta(minutes=order["processing_time"])
-
-            if lunch_start_dt <= current_dt < lunch_end_dt or current_dt < lunch_start_dt < slot_end_dt:
-                current_dt = lunch_end_dt
-                slot_end_dt = current_dt + timedelta(minutes=order["processing_time"])
-
-            if slot_end_dt > working_day_end:
-                current_dt = datetime.combine(current_dt.date() + timedelta(days=1), start_time_obj)
-                continue
-
-            machine_index = Schedule.query.count() % len(machines) if machines else 0
-            machine_name = machines[machine_index].machine_name if machines else "N/A"
-
-            db.session.add(Schedule(
-                student_name=order["Student"],
-                group_name=order["Group"],
-                machine_name=machine_name,
-                start_time=current_dt,
-                end_time=slot_end_dt,
-                extra_time=order["extra_time"]
-            ))
-            db.session.commit()
-
-            current_dt = slot_end_dt + timedelta(minutes=allowance_time)
+        # Stage the run, then swap it in for this site's slots in the date window
+        run = stage_run(site_id, 'basic', calendar, rows, current_user.id)
+        publish_run(run, schedule_scope(site_id, calendar))
 
+        if unscheduled:
+            flash(f"{len(unscheduled)} student(s) did not fit before the end date.", "warning")
         flash("Schedule generated successfully with lunch break!", "success")
     except Exception as e:
+        db.session.rollback()
         flash(f"Error generating schedule: {e}", "danger")
 
     return redirect(url_for("index"))
@@ -2713,12 +2490,38 @@ def schedule_generate_advanced_page():
                          groups=groups,
                          modules=modules,
                          machines=machines,
-                         students=students)
+                         students=students,
+                         max_scenarios=MAX_SCENARIOS,
+                         max_time_budget=MAX_TIME_BUDGET)
+
+# Proposed slots listed per what-if scenario
+SIMULATION_PREVIEW_ROWS = 50
+
+def what_if_variants(form, priority_rule, slot_duration, optimize, time_budget):
+    """Parameter sets to compare: every combination of the priority rules,
+    slot durations and greedy/optimized modes ticked on the form, each
+    defaulting to the single setting chosen for generation. The optimized
+    scenarios that will run share ``time_budget`` between them, so the
+    dry run stays as short as one optimized generation."""
+    rules = form.getlist('compare_rules') or [priority_rule]
+    durations = [int(d) for d in form.get('compare_durations', '').replace(',', ' ').split() if int(d) > 0]
+    modes = [False, True] if form.get('compare_optimize') else [optimize]
+    combinations = [(rule, duration, mode)
+                    for rule in rules for duration in durations or [slot_duration] for mode in modes]
+    optimized = sum(mode for _, _, mode in combinations[:MAX_SCENARIOS]) or 1
+    return [{
+        'label': f"{rule}, {duration} min, {'optimized' if mode else 'greedy'}",
+        'priority_rule': rule,
+        'slot_duration': duration,
+        'optimize': mode,
+        'time_budget': time_budget / optimized,
+    } for rule, duration, mode in combinations]
 
 @app.route("/generate_schedule_advanced", methods=["POST"])
-@login_required
+@require_site_access
 def generate_schedule_advanced():
     """Generate schedule with advanced options"""
+    site_id = get_active_site_id()
     try:
         # Get form parameters
         session_type = request.form.get('session_type', 'practical')
@@ -2728,6 +2531,9 @@ def generate_schedule_advanced():
         priority_rule = request.form.get('priority_rule', 'FIFO')
         clear_existing = request.form.get('clear_existing') == 'on'
         notes = request.form.get('notes', '')
+        optimize = request.form.get('optimize') == 'on'
+        placement = request.form.get('placement', 'first')
+        time_budget = min(max(float(request.form.get('time_budget') or 2), 0.1), MAX_TIME_BUDGET)
         
         # Date and time settings
         start_date = datetime.strptime(request.form['start_date'], '%Y-%m-%d').date()
@@ -2746,6 +2552,9 @@ def generate_schedule_advanced():
         # Combined filtering - collect all student IDs matching ANY criteria
         all_student_ids = set()
         module_names_for_schedule = []
+        module_levels = {}
+        student_modules = defaultdict(set)
+        group_ids, module_ids = [], []
         
         # Check for specific student selection first (overrides other filters)
         custom_student_ids = request.form.getlist('student_ids')
@@ -2766,16 +2575,22 @@ def generate_schedule_advanced():
                     module = Module.query.get(module_id)
                     if module:
                         module_names_for_schedule.append(module.name)
+                        module_levels[module.id] = normalize_level(module.level)
                         student_ids = [p.student_id for p in StudentModuleProgress.query.filter_by(module_id=module_id).all()]
                         all_student_ids.update(student_ids)
+                        for student_id in student_ids:
+                            student_modules[student_id].add(module.id)
             
-            # If no filters selected, get all students
+            # If no filters selected, get all of the site's students
             if not group_ids and not module_ids:
-                all_students = Student.query.all()
+                all_students = Student.query.filter_by(site_id=site_id).all()
                 all_student_ids.update([s.id for s in all_students])
         
         # Get student objects
-        students = Student.query.filter(Student.id.in_(list(all_student_ids))).all() if all_student_ids else []
+        students = Student.query.options(joinedload(Student.group)).filter(
+            Student.id.in_(list(all_student_ids)),
+            Student.site_id == site_id
+        ).order_by(Student.id).all() if all_student_ids else []
         
         if not students:
             flash('No students found matching the criteria.', 'warning')
@@ -2784,179 +2599,132 @@ def generate_schedule_advanced():
         # Get machines - use selected machines or all machines
         machine_ids = request.form.getlist('machine_ids')
         if machine_ids:
-            machines = Machine.query.filter(Machine.id.in_(machine_ids)).all()
+            machines = Machine.query.filter(Machine.id.in_(machine_ids), Machine.site_id == site_id).all()
         else:
-            machines = Machine.query.all()
+            machines = Machine.query.filter_by(site_id=site_id).all()
         
         if not machines:
             flash('No machines available for scheduling.', 'danger')
             return redirect(url_for('schedule_generate_advanced_page'))
         
-        # Clear existing schedule if requested
-        if clear_existing:
-            Schedule.query.delete()
-            db.session.commit()
-        
         # Prepare student orders
         orders = []
         module_name_combined = ', '.join(module_names_for_schedule) if module_names_for_schedule else None
         for student in students:
+            # Machine levels of the selected modules this student takes; None when any machine will do
+            levels = {module_levels[mid] for mid in student_modules.get(student.id) or module_levels}
             orders.append({
-                'student': student,
+                'student_name': student.student_name,
+                'student_id': student.id,
+                'group_name': student.group.name if student.group else '',
+                'site_id': site_id,
+                'module_name': module_name_combined,
+                'session_type': session_type,
+                'capacity': 1,
+                'notes': notes,
                 'processing_time': slot_duration,
-                'module_name': module_name_combined
+                'levels': None if not levels or None in levels else levels
             })
-        
-        # Apply priority sorting
-        if priority_rule == 'SPT':
-            orders.sort(key=lambda x: x['processing_time'])
-        elif priority_rule == 'LPT':
-            orders.sort(key=lambda x: x['processing_time'], reverse=True)
-        elif priority_rule == 'GROUP':
-            orders.sort(key=lambda x: x['student'].group.name if x['student'].group else 'ZZZ')
-        elif priority_rule == 'MODULE':
-            orders.sort(key=lambda x: x['module_name'] or 'ZZZ')
-        
-        # Calculate lunch times
-        lunch_start_dt = datetime.combine(start_date, lunch_start)
-        lunch_end_dt = lunch_start_dt + timedelta(minutes=lunch_duration)
-        
-        # Schedule generation logic
-        current_dt = datetime.combine(start_date, start_time)
-        final_dt = datetime.combine(end_date, end_time)
-        machine_index = 0
-        scheduled_count = 0
-        
+
+        # Apply priority rule as the dispatch order
+        orders = dispatch_order(orders, priority_rule)
+
+        calendar = WorkCalendar(start_date, end_date, start_time, end_time,
+                                lunch_start, lunch_duration, allowed_days)
+        machine_names = [m.machine_name for m in machines]
+
+        # Regeneration scope: this site's slots starting in the window, narrowed
+        # to the selected students (or groups) and machines
+        scope = schedule_scope(
+            site_id, calendar,
+            group_names=[g.name for g in Group.query.filter(Group.id.in_(group_ids))]
+                if group_ids and not module_ids and not custom_student_ids else None,
+            machine_names=machine_names if machine_ids else None,
+            student_names=[s.student_name for s in students] if custom_student_ids or module_ids else None
+        )
+        replacing = scope if clear_existing else None
+
         # For tests with multiple students per session
+        session_size = 1
         if session_type in ['practical_test', 'written_test'] and students_per_session > 1:
-            # Batch students together
-            batches = [orders[i:i + students_per_session] for i in range(0, len(orders), students_per_session)]
-            
-            for batch in batches:
-                if current_dt >= final_dt:
-                    break
-                
-                # Skip to next allowed day if needed
-                while current_dt.weekday() not in allowed_days:
-                    current_dt = datetime.combine(current_dt.date() + timedelta(days=1), start_time)
-                    if current_dt >= final_dt:
-                        break
-                
-                if current_dt >= final_dt:
-                    break
-                
-                working_day_end = datetime.combine(current_dt.date(), end_time)
-                
-                # Update lunch times for current day
-                lunch_start_today = datetime.combine(current_dt.date(), lunch_start)
-                lunch_end_today = lunch_start_today + timedelta(minutes=lunch_duration)
-                
-                # Skip lunch break
-                if lunch_start_today <= current_dt < lunch_end_today:
-                    current_dt = lunch_end_today
-                
-                slot_end_dt = current_dt + timedelta(minutes=slot_duration)
-                
-                # Handle lunch overlap
-                if current_dt < lunch_start_today < slot_end_dt:
-                    current_dt = lunch_end_today
-                    slot_end_dt = current_dt + timedelta(minutes=slot_duration)
-                
-                # Move to next day if session doesn't fit
-                if slot_end_dt > working_day_end:
-                    current_dt = datetime.combine(current_dt.date() + timedelta(days=1), start_time)
-                    continue
-                
-                # Assign machine
-                machine = machines[machine_index % len(machines)]
-                
-                # Create schedule entries for all students in batch
-                for order in batch:
-                    student = order['student']
-                    schedule_entry = Schedule(
-                        student_name=student.student_name,
-                        group_name=student.group.name if student.group else '',
-                        machine_name=machine.machine_name,
-                        module_name=order['module_name'],
-                        start_time=current_dt,
-                        end_time=slot_end_dt,
-                        session_type=session_type,
-                        capacity=students_per_session,
-                        notes=notes
-                    )
-                    db.session.add(schedule_entry)
-                    scheduled_count += 1
-                
-                db.session.commit()
-                
-                # Move to next time slot
-                current_dt = slot_end_dt + timedelta(minutes=allowance_time)
-                if not request.form.get('same_machine_for_test'):
-                    machine_index += 1
-        
-        else:
-            # Individual scheduling (one student per session)
+            session_size = students_per_session
             for order in orders:
-                if current_dt >= final_dt:
-                    break
-                
-                # Skip to next allowed day if needed
-                while current_dt.weekday() not in allowed_days:
-                    current_dt = datetime.combine(current_dt.date() + timedelta(days=1), start_time)
-                    if current_dt >= final_dt:
-                        break
-                
-                if current_dt >= final_dt:
-                    break
-                
-                working_day_end = datetime.combine(current_dt.date(), end_time)
-                
-                # Update lunch times for current day
-                lunch_start_today = datetime.combine(current_dt.date(), lunch_start)
-                lunch_end_today = lunch_start_today + timedelta(minutes=lunch_duration)
-                
-                # Skip lunch break
-                if lunch_start_today <= current_dt < lunch_end_today:
-                    current_dt = lunch_end_today
-                
-                slot_end_dt = current_dt + timedelta(minutes=order['processing_time'])
-                
-                # Handle lunch overlap
-                if current_dt < lunch_start_today < slot_end_dt:
-                    current_dt = lunch_end_today
-                    slot_end_dt = current_dt + timedelta(minutes=order['processing_time'])
-                
-                # Move to next day if session doesn't fit
-                if slot_end_dt > working_day_end:
-                    current_dt = datetime.combine(current_dt.date() + timedelta(days=1), start_time)
-                    continue
-                
-                # Assign machine
-                machine = machines[machine_index % len(machines)]
-                student = order['student']
-                
-                schedule_entry = Schedule(
-                    student_name=student.student_name,
-                    group_name=student.group.name if student.group else '',
-                    machine_name=machine.machine_name,
-                    module_name=order['module_name'],
-                    start_time=current_dt,
-                    end_time=slot_end_dt,
-                    session_type=session_type,
-                    capacity=1,
-                    notes=notes
-                )
-                db.session.add(schedule_entry)
-                scheduled_count += 1
-                
-                db.session.commit()
-                
-                # Move to next time slot and machine
-                current_dt = slot_end_dt + timedelta(minutes=allowance_time)
-                machine_index += 1
-        
-        flash(f'Schedule generated successfully! {scheduled_count} session(s) created.', 'success')
-        return redirect(url_for('view_schedule'))
+                order['capacity'] = students_per_session
+            if request.form.get('same_machine_for_test'):
+                machine_names = machine_names[:1]
+
+        # Bookings that stay in place block their machines and students
+        machine_free = booked_until(Schedule.machine_name, machine_names, calendar, site_id, replacing)
+        student_free = students_booked_until(orders, calendar, site_id, replacing)
+        # Gap filling places around the bookings themselves
+        bookings = existing_bookings(site_id, calendar, machine_names, orders, replacing) \
+            if placement in ('first', 'best') else None
+
+        # What-if mode: plan each parameter set in memory and compare, saving nothing
+        if request.form.get('dry_run'):
+            variants = what_if_variants(request.form, priority_rule, slot_duration, optimize, time_budget)
+            if len(variants) > MAX_SCENARIOS:
+                flash(f'Only the first {MAX_SCENARIOS} of {len(variants)} combinations were simulated.', 'warning')
+            base = {
+                'orders': orders,
+                'machine_names': machine_names,
+                'calendar': calendar,
+                'allowance': allowance_time,
+                'session_size': session_size,
+                'machine_free': machine_free,
+                'student_free': student_free,
+                'machine_levels': {m.machine_name: normalize_level(m.level) for m in machines},
+                'placement': placement,
+                'bookings': bookings,
+            }
+            results = simulate_many(base, variants)
+            best = min(range(len(results)), key=lambda i: (
+                len(results[i]['unscheduled']), results[i]['stats']['makespan_minutes'],
+                -results[i]['stats']['utilization']))
+            return render_template('schedule/simulation.html',
+                                 results=results,
+                                 best=best,
+                                 preview_rows=SIMULATION_PREVIEW_ROWS,
+                                 student_count=len(orders),
+                                 machine_count=len(machine_names),
+                                 calendar=calendar)
+
+        # Optimized mode matches machine levels and improves the greedy plan
+        machine_levels = {m.machine_name: normalize_level(m.level) for m in machines} if optimize else None
+        plan_args = (orders, machine_names, calendar, allowance_time, session_size,
+                     machine_free, student_free, machine_levels)
+        if bookings is not None and not optimize:
+            # Fill the free gaps between the bookings that stay
+            rows, unscheduled = plan_gap_fill(orders, machine_names, calendar, bookings, allowance_time,
+                                              session_size, fit=placement)
+        else:
+            rows, unscheduled = plan_parallel(*plan_args)
+        stats = schedule_stats(rows, calendar, machine_names, allowance_time)
+
+        comparison = None
+        if optimize:
+            greedy = {'stats': stats, 'unscheduled': len(unscheduled)}
+            rows, unscheduled, moves = optimize_parallel(orders, rows, *plan_args[1:], time_budget=time_budget)
+            stats = schedule_stats(rows, calendar, machine_names, allowance_time)
+            comparison = {
+                'greedy': greedy,
+                'optimized': {'stats': stats, 'unscheduled': len(unscheduled)},
+                'moves': moves,
+                'time_budget': time_budget,
+            }
+
+        # Readers keep the previous schedule until the staged run is published
+        run = stage_run(site_id, 'advanced', calendar, rows, current_user.id)
+        replaced_count = publish_run(run, replacing)
+
+        return render_template('schedule/generation_result.html',
+                             stats=stats,
+                             run=run,
+                             scheduled_count=len(rows),
+                             replaced_count=replaced_count,
+                             unscheduled=unscheduled,
+                             priority_rule=priority_rule,
+                             comparison=comparison)
         
     except Exception as e:
         db.session.rollback()
@@ -2983,34 +2751,39 @@ def manual_add_schedule():
             flash("Please select at least one student or group.", "danger")
             return redirect(url_for('index'))
 
+        site_id = get_active_site_id()
         all_students = list(selected_students)
         for group_name in selected_groups:
-            group_students = Student.query.filter(Student.group.has(name=group_name)).all()
+            group_students = Student.query.filter(Student.group.has(name=group_name), Student.site_id == site_id).all()
             all_students.extend([s.student_name for s in group_students])
         all_students = list(set(all_students))
 
         conflict_log = []
         added_count = 0
 
+        # Load the window once; slots added below are checked against each other too
+        index = ConflictIndex.load(start_dt, end_dt, students=all_students, machines=selected_machines,
+                                   site_id=site_id)
+        student_ids = name_ids(Student.student_name, all_students, site_id)
+        machine_ids = name_ids(Machine.machine_name, selected_machines, site_id)
+
         for machine in selected_machines:
             for student_name in all_students:
-                conflict = Schedule.query.filter(
-                    Schedule.student_name == student_name,
-                    Schedule.machine_name == machine,
-                    Schedule.start_time < end_dt,
-                    Schedule.end_time > start_dt
-                ).first()
-
-                if conflict:
-                    conflict_log.append(f"{student_name} → {machine} @ {start_time}-{end_time}")
+                problems = index.conflicts(student_name, machine, start_dt, end_dt)
+                if problems:
+                    conflict_log.append(f"{student_name} → {machine} @ {start_time}-{end_time}: {problems[0]}")
                     continue
 
                 db.session.add(Schedule(
+                    site_id=site_id,
                     student_name=student_name,
+                    student_id=student_ids.get(student_name),
                     machine_name=machine,
+                    machine_id=machine_ids.get(machine),
                     start_time=start_dt,
                     end_time=end_dt
                 ))
+                index.add(student_name, machine, start_dt, end_dt)
                 added_count += 1
 
         db.session.commit()
@@ -3116,31 +2889,53 @@ def groups_delete(group_id):
 ##############################################
 # VIEW SCHEDULE & INVENTORY
 ##############################################
+def latest_progress(student_ids):
+    """Each student's latest mini-task progress (highest id) in one query.
+
+    ``student_ids`` is a list of ids or a select of them. Returns
+    {student_id: row} with ``mini_task_id`` and ``mini_task_title``.
+    """
+    ranked = db.session.query(
+        StudentMiniTaskProgress.student_id,
+        StudentMiniTaskProgress.mini_task_id,
+        db.func.row_number().over(
+            partition_by=StudentMiniTaskProgress.student_id,
+            order_by=StudentMiniTaskProgress.id.desc()
+        ).label("rank")
+    ).filter(StudentMiniTaskProgress.student_id.in_(student_ids)).subquery()
+
+    rows = db.session.query(
+        ranked.c.student_id, ranked.c.mini_task_id, MiniTask.title.label("mini_task_title")
+    ).outerjoin(MiniTask, MiniTask.id == ranked.c.mini_task_id).filter(ranked.c.rank == 1)
+    return {row.student_id: row for row in rows}
+
 @app.route("/view_schedule")
 @require_site_access
 def view_schedule():
     site_id = get_active_site_id()
-    schedules = Schedule.query.filter_by(site_id=site_id).all()
-    students = {s.student_name: s for s in Student.query.filter_by(site_id=site_id).all()}
+    schedules = Schedule.query.options(
+        selectinload(Schedule.participants).joinedload(ScheduleParticipant.student)
+    ).filter_by(site_id=site_id).all()
+    students = {s.id: s for s in Student.query.options(joinedload(Student.group)).filter_by(site_id=site_id)}
     inventory = Inventory.query.filter_by(site_id=site_id).all()
-    mini_tasks = {m.id: m for m in MiniTask.query.all()}
-    progress_by_student = {
-        p.student_id: p for p in StudentMiniTaskProgress.query.order_by(StudentMiniTaskProgress.id.desc()).all()
-    }
+    progress_by_student = latest_progress(db.select(Student.id).where(Student.site_id == site_id))
+
+    # One line per student; a shared session appears once for each of them
+    booked = [(slot, student) for slot in schedules
+              for student in [students.get(slot.student_id)] + [p.student for p in slot.participants]]
 
     schedule_data = []
-    for slot in schedules:
-        student = students.get(slot.student_name)
+    for slot, student in booked:
         if not student:
             continue
         progress = progress_by_student.get(student.id)
         mini_task_id = progress.mini_task_id if progress else None
-        mini_task_title = mini_tasks[mini_task_id].title if mini_task_id in mini_tasks else None
+        mini_task_title = progress.mini_task_title if progress else None
 
         schedule_data.append({
             "id": slot.id,
             "Machine": slot.machine_name,
-            "Student": slot.student_name,
+            "Student": student.student_name,
             "Group": student.group.name if student.group else None,
             "Start Time": slot.start_time.strftime("%Y-%m-%d %H:%M"),
             "End Time": slot.end_time.strftime("%Y-%m-%d %H:%M"),
@@ -3169,6 +2964,8 @@ def assign_inventory_modal():
     usage = InventoryUsage(
         consumable=item.item_name,
         student_name=student.student_name,
+        student_id=student.id,
+        inventory_id=item.id,
         quantity=quantity,
         unit_cost=item.cost_per_unit,
         student_task_id=task.id
@@ -3185,63 +2982,118 @@ def assign_inventory_modal():
 @app.route("/schedule/calendar")
 @require_site_access
 def schedule_calendar():
+    """Calendar page; events are fetched per visible range from schedule_events"""
     site_id = get_active_site_id()
-    schedules = Schedule.query.filter_by(site_id=site_id).all()
     machines = Machine.query.filter_by(site_id=site_id).all()
     groups = Group.query.filter_by(site_id=site_id).all()
-    students = {s.student_name: s for s in Student.query.filter_by(site_id=site_id).all()}
-    mini_tasks = {m.id: m for m in MiniTask.query.all()}
-    progress_map = {
-        p.student_id: p for p in StudentMiniTaskProgress.query.order_by(StudentMiniTaskProgress.id.desc()).all()
-    }
+    inventory = Inventory.query.filter_by(site_id=site_id).all()
+    return render_template("calender.html", machines=machines, groups=groups, inventory=inventory)
+
+# Slots are booked within a working day; a slot that started up to this long
+# before the visible range can still overlap it
+EVENT_LOOKBACK = timedelta(days=1)
+
+def _calendar_param(name):
+    """FullCalendar range bound (ISO date or datetime, maybe with an offset) as a naive datetime"""
+    # An unencoded "+" in the offset arrives as a space
+    value = request.args.get(name, "").strip().replace(" ", "+").replace("Z", "+00:00")
+    return datetime.fromisoformat(value).replace(tzinfo=None)
+
+@app.route("/api/schedule/events")
+@require_site_access
+def schedule_events():
+    """FullCalendar event feed: the active site's slots overlapping [start, end)"""
+    site_id = get_active_site_id()
+    try:
+        start, end = _calendar_param("start"), _calendar_param("end")
+    except ValueError:
+        return jsonify({"status": "error", "message": "start and end must be ISO dates"}), 400
+    group = request.args.get("group") or None
+    machine = request.args.get("machine") or None
+
+    # Range scan on ix_schedule_site_start, then the exact overlap test
+    query = Schedule.query.filter(
+        Schedule.site_id == site_id,
+        Schedule.start_time >= start - EVENT_LOOKBACK,
+        Schedule.start_time < end,
+        Schedule.end_time > start
+    )
+    if machine:
+        query = query.filter(Schedule.machine_name == machine)
+    slots = query.options(
+        selectinload(Schedule.participants).joinedload(ScheduleParticipant.student).joinedload(Student.group)
+    ).order_by(Schedule.start_time).all()
+
+    # Students, their latest progress and mini-task titles for this window only
+    ids = {slot.student_id for slot in slots} - {None}
+    students = {s.id: s for s in Student.query.options(joinedload(Student.group)).filter(
+        Student.id.in_(ids)
+    )} if ids else {}
+    student_ids = [s.id for s in students.values()] + [p.student_id for slot in slots for p in slot.participants]
+    progress_map = latest_progress(student_ids) if student_ids else {}
 
     events = []
-    for slot in schedules:
-        student = students.get(slot.student_name)
+    for slot in slots:
+        student = students.get(slot.student_id)
         if not student:
             continue
+        # A shared session is one event listing all its students
+        booked = [student] + [p.student for p in slot.participants]
+        groups = list(dict.fromkeys(s.group.name if s.group else "N/A" for s in booked))
+        if group and group not in groups:
+            continue
         progress = progress_map.get(student.id)
         mini_task_id = progress.mini_task_id if progress else None
-        mini_task_title = mini_tasks[mini_task_id].title if mini_task_id else "—"
+        mini_task_title = progress.mini_task_title if progress else None
 
         events.append({
             "id": slot.id,
-            "title": student.student_name,
+            "title": ", ".join(s.student_name for s in booked),
             "start": slot.start_time.isoformat(),
             "end": slot.end_time.isoformat(),
             "extendedProps": {
                 "student_id": student.id,
+                "student_name": student.student_name,
+                "students": [s.student_name for s in booked],
+                "capacity": slot.capacity or 1,
                 "mini_task_id": mini_task_id,
-                "mini_task_title": mini_task_title,
-                "group": student.group.name if student.group else "N/A",
+                "mini_task_title": mini_task_title or "—",
+                "group": ", ".join(groups),
                 "machine": slot.machine_name,
                 "timeslot": f"{slot.start_time.strftime('%H:%M')} - {slot.end_time.strftime('%H:%M')}"
             }
         })
-
-    inventory = Inventory.query.filter_by(site_id=site_id).all()
-    return render_template("calender.html", schedule_events=events, machines=machines, groups=groups, inventory=inventory)
+    return jsonify(events)
+
+def slot_conflicts(slot, student_name, machine_name, start_time, end_time):
+    """Reasons a slot cannot move, checked for every student of a shared
+    session; the slot itself is left out"""
+    names = [student_name] + [p.student.student_name for p in slot.participants]
+    index = ConflictIndex.load(start_time, end_time, names, [machine_name], exclude_ids=[slot.id],
+                               site_id=slot.site_id)
+    problems = [problem for name in names
+                for problem in index.conflicts(name, machine_name, start_time, end_time, slot.capacity)]
+    return list(dict.fromkeys(problems))
 
 @app.route("/update_schedule/<int:schedule_id>", methods=["POST"])
 def update_schedule(schedule_id):
     try:
         sched = Schedule.query.get_or_404(schedule_id)
-        sched.student_name = request.form.get("student_name", sched.student_name)
-        sched.machine_name = request.form.get("machine_name", sched.machine_name)
-        sched.start_time = datetime.strptime(request.form.get("start_time"), "%Y-%m-%dT%H:%M")
-        sched.end_time = datetime.strptime(request.form.get("end_time"), "%Y-%m-%dT%H:%M")
-
-        conflict = Schedule.query.filter(
-            Schedule.id != schedule_id,
-            Schedule.student_name == sched.student_name,
-            Schedule.machine_name == sched.machine_name,
-            Schedule.start_time < sched.end_time,
-            Schedule.end_time > sched.start_time
-        ).first()
-
-        if conflict:
-            return jsonify({"status": "error", "message": "Conflict with another slot."}), 409
-
+        student_name = request.form.get("student_name", sched.student_name)
+        machine_name = request.form.get("machine_name", sched.machine_name)
+        start_time = datetime.strptime(request.form.get("start_time"), "%Y-%m-%dT%H:%M")
+        end_time = datetime.strptime(request.form.get("end_time"), "%Y-%m-%dT%H:%M")
+
+        problems = slot_conflicts(sched, student_name, machine_name, start_time, end_time)
+        if problems:
+            return jsonify({"status": "error", "message": f"Conflict with another slot: {'; '.join(problems)}"}), 409
+
+        sched.student_name = student_name
+        sched.machine_name = machine_name
+        sched.student_id = name_ids(Student.student_name, [student_name], sched.site_id).get(student_name)
+        sched.machine_id = name_ids(Machine.machine_name, [machine_name], sched.site_id).get(machine_name)
+        sched.start_time = start_time
+        sched.end_time = end_time
         db.session.commit()
         return jsonify({"status": "success"})
     except Exception as e:
@@ -3249,14 +3101,19 @@ def update_schedule(schedule_id):
 
 @app.route("/assign_inventory_from_calendar", methods=["POST"])
 def assign_inventory_from_calendar():
-    student_name = request.form["student_name"]
+    student_name = request.form.get("student_name")
+    student_id = request.form.get("student_id")
     mini_task_id = request.form["mini_task_id"]
     inventory_id = request.form["inventory_id"]
     quantity = int(request.form["quantity"])
 
-    student = Student.query.filter_by(student_name=student_name).first()
+    # Prefer the event's student id; names are not unique across groups
+    if student_id:
+        student = Student.query.get(student_id)
+    else:
+        student = Student.query.filter_by(student_name=student_name).first()
     item = Inventory.query.get(inventory_id)
-    task = StudentMiniTaskProgress.query.filter_by(student_id=student.id, mini_task_id=mini_task_id).first()
+    task = StudentMiniTaskProgress.query.filter_by(student_id=student.id, mini_task_id=mini_task_id).first() if student else None
 
     if not all([student, item, task]):
         return jsonify({"status": "error", "message": "Missing student/task/item"}), 400
@@ -3264,6 +3121,8 @@ def assign_inventory_from_calendar():
     usage = InventoryUsage(
         consumable=item.item_name,
         student_name=student.student_name,
+        student_id=student.id,
+        inventory_id=item.id,
         quantity=quantity,
         unit_cost=item.cost_per_unit,
         student_task_id=task.id
@@ -3293,7 +3152,9 @@ def schedule_day_view(date):
     start_of_day = datetime.combine(date_obj, datetime.min.time())
     end_of_day = datetime.combine(date_obj, datetime.max.time())
     
-    schedules = Schedule.query.filter(
+    schedules = Schedule.query.options(
+        selectinload(Schedule.participants).joinedload(ScheduleParticipant.student)
+    ).filter(
         Schedule.site_id == site_id,
         Schedule.start_time >= start_of_day,
         Schedule.start_time <= end_of_day
@@ -3340,24 +3201,26 @@ def add_schedule_slot():
         end_time = datetime.strptime(end_time_str, "%Y-%m-%dT%H:%M")
         
         # Get student's group
-        student = Student.query.filter_by(student_name=student_name).first()
+        site_id = get_active_site_id()
+        student_id = name_ids(Student.student_name, [student_name], site_id).get(student_name)
+        student = db.session.get(Student, student_id) if student_id else None
         group_name = student.group.name if student and student.group else ""
         
         # Check for conflicts
-        conflict = Schedule.query.filter(
-            Schedule.student_name == student_name,
-            Schedule.machine_name == machine_name,
-            Schedule.start_time < end_time,
-            Schedule.end_time > start_time
-        ).first()
+        problems = ConflictIndex.load(start_time, end_time, [student_name], [machine_name],
+                                      site_id=site_id).conflicts(
+            student_name, machine_name, start_time, end_time)
         
-        if conflict:
-            return jsonify({"status": "error", "message": "Time slot conflict detected"}), 409
+        if problems:
+            return jsonify({"status": "error", "message": f"Time slot conflict detected: {'; '.join(problems)}"}), 409
         
         new_slot = Schedule(
+            site_id=site_id,
             student_name=student_name,
+            student_id=student_id,
             group_name=group_name,
             machine_name=machine_name,
+            machine_id=name_ids(Machine.machine_name, [machine_name], site_id).get(machine_name),
             start_time=start_time,
             end_time=end_time
         )
@@ -3377,33 +3240,32 @@ def edit_schedule_slot(slot_id):
     
     if request.method == "POST":
         try:
-            slot.student_name = request.form.get("student_name", slot.student_name)
-            slot.machine_name = request.form.get("machine_name", slot.machine_name)
+            student_name = request.form.get("student_name", slot.student_name)
+            machine_name = request.form.get("machine_name", slot.machine_name)
             
             start_time_str = request.form.get("start_time")
             end_time_str = request.form.get("end_time")
             
-            if start_time_str:
-                slot.start_time = datetime.strptime(start_time_str, "%Y-%m-%dT%H:%M")
-            if end_time_str:
-                slot.end_time = datetime.strptime(end_time_str, "%Y-%m-%dT%H:%M")
-            
-            # Update group name
-            student = Student.query.filter_by(student_name=slot.student_name).first()
-            if student and student.group:
-                slot.group_name = student.group.name
+            start_time = datetime.strptime(start_time_str, "%Y-%m-%dT%H:%M") if start_time_str else slot.start_time
+            end_time = datetime.strptime(end_time_str, "%Y-%m-%dT%H:%M") if end_time_str else slot.end_time
             
             # Check for conflicts
-            conflict = Schedule.query.filter(
-                Schedule.id != slot_id,
-                Schedule.student_name == slot.student_name,
-                Schedule.machine_name == slot.machine_name,
-                Schedule.start_time < slot.end_time,
-                Schedule.end_time > slot.start_time
-            ).first()
+            problems = slot_conflicts(slot, student_name, machine_name, start_time, end_time)
             
-            if conflict:
-                return jsonify({"status": "error", "message": "Time slot conflict detected"}), 409
+            if problems:
+                return jsonify({"status": "error", "message": f"Time slot conflict detected: {'; '.join(problems)}"}), 409
+            
+            slot.student_name = student_name
+            slot.machine_name = machine_name
+            slot.start_time = start_time
+            slot.end_time = end_time
+            
+            # Update group name and links
+            slot.student_id = name_ids(Student.student_name, [student_name], slot.site_id).get(student_name)
+            student = db.session.get(Student, slot.student_id) if slot.student_id else None
+            if student and student.group:
+                slot.group_name = student.group.name
+            slot.machine_id = name_ids(Machine.machine_name, [machine_name], slot.site_id).get(machine_name)
             
             db.session.commit()
             return jsonify({"status": "success", "message": "Slot updated successfully"})
@@ -3434,6 +3296,143 @@ def delete_schedule_slot(slot_id):
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
+##############################################
+# SCHEDULE AUDIT
+##############################################
+@app.route("/schedule/audit")
+@require_site_access
+def schedule_audit():
+    """Check the active site's whole schedule for double bookings and calendar breaches"""
+    site_id = get_active_site_id()
+    try:
+        lunch_start = datetime.strptime(request.args.get("lunch_start", "12:00"), "%H:%M").time()
+        lunch_duration = int(request.args.get("lunch_duration", 60))
+        allowed_days = [int(day) for day in request.args.getlist("days")] or [0, 1, 2, 3, 4]
+    except ValueError:
+        flash("Invalid lunch time, duration or weekday.", "danger")
+        return redirect(url_for("schedule_audit"))
+
+    report = audit_schedule(site_id, lunch_start, lunch_duration, allowed_days)
+    return render_template("schedule/audit.html",
+                         report=report,
+                         kinds=AUDIT_KINDS,
+                         weekdays=WEEKDAYS,
+                         lunch_start=lunch_start.strftime("%H:%M"),
+                         lunch_duration=lunch_duration,
+                         allowed_days=allowed_days)
+
+##############################################
+# OUTAGE REPAIR
+##############################################
+@app.route("/schedule/repair", methods=["GET", "POST"])
+@require_site_access
+def schedule_repair():
+    """Move only the slots a machine outage hits into the nearest free time.
+
+    GET may prefill the form from a maintenance log or macro plan row:
+    ``machine``, ``start`` and either ``end`` or ``hours``.
+    """
+    site_id = get_active_site_id()
+    machines = Machine.query.filter_by(site_id=site_id).order_by(Machine.machine_name).all()
+    form = request.form if request.method == "POST" else request.args
+    values = {
+        "machine": form.get("machine", ""),
+        "start": form.get("start", ""),
+        "end": form.get("end", ""),
+        "start_time": form.get("start_time", "08:00"),
+        "end_time": form.get("end_time", "16:00"),
+        "lunch_start": form.get("lunch_start", "12:00"),
+        "lunch_duration": form.get("lunch_duration", "60"),
+    }
+    allowed_days = [0, 1, 2, 3, 4]
+    try:
+        allowed_days = [int(day) for day in form.getlist("days")] or allowed_days
+        if values["start"] and not values["end"] and form.get("hours"):
+            outage_start = datetime.strptime(values["start"], "%Y-%m-%dT%H:%M")
+            values["end"] = (outage_start + timedelta(hours=float(form["hours"]))).strftime("%Y-%m-%dT%H:%M")
+        valid = True
+    except ValueError:
+        flash("Invalid outage start, duration or weekday.", "danger")
+        valid = False
+
+    result = None
+    if request.method == "POST" and valid:
+        try:
+            outage_start = datetime.strptime(values["start"], "%Y-%m-%dT%H:%M")
+            outage_end = datetime.strptime(values["end"], "%Y-%m-%dT%H:%M")
+            if outage_end <= outage_start:
+                raise ValueError("The outage must end after it starts.")
+            broken = next((m for m in machines if m.machine_name == values["machine"]), None)
+            if broken is None:
+                raise ValueError("Choose a machine of this site.")
+
+            # Machines of the same level can take over; the broken one is free again after the outage
+            level = normalize_level(broken.level)
+            compatible = [m.machine_name for m in machines if level is None or normalize_level(m.level) == level]
+            calendar = WorkCalendar(outage_start.date(), outage_end.date() + timedelta(days=REPAIR_HORIZON_DAYS),
+                                    datetime.strptime(values["start_time"], "%H:%M").time(),
+                                    datetime.strptime(values["end_time"], "%H:%M").time(),
+                                    datetime.strptime(values["lunch_start"], "%H:%M").time(),
+                                    int(values["lunch_duration"]), allowed_days)
+
+            moved, stranded = repair_outage(site_id, broken.machine_name, outage_start, outage_end,
+                                            calendar, compatible)
+            preview = bool(request.form.get("preview"))
+            if preview:
+                db.session.rollback()
+            else:
+                db.session.commit()
+            result = {"moved": moved, "stranded": stranded, "preview": preview, "compatible": compatible}
+            if not moved and not stranded:
+                flash("No slots on that machine overlap the outage.", "info")
+            elif not preview:
+                flash(f"{len(moved)} session(s) moved, {len(stranded)} could not be placed.",
+                      "warning" if stranded else "success")
+        except ValueError as e:
+            db.session.rollback()
+            flash(str(e), "danger")
+        except Exception as e:
+            db.session.rollback()
+            flash(f"Error repairing schedule: {e}", "danger")
+
+    return render_template("schedule/repair.html",
+                         machines=machines,
+                         values=values,
+                         allowed_days=allowed_days,
+                         weekdays=WEEKDAYS,
+                         horizon_days=REPAIR_HORIZON_DAYS,
+                         result=result)
+
+##############################################
+# SCHEDULE RUNS
+##############################################
+@app.route("/schedule/runs")
+@require_site_access
+def schedule_runs():
+    """Recent generation runs for the active site, latest first"""
+    site_id = get_active_site_id()
+    runs = ScheduleRun.query.filter_by(site_id=site_id).order_by(ScheduleRun.id.desc()).limit(20).all()
+    latest_published = next((run.id for run in runs if run.status == 'published'), None)
+    return render_template("schedule/runs.html",
+                         runs=runs,
+                         latest_published=latest_published,
+                         runs_kept=SCHEDULE_RUNS_KEPT)
+
+@app.route("/schedule/runs/<int:run_id>/rollback", methods=["POST"])
+@require_site_access
+def rollback_schedule_run(run_id):
+    """Undo the site's latest published run"""
+    run = ScheduleRun.query.filter_by(id=run_id, site_id=get_active_site_id()).first_or_404()
+    try:
+        removed, restored = rollback_run(run)
+        flash(f"Run {run.id} rolled back: {removed} slot(s) removed, {restored} restored.", "success")
+    except ValueError as e:
+        flash(str(e), "warning")
+    except Exception as e:
+        db.session.rollback()
+        flash(f"Error rolling back run: {e}", "danger")
+    return redirect(url_for("schedule_runs"))
+
 ##############################################
 # VERIFICATION PAGE
 ##############################################
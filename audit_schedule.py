@@ -0,0 +1,52 @@
+"""
+Schedule Audit
+==============
+Checks stored schedule rows for students in overlapping slots, machines used
+beyond capacity, slots over lunch and slots on disallowed weekdays. Same
+checks as the Schedule -> Audit page.
+
+Usage:
+    python audit_schedule.py                          # every site
+    python audit_schedule.py --site 2                 # one site
+    python audit_schedule.py --lunch 12:30 --lunch-minutes 45 --days 0,1,2,3,4,5
+"""
+
+import sys
+import time
+from datetime import datetime
+from app import app
+from conflicts import audit_schedule, AUDIT_KINDS
+
+SHOWN = 20
+
+def _option(args, name, default):
+    return args[args.index(name) + 1] if name in args else default
+
+def main(args):
+    site_id = _option(args, '--site', None)
+    site_id = int(site_id) if site_id is not None else None
+    lunch_start = datetime.strptime(_option(args, '--lunch', '12:00'), '%H:%M').time()
+    lunch_minutes = int(_option(args, '--lunch-minutes', 60))
+    allowed_days = [int(day) for day in _option(args, '--days', '0,1,2,3,4').split(',')]
+
+    with app.app_context():
+        scope = f"site {site_id}" if site_id is not None else "all sites"
+        print(f"Auditing schedule for {scope}...")
+        started = time.perf_counter()
+        report = audit_schedule(site_id, lunch_start, lunch_minutes, allowed_days, limit=SHOWN)
+        elapsed = time.perf_counter() - started
+
+        for kind, label in AUDIT_KINDS.items():
+            count = report['counts'][kind]
+            print(f"\n{'✗' if count else '✓'} {label}: {count}")
+            for finding in report['findings'][kind]:
+                print("    " + ", ".join(f"{key}={value}" for key, value in finding.items()))
+            if count > SHOWN:
+                print(f"    ...and {count - SHOWN} more")
+
+        problems = sum(report['counts'].values())
+        print(f"\nChecked {report['rows']} slots in {elapsed:.2f}s, {problems} problem(s) found")
+        return 1 if problems else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -144,12 +144,19 @@ class DynamicField(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 # Dynamic Field Values for storing actual data
+# One value per (field, record); write through dynamic_values.upsert_dynamic_values
 class DynamicFieldValue(db.Model):
     __tablename__ = 'dynamic_field_values'
     id = db.Column(db.Integer, primary_key=True)
-    field_id = db.Column(db.Integer, db.ForeignKey('dynamic_fields.id'))
-    record_id = db.Column(db.Integer)  # ID of the record in the target model
+    field_id = db.Column(db.Integer, db.ForeignKey('dynamic_fields.id'), nullable=False)
+    model_name = db.Column(db.String(50))  # Copied from the field, e.g. 'Student'
+    record_id = db.Column(db.Integer, nullable=False)  # ID of the record in the target model
     value = db.Column(db.Text)
     
     # Relationship
     field = db.relationship('DynamicField', backref='values')
+
+    __table_args__ = (
+        db.UniqueConstraint('field_id', 'record_id', name='uq_dynamic_field_values_field_record'),
+        db.Index('ix_dynamic_field_values_model_record', 'model_name', 'record_id'),
+    )
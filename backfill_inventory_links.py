@@ -0,0 +1,39 @@
+"""
+Inventory Usage Link Backfill
+=============================
+Resolves InventoryUsage.student_name / consumable text on historical rows
+into the student_id / inventory_id foreign keys, in batches. Names like
+"AGT21006 Maila Frans" are matched on student number and name.
+
+The migration that adds the columns already runs the same resolvers over
+every row; re-run this after adding students or items (or their student
+numbers) that older rows name.
+
+Safe to re-run: only rows that are still unresolved are touched.
+
+Usage:
+    python backfill_inventory_links.py
+"""
+
+from app import app
+from resolvers import backfill_inventory_usage
+
+def main():
+    with app.app_context():
+        print("Resolving inventory usage rows to students and inventory items...")
+
+        def progress(stats):
+            print(f"  ...{stats['rows']} rows processed")
+
+        stats = backfill_inventory_usage(progress=progress)
+
+        print(f"\n✓ Backfill complete ({stats['rows']} rows examined)")
+        print(f"  - Students resolved:   {stats['students_resolved']}")
+        print(f"  - Students unresolved: {stats['students_unresolved']}")
+        print(f"  - Items resolved:      {stats['items_resolved']}")
+        print(f"  - Items unresolved:    {stats['items_unresolved']}")
+        if stats['students_unresolved']:
+            print("\nUnresolved rows keep their text name and are excluded from per-student totals.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""
+Schedule Link Backfill
+======================
+Resolves the free-text student and machine names on historical Schedule,
+MacroPlan and MachineMaintenance rows into the student_id / machine_id
+foreign keys, in batches, then rebuilds the schedule rollups. Names like
+"AGT21006 Maila Frans" are matched on student number and name.
+
+The migration that adds the columns already runs the same resolvers over
+every row; re-run this after adding students or machines (or their student
+numbers) that older rows name.
+
+Safe to re-run: only rows that are still unresolved are touched.
+
+Usage:
+    python backfill_schedule_links.py
+"""
+
+from app import app
+from resolvers import backfill_schedule_links
+
+def main():
+    with app.app_context():
+        print("Resolving schedule, macro plan and maintenance rows to students and machines...")
+
+        def progress(stats):
+            print(f"  ...{stats['rows']} rows processed")
+
+        results = backfill_schedule_links(progress=progress)
+
+        print("\n✓ Backfill complete")
+        unresolved = False
+        for table, stats in results.items():
+            print(f"  {table} ({stats['rows']} rows examined)")
+            for label in ('students', 'machines'):
+                if f'{label}_resolved' in stats:
+                    print(f"    - {label.capitalize()} resolved:   {stats[f'{label}_resolved']}")
+                    print(f"    - {label.capitalize()} unresolved: {stats[f'{label}_unresolved']}")
+                    unresolved = unresolved or stats[f'{label}_unresolved'] > 0
+        if unresolved:
+            print("\nUnresolved rows keep their text names and are excluded from per-student and per-machine summaries.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Schedule Generation Benchmark
+=============================
+Times the old /generate_schedule loop (a COUNT and a commit per slot,
+``list.pop(0)``) against the in-memory batch generator in scheduler.py.
+Runs against a throwaway SQLite database, never the configured one.
+
+Usage:
+    python benchmark_schedule.py              # 1,000 and 10,000 students
+    python benchmark_schedule.py 500 5000     # other sizes
+"""
+
+import os
+import sys
+import tempfile
+import time
+from datetime import date, datetime, time as dtime, timedelta
+
+# Point the app at a scratch database before it is imported
+_scratch = tempfile.mkdtemp(prefix='schedule-benchmark-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_scratch, 'benchmark.db')
+
+from app import app
+from models import db, Site, Student, Group, Machine, Schedule
+from rollups import rebuild_rollups, SCHEDULE_ROLLUPS
+from scheduler import WorkCalendar, plan_round_robin, schedule_scope, stage_run, publish_run
+
+MACHINES = 12
+SLOT_MINUTES = 30
+START_DATE = date(2025, 1, 6)
+END_DATE = date(2028, 12, 29)
+DAY_START, DAY_END = dtime(8, 0), dtime(17, 0)
+LUNCH_START, LUNCH_MINUTES = dtime(12, 0), 60
+
+
+def seed(students):
+    Schedule.query.delete()
+    Student.query.delete()
+    Machine.query.delete()
+    Group.query.delete()
+    site = Site.query.filter_by(name='Benchmark').first() or Site(name='Benchmark', code='BENCH')
+    db.session.add(site)
+    db.session.flush()
+    group = Group(name='Benchmark', site_id=site.id)
+    db.session.add(group)
+    db.session.flush()
+    db.session.add_all(Machine(machine_name=f'M{i:02d}', level='1', site_id=site.id) for i in range(MACHINES))
+    db.session.add_all(Student(student_name=f'Student {i:05d}', group_id=group.id, site_id=site.id)
+                       for i in range(students))
+    db.session.commit()
+    return site.id
+
+def legacy():
+    """The previous generator, kept verbatim apart from the form parsing"""
+    lunch_start_dt = datetime.combine(START_DATE, LUNCH_START)
+    lunch_end_dt = lunch_start_dt + timedelta(minutes=LUNCH_MINUTES)
+    current_dt = datetime.combine(START_DATE, DAY_START)
+    final_dt = datetime.combine(END_DATE, DAY_END)
+
+    orders = [{"Student": s.student_name, "Group": s.group.name if s.group else "",
+               "processing_time": SLOT_MINUTES, "extra_time": 0} for s in Student.query.all()]
+    Schedule.query.delete()
+    db.session.commit()
+    rebuild_rollups(models=SCHEDULE_ROLLUPS)
+    machines = Machine.query.all()
+
+    while orders and current_dt < final_dt:
+        order = orders.pop(0)
+        working_day_end = datetime.combine(current_dt.date(), DAY_END)
+        if current_dt >= working_day_end:
+            current_dt = datetime.combine(current_dt.date() + timedelta(days=1), DAY_START)
+            continue
+        slot_end_dt = current_dt + timedelta(minutes=order["processing_time"])
+        if lunch_start_dt <= current_dt < lunch_end_dt or current_dt < lunch_start_dt < slot_end_dt:
+            current_dt = lunch_end_dt
+            slot_end_dt = current_dt + timedelta(minutes=order["processing_time"])
+        if slot_end_dt > working_day_end:
+            current_dt = datetime.combine(current_dt.date() + timedelta(days=1), DAY_START)
+            continue
+        machine_index = Schedule.query.count() % len(machines) if machines else 0
+        db.session.add(Schedule(student_name=order["Student"], group_name=order["Group"],
+                                machine_name=machines[machine_index].machine_name,
+                                start_time=current_dt, end_time=slot_end_dt,
+                                extra_time=order["extra_time"]))
+        db.session.commit()
+        current_dt = slot_end_dt
+
+def batch(site_id):
+    """The current generator: plan in memory, stage the run, publish it in one swap"""
+    calendar = WorkCalendar(START_DATE, END_DATE, DAY_START, DAY_END, LUNCH_START, LUNCH_MINUTES)
+    students = db.session.query(Student.id, Student.student_name, Group.name).outerjoin(
+        Group, Student.group_id == Group.id
+    ).filter(Student.site_id == site_id).order_by(Student.id).all()
+    orders = [{"student_id": student_id, "student_name": name, "group_name": group or "", "site_id": site_id,
+               "processing_time": SLOT_MINUTES, "extra_time": 0} for student_id, name, group in students]
+    machine_names = [name for (name,) in db.session.query(Machine.machine_name).filter(
+        Machine.site_id == site_id).order_by(Machine.id)]
+    rows, _ = plan_round_robin(orders, machine_names, calendar)
+
+    run = stage_run(site_id, 'basic', calendar, rows)
+    publish_run(run, schedule_scope(site_id, calendar))
+
+def timed(generate, *args):
+    started = time.perf_counter()
+    generate(*args)
+    elapsed = time.perf_counter() - started
+    return elapsed, Schedule.query.count()
+
+def main(args):
+    sizes = [int(a) for a in args] or [1000, 10000]
+    with app.app_context():
+        db.create_all()
+        print(f"{'students':>9}  {'legacy':>10}  {'rows':>6}  {'batch':>10}  {'rows':>6}  {'speedup':>8}")
+        for size in sizes:
+            site_id = seed(size)
+            legacy_time, legacy_rows = timed(legacy)
+            # Legacy rows carry no site, so they fall outside the batch scope
+            Schedule.query.delete()
+            rebuild_rollups(models=SCHEDULE_ROLLUPS)
+            batch_time, batch_rows = timed(batch, site_id)
+            print(f"{size:>9}  {legacy_time:>9.2f}s  {legacy_rows:>6}  {batch_time:>9.2f}s  {batch_rows:>6}  "
+                  f"{legacy_time / batch_time:>7.0f}x")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
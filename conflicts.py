@@ -0,0 +1,274 @@
+"""
+Schedule conflict checks
+========================
+Loads the bookings in a time window once and answers every conflict check
+for a batch of new or moved slots from memory.
+
+Bookings are indexed twice, per student and per machine, each as intervals
+sorted by start time with a running maximum of end times, so an overlap
+query is a bisection plus a walk over the intervals that actually overlap.
+
+A slot conflicts when its student is already booked anywhere at that time
+(on any machine), or when its machine is already taken. A machine may hold
+several students only for a shared session: the same start and end, within
+the session's ``capacity``.
+
+A shared session is stored as one Schedule row plus its other participants
+(ScheduleParticipant); ``schedule_bookings`` unfolds it again into one
+booking per student, so every check here sees each student in it.
+
+``audit_schedule`` checks a whole stored schedule the same way in a single
+sweep, for the audit page and ``python audit_schedule.py``.
+"""
+import heapq
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+from sqlalchemy import or_, select, union_all
+
+from models import db, Schedule, ScheduleParticipant, Student, Group
+
+Booking = namedtuple('Booking', 'id student_name machine_name start_time end_time capacity')
+
+
+
+def schedule_bookings():
+    """Schedule as one row per booked student: every row for the student it
+    names, plus a copy of a shared session for each other participant,
+    carrying that student's id, name and group. ``id`` is the Schedule row's.
+    """
+    table = Schedule.__table__
+    participant, student, group = ScheduleParticipant.__table__, Student.__table__, Group.__table__
+    renamed = {'student_id': participant.c.student_id, 'student_name': student.c.student_name,
+               'group_name': group.c.name.label('group_name')}
+    others = select(*[renamed.get(column.key, column) for column in table.c]).select_from(
+        participant.join(table, table.c.id == participant.c.schedule_id)
+        .join(student, student.c.id == participant.c.student_id)
+        .outerjoin(group, group.c.id == student.c.group_id)
+    )
+    return union_all(select(table), others).subquery('schedule_bookings')
+
+
+class IntervalIndex:
+    """Intervals per key, sorted by start, queried by bisection"""
+
+    def __init__(self):
+        self._starts = defaultdict(list)
+        self._items = defaultdict(list)
+        # Running maximum of end times per key, rebuilt after inserts
+        self._reach = {}
+
+    def add(self, key, start, end, item):
+        i = bisect_right(self._starts[key], start)
+        self._starts[key].insert(i, start)
+        self._items[key].insert(i, (end, item))
+        self._reach.pop(key, None)
+
+    def overlapping(self, key, start, end):
+        """Items whose interval overlaps [start, end)"""
+        starts = self._starts.get(key)
+        if not starts:
+            return []
+        items = self._items[key]
+        reach = self._reach.get(key)
+        if reach is None:
+            reach = self._reach[key] = list(accumulate((e for e, _ in items), max))
+
+        # Only intervals starting before ``end`` can overlap; walk back from
+        # the last of them until no earlier interval reaches past ``start``
+        found = []
+        i = bisect_left(starts, end) - 1
+        while i >= 0 and reach[i] > start:
+            item_end, item = items[i]
+            if item_end > start:
+                found.append(item)
+            i -= 1
+        return found
+
+
+class ConflictIndex:
+    """Bookings in a window, indexed per student and per machine"""
+
+    def __init__(self, bookings=()):
+        self.students = IntervalIndex()
+        self.machines = IntervalIndex()
+        for booking in bookings:
+            self._index(booking)
+
+    @classmethod
+    def load(cls, start, end, students=(), machines=(), exclude_ids=(), site_id=None):
+        """Index the stored bookings overlapping [start, end) that involve
+        any of ``students`` or ``machines``, leaving out ``exclude_ids``
+        (the slots being edited). ``site_id`` limits them to one site."""
+        students = [s for s in set(students) if s]
+        machines = [m for m in set(machines) if m]
+        if not students and not machines:
+            return cls()
+
+        bookings = schedule_bookings().c
+        query = db.session.query(
+            bookings.id, bookings.student_name, bookings.machine_name,
+            bookings.start_time, bookings.end_time, bookings.capacity
+        ).filter(
+            bookings.start_time < end,
+            bookings.end_time > start,
+            or_(bookings.student_name.in_(students), bookings.machine_name.in_(machines))
+        )
+        if exclude_ids:
+            query = query.filter(bookings.id.notin_(list(exclude_ids)))
+        if site_id is not None:
+            query = query.filter(bookings.site_id == site_id)
+        return cls(Booking(*row) for row in query)
+
+    def _index(self, booking):
+        if booking.student_name:
+            self.students.add(booking.student_name, booking.start_time, booking.end_time, booking)
+        if booking.machine_name:
+            self.machines.add(booking.machine_name, booking.start_time, booking.end_time, booking)
+
+    def add(self, student_name, machine_name, start, end, capacity=1):
+        """Record a slot accepted in this batch so later checks see it"""
+        self._index(Booking(None, student_name, machine_name, start, end, capacity or 1))
+
+    def conflicts(self, student_name, machine_name, start, end, capacity=1):
+        """Human readable reasons the slot cannot be booked; empty when free"""
+        problems = []
+        for b in self.students.overlapping(student_name, start, end):
+            problems.append(f"{student_name} is already booked on {b.machine_name or 'no machine'} "
+                            f"{_span(b.start_time, b.end_time)}")
+
+        if machine_name:
+            taken = self.machines.overlapping(machine_name, start, end)
+            shared = all(b.start_time == start and b.end_time == end for b in taken)
+            if taken and not (shared and len(taken) < min(capacity or 1, *(b.capacity or 1 for b in taken))):
+                others = sorted({b.student_name for b in taken if b.student_name != student_name})
+                if others:
+                    problems.append(f"{machine_name} is already booked by {', '.join(others)} "
+                                    f"{_span(taken[0].start_time, taken[0].end_time)}")
+        return problems
+
+def _span(start, end):
+    if start.date() == end.date():
+        return f"{start.strftime('%Y-%m-%d %H:%M')}-{end.strftime('%H:%M')}"
+    return f"{start.strftime('%Y-%m-%d %H:%M')}-{end.strftime('%Y-%m-%d %H:%M')}"
+
+
+##############################################
+# WHOLE-SCHEDULE AUDIT
+##############################################
+# Findings kept per kind; the counts are always complete
+AUDIT_LIMIT = 500
+AUDIT_BATCH_SIZE = 10000
+
+AUDIT_KINDS = {
+    'student_overlaps': 'Students booked in overlapping slots',
+    'machine_capacity': 'Machines used beyond capacity',
+    'lunch': 'Slots overlapping lunch',
+    'weekday': 'Slots on disallowed weekdays',
+}
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+
+def audit_schedule(site_id=None, lunch_start=None, lunch_minutes=0, allowed_days=None, limit=AUDIT_LIMIT):
+    """Audit stored schedule rows in one sweep over start time.
+
+    Rows stream from the database in (start_time, id) order. A student
+    overlaps when a slot starts before the furthest end of that student's
+    earlier slots; a machine is over capacity when the slots still running
+    on it (a heap of end times) are not all the same session, or outnumber
+    the smallest ``capacity`` among them. Lunch
+    and weekday checks are per slot. Shared sessions are unfolded
+    (``schedule_bookings``), so each of their students is checked. Audits
+    every site when ``site_id`` is None; names are compared within a site.
+
+    Returns ``{'rows', 'counts', 'findings'}`` with findings per AUDIT_KINDS
+    key, the first ``limit`` of each.
+    """
+    counts = dict.fromkeys(AUDIT_KINDS, 0)
+    findings = {kind: [] for kind in AUDIT_KINDS}
+    lunch_length = timedelta(minutes=lunch_minutes or 0)
+    allowed_days = set(allowed_days) if allowed_days else None
+
+    def keep(kind):
+        """Count a finding; True while there is room to list it"""
+        counts[kind] += 1
+        return counts[kind] <= limit
+
+    def lunch_on(day):
+        """Lunch (start, end) for a day, cached: rows arrive day by day"""
+        if day not in lunches:
+            begins = datetime.combine(day, lunch_start)
+            lunches[day] = (begins, begins + lunch_length)
+        return lunches[day]
+
+    bookings = schedule_bookings()
+    statement = select(
+        bookings.c.id, bookings.c.site_id, bookings.c.student_name, bookings.c.machine_name,
+        bookings.c.start_time, bookings.c.end_time, bookings.c.capacity
+    ).where(bookings.c.start_time.isnot(None), bookings.c.end_time.isnot(None))
+    if site_id is not None:
+        statement = statement.where(bookings.c.site_id == site_id)
+    statement = statement.order_by(bookings.c.start_time, bookings.c.id)
+
+    # (site, student) -> the earlier slot reaching furthest
+    student_reach = {}
+    # (site, machine) -> heap of (end, id, start, capacity) for slots still running
+    running = defaultdict(list)
+    lunches = {}
+    check_lunch = lunch_start is not None and bool(lunch_length)
+    total = 0
+    # The students of a shared session arrive one after another
+    last_id = None
+
+    # Plain Core rows: ORM loading would dominate the sweep on large sites
+    connection = db.session.connection().execution_options(yield_per=AUDIT_BATCH_SIZE)
+    for row in connection.execute(statement):
+        slot_id, site, student, machine, start, end, capacity = row
+        first = slot_id != last_id
+        last_id = slot_id
+        total += first
+
+        if student:
+            key = (site, student)
+            previous = student_reach.get(key)
+            if previous is not None and start < previous[5]:
+                if keep('student_overlaps'):
+                    findings['student_overlaps'].append({
+                        'student': student, 'slot_id': slot_id, 'other_id': previous[0],
+                        'slot': _span(start, end), 'other': _span(previous[4], previous[5]),
+                        'machines': f"{previous[3] or '-'} / {machine or '-'}",
+                    })
+            if previous is None or end > previous[5]:
+                student_reach[key] = row
+
+        if machine:
+            active = running[(site, machine)]
+            while active and active[0][0] <= start:
+                heapq.heappop(active)
+            heapq.heappush(active, (end, slot_id, start, capacity or 1))
+            capacity = min(entry[3] for entry in active)
+            shared = all(entry[2] == start and entry[0] == end for entry in active)
+            if (not shared or len(active) > capacity) and keep('machine_capacity'):
+                findings['machine_capacity'].append({
+                    'machine': machine, 'slot_id': slot_id, 'student': student,
+                    'slot': _span(start, end), 'in_use': len(active), 'capacity': capacity,
+                })
+
+        if check_lunch and first:
+            begins, ends = lunch_on(start.date())
+            if start < ends and begins < end and keep('lunch'):
+                findings['lunch'].append({
+                    'slot_id': slot_id, 'student': student, 'machine': machine, 'slot': _span(start, end),
+                })
+
+        if allowed_days is not None and first:
+            weekday = start.weekday()
+            if weekday not in allowed_days and keep('weekday'):
+                findings['weekday'].append({
+                    'slot_id': slot_id, 'student': student, 'machine': machine,
+                    'slot': _span(start, end), 'weekday': WEEKDAYS[weekday],
+                })
+
+    return {'rows': total, 'counts': counts, 'findings': findings}
@@ -0,0 +1,142 @@
+"""
+Dynamic field values
+====================
+Batch access to the DynamicField / DynamicFieldValue (EAV) tables.
+
+Loads every value for a set of records in one query and pivots it to
+``{record_id: {field_name: value}}`` (or a DataFrame for reports), instead
+of one ``DynamicFieldValue.query.filter_by(...).first()`` per field per
+record. Writes go through ``upsert_dynamic_values``, which relies on the
+unique (field_id, record_id) key to insert-or-update in one statement.
+"""
+import pandas as pd
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db
+from auth_models import DynamicField, DynamicFieldValue
+
+# Stay well below SQLite's bound-parameter limit for IN (...) lists
+IN_CHUNK_SIZE = 900
+
+
+def _chunks(ids, size=IN_CHUNK_SIZE):
+    ids = list(ids)
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+def load_dynamic_values(model_name, record_ids=None, fields=None):
+    """Pivoted dynamic values for many records.
+
+    ``record_ids=None`` loads values for every record of the model.
+    ``fields`` may be a list of DynamicField rows the caller already has;
+    otherwise all fields for ``model_name`` are used. Records without any
+    values are absent from the result.
+    """
+    if fields is None:
+        fields = DynamicField.query.filter_by(model_name=model_name).all()
+    if not fields:
+        return {}
+    names = {f.id: f.field_name for f in fields}
+
+    base = db.session.query(
+        DynamicFieldValue.record_id, DynamicFieldValue.field_id, DynamicFieldValue.value
+    ).filter(
+        DynamicFieldValue.model_name == model_name,
+        DynamicFieldValue.field_id.in_(list(names))
+    )
+
+    if record_ids is None:
+        batches = [base]
+    else:
+        batches = [base.filter(DynamicFieldValue.record_id.in_(chunk)) for chunk in _chunks(record_ids)]
+
+    values = {}
+    for query in batches:
+        for record_id, field_id, value in query:
+            values.setdefault(record_id, {})[names[field_id]] = value
+    return values
+
+def dynamic_values_for(model_name, record_id, fields=None, default=None):
+    """Dynamic values of a single record, with every field present"""
+    if fields is None:
+        fields = DynamicField.query.filter_by(model_name=model_name).all()
+    values = load_dynamic_values(model_name, [record_id], fields).get(record_id, {})
+    return {f.field_name: values.get(f.field_name, default) for f in fields}
+
+def dynamic_values_frame(model_name, record_ids=None, fields=None):
+    """Dynamic values as a DataFrame indexed by record id, one column per field"""
+    if fields is None:
+        fields = DynamicField.query.filter_by(model_name=model_name).all()
+    values = load_dynamic_values(model_name, record_ids, fields)
+    columns = list(dict.fromkeys(f.field_name for f in fields))
+    frame = pd.DataFrame.from_dict(values, orient='index', columns=columns)
+    if record_ids is not None:
+        frame = frame.reindex(list(record_ids))
+    frame.index.name = 'record_id'
+    return frame
+
+
+def upsert_dynamic_values(model_name, rows):
+    """Insert or update many values in one statement.
+
+    ``rows`` is an iterable of (field_id, record_id, value); a later row for
+    the same (field_id, record_id) wins. Uses ON CONFLICT DO UPDATE on
+    PostgreSQL and SQLite. Does not commit. Returns the number of values
+    written.
+    """
+    latest = {}
+    for field_id, record_id, value in rows:
+        latest[(field_id, record_id)] = value
+    if not latest:
+        return 0
+
+    params = [
+        {'field_id': field_id, 'record_id': record_id, 'model_name': model_name, 'value': value}
+        for (field_id, record_id), value in latest.items()
+    ]
+
+    dialect = db.engine.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        stmt = insert(DynamicFieldValue.__table__)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['field_id', 'record_id'],
+            set_={'value': stmt.excluded.value, 'model_name': stmt.excluded.model_name}
+        )
+        db.session.execute(stmt, params)
+    else:
+        # Portable fallback: one lookup per value
+        for p in params:
+            existing = DynamicFieldValue.query.filter_by(field_id=p['field_id'], record_id=p['record_id']).first()
+            if existing:
+                existing.value = p['value']
+                existing.model_name = model_name
+            else:
+                db.session.add(DynamicFieldValue(**p))
+    return len(params)
+
+def delete_dynamic_values(model_name, record_id, field_ids):
+    """Remove the given fields' values from one record. Does not commit."""
+    if not field_ids:
+        return 0
+    return DynamicFieldValue.query.filter(
+        DynamicFieldValue.model_name == model_name,
+        DynamicFieldValue.record_id == record_id,
+        DynamicFieldValue.field_id.in_(list(field_ids))
+    ).delete(synchronize_session=False)
+
+def save_dynamic_values(model_name, record_id, fields, form, prefix='dynamic_'):
+    """Apply a submitted add/edit form to one record's dynamic values.
+
+    Non-empty inputs are upserted, empty inputs remove any stored value.
+    Does not commit.
+    """
+    rows, cleared = [], []
+    for field in fields:
+        value = form.get(f'{prefix}{field.field_name}', '').strip()
+        if value:
+            rows.append((field.id, record_id, value))
+        else:
+            cleared.append(field.id)
+    upsert_dynamic_values(model_name, rows)
+    delete_dynamic_values(model_name, record_id, cleared)
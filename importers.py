@@ -0,0 +1,354 @@
+"""
+Spreadsheet importers
+=====================
+Set-based import of the student intake and machine workbooks. Instead of
+looking up students, field definitions and field values cell by cell, the
+import runs as a short pipeline over DataFrame chunks of the sheet (see
+sheet_reader.iter_chunks):
+
+1. match        - one query for the site's existing records, matched in memory
+2. normalize    - clean every column of a chunk at once
+3. insert       - the chunk's new records in one INSERT ... RETURNING
+4. values       - the chunk's custom field values in one upsert
+5. update       - changed existing records in one executemany UPDATE at the end
+
+Nothing is committed here; the caller commits once, so a failure anywhere
+leaves the database untouched.
+"""
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+from sqlalchemy import insert, update, or_
+
+from models import db, Student, Machine
+from auth_models import DynamicField
+from dynamic_values import upsert_dynamic_values
+
+# Cell contents treated as empty
+NULL_TOKENS = {'nan', 'none', 'null', '', '-', 'n/a', 'na'}
+
+# Accepted headers for the built-in student columns, in priority order
+STUDENT_NUMBER_COLUMNS = ['Student Number', 'student_number', 'STUDENT NUMBER', 'Student_Number',
+                          'ID NUMBER', 'ID_NUMBER']
+STUDENT_NAME_COLUMNS = ['Student Name', 'student_name', 'STUDENT NAME', 'Student_Name']
+FIRST_NAME_COLUMNS = ['NAME', 'Name', 'name']
+SURNAME_COLUMNS = ['SURNAME', 'Surname', 'surname']
+MACHINE_NAME_COLUMNS = ['Machine Name', 'machine_name', 'MACHINE NAME', 'Machine_Name']
+LEVEL_COLUMNS = ['Level', 'level', 'LEVEL']
+
+
+class PhaseTimer:
+    """Wall-clock time per named phase, summed over repeats, in first-run order"""
+
+    def __init__(self):
+        self.phases = {}
+
+    @contextmanager
+    def __call__(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    def summary(self):
+        return ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.phases.items())
+
+
+##############################################
+# NORMALIZATION
+##############################################
+def clean_column(series):
+    """Strip strings and turn blanks / null tokens / NaN into None"""
+    values = series.astype(object).where(series.notna(), None)
+    is_text = values.map(lambda v: isinstance(v, str))
+    if is_text.any():
+        text = values[is_text].str.strip()
+        values[is_text] = text.where(~text.str.lower().isin(NULL_TOKENS))
+    # Assignment above may bring NaN back in; normalize to None once more
+    return values.where(values.notna(), None)
+
+def _first_present(df, candidates):
+    """Row-wise first non-empty value across the candidate columns"""
+    columns = [c for c in candidates if c in df.columns]
+    if not columns:
+        return pd.Series([None] * len(df), index=df.index, dtype=object)
+    result = df[columns[0]]
+    for column in columns[1:]:
+        result = result.where(result.notna(), df[column])
+    return result.astype(object).where(result.notna(), None)
+
+def _as_text(series):
+    return series.map(lambda v: None if pd.isna(v) else str(v))
+
+def _clean_frame(df, candidates, custom_fields):
+    wanted = set(sum(candidates, [])) | set(custom_fields)
+    return pd.DataFrame({c: clean_column(df[c]) for c in df.columns if c in wanted}, index=df.index)
+
+def _finish_frame(result, cleaned, custom_fields, required):
+    for field_name in custom_fields:
+        if field_name in cleaned.columns:
+            result[field_name] = _as_text(cleaned[field_name])
+    result = result[result[required].notna()]
+    # pandas stores missing text as NaN; callers expect None
+    return result.astype(object).where(result.notna(), None)
+
+def normalize_student_frame(df, custom_fields):
+    """Cleaned frame with student_number, student_name and the custom columns.
+
+    Rows without a usable name are dropped, as the row-by-row import did.
+    """
+    cleaned = _clean_frame(df, [STUDENT_NUMBER_COLUMNS, STUDENT_NAME_COLUMNS, FIRST_NAME_COLUMNS,
+                                SURNAME_COLUMNS], custom_fields)
+
+    number = _first_present(cleaned, STUDENT_NUMBER_COLUMNS)
+    name = _first_present(cleaned, STUDENT_NAME_COLUMNS)
+
+    # Fall back to NAME + SURNAME where there is no combined name
+    first = _as_text(_first_present(cleaned, FIRST_NAME_COLUMNS))
+    surname = _as_text(_first_present(cleaned, SURNAME_COLUMNS))
+    combined = (first.fillna('') + ' ' + surname.fillna('')).str.strip()
+    name = name.where(name.notna(), combined.where(combined != '', None))
+
+    result = pd.DataFrame({'student_number': _as_text(number), 'student_name': _as_text(name)}, index=df.index)
+    return _finish_frame(result, cleaned, custom_fields, 'student_name')
+
+def normalize_machine_frame(df, custom_fields):
+    """Cleaned frame with machine_name, level and the custom columns"""
+    cleaned = _clean_frame(df, [MACHINE_NAME_COLUMNS, LEVEL_COLUMNS], custom_fields)
+    result = pd.DataFrame({
+        'machine_name': _as_text(_first_present(cleaned, MACHINE_NAME_COLUMNS)),
+        'level': _as_text(_first_present(cleaned, LEVEL_COLUMNS)),
+    }, index=df.index)
+    return _finish_frame(result, cleaned, custom_fields, 'machine_name')
+
+
+##############################################
+# SHARED STEPS
+##############################################
+def ensure_dynamic_fields(model_name, field_types):
+    """Field definitions for the selected columns, creating missing ones"""
+    fields = {f.field_name: f for f in DynamicField.query.filter_by(model_name=model_name).all()}
+    for field_name, field_type in field_types.items():
+        if field_name not in fields:
+            fields[field_name] = DynamicField(model_name=model_name, field_name=field_name,
+                                              field_type=field_type or 'text', required=False)
+            db.session.add(fields[field_name])
+    db.session.flush()
+    return {name: fields[name] for name in field_types}
+
+def _insert_returning_ids(model, rows):
+    """Insert many rows in one statement, returning ids in input order"""
+    if not rows:
+        return []
+    return db.session.scalars(
+        insert(model).returning(model.id, sort_by_parameter_order=True), rows
+    ).all()
+
+def _upsert_values(model_name, fields, rows, record_ids):
+    """Upsert every non-empty custom column value; ``record_ids`` parallels ``rows``"""
+    value_rows = []
+    for field_name, field in fields.items():
+        if field_name not in rows.columns:
+            continue
+        for record_id, value in zip(record_ids, rows[field_name]):
+            if value is not None:
+                value_rows.append((field.id, record_id, value))
+    upsert_dynamic_values(model_name, value_rows)
+
+
+##############################################
+# STUDENT IMPORT
+##############################################
+def _timed(chunks, timer, name='read'):
+    """Iterate chunks, charging the time spent producing each to ``name``"""
+    chunks = iter(chunks)
+    while True:
+        with timer(name):
+            chunk = next(chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
+def import_students(chunks, intake_group, field_types, timer=None, progress=None):
+    """Import an intake sheet, given as DataFrame chunks, into ``intake_group``.
+
+    ``field_types`` maps each selected custom column to its field type.
+    Students are matched by student number first, then by name, among
+    students of the group's site (and unassigned ones); rows repeating a
+    student seen earlier in the file update that student. ``progress`` is
+    called with the number of rows processed after each chunk. Returns counts.
+    """
+    timer = timer or PhaseTimer()
+    site_id = intake_group.site_id
+
+    with timer('match'):
+        fields = ensure_dynamic_fields('Student', field_types)
+        existing = db.session.query(
+            Student.id, Student.student_number, Student.student_name, Student.group_id
+        ).filter(or_(Student.site_id == site_id, Student.site_id.is_(None))).order_by(Student.id).all()
+
+        # First match wins, like the .first() lookups this replaces
+        by_number, by_name = {}, {}
+        for s in existing:
+            if s.student_number:
+                by_number.setdefault(s.student_number, s.id)
+            by_name.setdefault(s.student_name, s.id)
+        # Stored vs. wanted (number, group) of every student the import may touch
+        stored = {s.id: (s.student_number, s.group_id) for s in existing}
+        wanted = dict(stored)
+
+    total = added = updated = skipped = 0
+    for chunk in _timed(chunks, timer):
+        with timer('normalize'):
+            rows = normalize_student_frame(chunk, list(fields))
+
+        with timer('match'):
+            # New students are keyed ('new', n) until inserted
+            new_students, targets, provisional = [], [], []
+            for number, name in zip(rows['student_number'], rows['student_name']):
+                key = (by_number.get(number) if number else None) or by_name.get(name)
+                if key is None:
+                    key = ('new', len(new_students))
+                    new_students.append({'student_number': number, 'student_name': name,
+                                         'group_id': intake_group.id, 'site_id': site_id})
+                    if number:
+                        by_number[number] = key
+                        provisional.append((by_number, number))
+                    by_name[name] = key
+                    provisional.append((by_name, name))
+                elif isinstance(key, tuple):
+                    pending = new_students[key[1]]
+                    if number and not pending['student_number']:
+                        pending['student_number'] = number
+                        if number not in by_number:
+                            by_number[number] = key
+                            provisional.append((by_number, number))
+                else:
+                    current_number = wanted[key][0]
+                    if number and not current_number:
+                        current_number = number
+                        by_number.setdefault(number, key)
+                    wanted[key] = (current_number, intake_group.id)
+                targets.append(key)
+
+        with timer('insert'):
+            new_ids = _insert_returning_ids(Student, new_students)
+            for student_id, student in zip(new_ids, new_students):
+                stored[student_id] = wanted[student_id] = (student['student_number'], student['group_id'])
+
+        with timer('values'):
+            record_ids = [new_ids[key[1]] if isinstance(key, tuple) else key for key in targets]
+            _upsert_values('Student', fields, rows, record_ids)
+
+        # Later chunks refer to this chunk's new students by id
+        for lookup, k in provisional:
+            lookup[k] = new_ids[lookup[k][1]]
+
+        total += len(chunk)
+        added += len(new_students)
+        updated += len(targets) - len(new_students)
+        skipped += len(chunk) - len(rows)
+        if progress:
+            progress(total)
+
+    with timer('update'):
+        changes = [{'id': student_id, 'student_number': number, 'group_id': group_id}
+                   for student_id, (number, group_id) in wanted.items() if stored[student_id] != (number, group_id)]
+        if changes:
+            db.session.execute(update(Student), changes)
+
+    return {
+        'rows': total,
+        'added': added,
+        'updated': updated,
+        'errors': [f"{skipped} row(s) without a student name were skipped"] if skipped else [],
+        'fields': len(fields),
+    }
+
+
+##############################################
+# MACHINE IMPORT
+##############################################
+def import_machines(chunks, site_id, field_types, timer=None, progress=None):
+    """Import a machine sheet, given as DataFrame chunks, into a site.
+
+    Machines are matched by name within the site. New machines need a
+    level (the column is required); rows that would create one without a
+    level are reported and skipped. Returns counts.
+    """
+    timer = timer or PhaseTimer()
+
+    with timer('match'):
+        fields = ensure_dynamic_fields('Machine', field_types)
+        existing = db.session.query(Machine.id, Machine.machine_name, Machine.level).filter(
+            Machine.site_id == site_id
+        ).order_by(Machine.id).all()
+        by_name = {}
+        for m in existing:
+            by_name.setdefault(m.machine_name, m.id)
+        stored = {m.id: m.level for m in existing}
+        levels = dict(stored)
+
+    total = added = matched = skipped = 0
+    errors = []
+    for chunk in _timed(chunks, timer):
+        with timer('normalize'):
+            rows = normalize_machine_frame(chunk, list(fields))
+
+        with timer('match'):
+            new_machines, targets, provisional = [], [], []
+            for index, name, level in zip(rows.index, rows['machine_name'], rows['level']):
+                key = by_name.get(name)
+                if key is None:
+                    if not level:
+                        errors.append(f"Data row {total + index + 1}: new machine '{name}' has no level")
+                        targets.append(None)
+                        continue
+                    key = ('new', len(new_machines))
+                    new_machines.append({'machine_name': name, 'level': level, 'site_id': site_id})
+                    by_name[name] = key
+                    provisional.append(name)
+                elif level:
+                    if isinstance(key, tuple):
+                        new_machines[key[1]]['level'] = level
+                    else:
+                        levels[key] = level
+                targets.append(key)
+
+        with timer('insert'):
+            new_ids = _insert_returning_ids(Machine, new_machines)
+            for machine_id, machine in zip(new_ids, new_machines):
+                stored[machine_id] = levels[machine_id] = machine['level']
+
+        with timer('values'):
+            keep = [key is not None for key in targets]
+            record_ids = [new_ids[key[1]] if isinstance(key, tuple) else key for key in targets if key is not None]
+            _upsert_values('Machine', fields, rows[keep], record_ids)
+
+        for name in provisional:
+            by_name[name] = new_ids[by_name[name][1]]
+
+        total += len(chunk)
+        added += len(new_machines)
+        matched += sum(1 for key in targets if key is not None)
+        skipped += len(chunk) - len(rows)
+        if progress:
+            progress(total)
+
+    with timer('update'):
+        changes = [{'id': machine_id, 'level': level}
+                   for machine_id, level in levels.items() if stored[machine_id] != level]
+        if changes:
+            db.session.execute(update(Machine), changes)
+
+    if skipped:
+        errors.insert(0, f"{skipped} row(s) without a machine name were skipped")
+    return {
+        'rows': total,
+        'added': added,
+        'updated': matched - added,
+        'errors': errors,
+        'fields': len(fields),
+    }
@@ -0,0 +1,163 @@
+"""
+Background jobs
+===============
+Confirmed spreadsheet imports run on a small local thread pool instead of
+the request thread. Job state lives in the ImportJob table, so the status
+page can be reloaded (or reopened from another tab) while a job runs, and
+the /jobs/<id> endpoint in app.py only has to read one row.
+
+Job state is committed between phases, never inside the import itself, so
+the import stays one transaction. Rows processed are reported per chunk on
+a separate connection where the database allows concurrent writers.
+
+Pool threads die with their process, so a job still queued or running long
+after it was submitted belonged to a worker that was restarted; the status
+endpoints mark it failed (``fail_if_stale``) instead of polling forever.
+"""
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from models import db, Group, ImportJob
+from importers import import_students, import_machines, PhaseTimer
+from sheet_reader import count_rows, iter_chunks
+
+log = logging.getLogger(__name__)
+
+# Imports are write-heavy; a couple of workers per process is plenty
+JOB_WORKERS = int(os.environ.get("IMPORT_JOB_WORKERS", 2))
+UPLOAD_DIR = 'temp_uploads'
+
+# Longer than any import takes; a job queued or running past this has lost its worker
+JOB_TIMEOUT = timedelta(minutes=int(os.environ.get("IMPORT_JOB_TIMEOUT_MINUTES", 60)))
+
+_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='import-job')
+
+
+def create_job(kind, site_id, user_id, filename, params):
+    """Record a queued job and commit it so it is visible to the poller"""
+    job = ImportJob(kind=kind, site_id=site_id, user_id=user_id, filename=filename,
+                    params=json.dumps(params), status='queued')
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+def submit_job(app, job_id):
+    """Run a job on the pool; ``app`` is the Flask app (not the proxy)"""
+    return _executor.submit(_run, app, job_id)
+
+def fail_if_stale(job):
+    """Mark a job failed when it has been queued or running longer than
+    JOB_TIMEOUT, and drop its upload. Commits only then; returns the job."""
+    since = job.started_at if job.status == 'running' else job.created_at
+    if job.status not in ('queued', 'running') or since is None or datetime.utcnow() - since < JOB_TIMEOUT:
+        return job
+    log.warning("Import job %s was %s since %s; marking it failed", job.id, job.status, since)
+    _progress(job, status='failed', phase=None, finished_at=datetime.utcnow(),
+              message="The import stopped when the server restarted. Please upload the file again.",
+              errors=json.dumps(["Import interrupted by a server restart"]))
+    _remove_upload(job)
+    return job
+
+
+##############################################
+# RUNNERS
+##############################################
+def _open_sheet(job, params):
+    """Chunks of the uploaded sheet, streamed; records the row total the
+    wizard counted first (counting here only for jobs queued without one)"""
+    path = os.path.join(UPLOAD_DIR, job.filename)
+    header_row = params.get('header_row', 0)
+    rows_total = params.get('rows_total')
+    if rows_total is None:
+        rows_total = max(count_rows(path) - header_row - 1, 0)
+    _progress(job, phase='importing', rows_total=rows_total)
+    return iter_chunks(path, header_row)
+
+def _row_progress(job_id):
+    """Callback recording rows processed while the import transaction is open.
+
+    Written on a separate connection so pollers see it before the commit.
+    SQLite allows a single writer, so there the count is only set at the end.
+    """
+    if db.engine.dialect.name == 'sqlite':
+        return None
+
+    def progress(rows):
+        with db.engine.begin() as connection:
+            connection.execute(
+                ImportJob.__table__.update().where(ImportJob.__table__.c.id == job_id).values(rows_processed=rows)
+            )
+    return progress
+
+def _summary(result, noun, target=''):
+    parts = []
+    if result['added'] > 0:
+        parts.append(f"{result['added']} new {noun}(s) added")
+    if result['updated'] > 0:
+        parts.append(f"{result['updated']} existing {noun}(s) updated")
+    if not parts:
+        return f"No {noun}s were added or updated."
+    return f"Successfully processed: {' and '.join(parts)}{target} with {result['fields']} custom field(s)!"
+
+def _run_students(job, params, timer):
+    intake_group = db.session.get(Group, params['intake_group_id'])
+    if intake_group is None:
+        raise ValueError("Invalid intake group")
+    chunks = _open_sheet(job, params)
+    result = import_students(chunks, intake_group, params.get('field_types', {}),
+                             timer=timer, progress=_row_progress(job.id))
+    return result, _summary(result, 'student', f" to '{intake_group.name}'")
+
+def _run_machines(job, params, timer):
+    chunks = _open_sheet(job, params)
+    result = import_machines(chunks, job.site_id, params.get('field_types', {}),
+                             timer=timer, progress=_row_progress(job.id))
+    return result, _summary(result, 'machine')
+
+RUNNERS = {
+    'students': _run_students,
+    'machines': _run_machines,
+}
+
+
+##############################################
+# EXECUTION
+##############################################
+def _progress(job, **values):
+    for name, value in values.items():
+        setattr(job, name, value)
+    db.session.commit()
+
+def _run(app, job_id):
+    with app.app_context():
+        job = db.session.get(ImportJob, job_id)
+        if job is None or job.status != 'queued':
+            return
+        _progress(job, status='running', started_at=datetime.utcnow())
+
+        timer = PhaseTimer()
+        try:
+            result, message = RUNNERS[job.kind](job, json.loads(job.params or '{}'), timer)
+            with timer('commit'):
+                db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            log.exception("Import job %s failed", job_id)
+            job = db.session.get(ImportJob, job_id)
+            _progress(job, status='failed', phase=None, finished_at=datetime.utcnow(),
+                      message=f"Error importing data: {e}", errors=json.dumps([str(e)]))
+        else:
+            _progress(job, status='done', phase=None, finished_at=datetime.utcnow(),
+                      rows_total=result['rows'], rows_processed=result['rows'], added=result['added'], updated=result['updated'],
+                      errors=json.dumps(result['errors']), message=f"{message} ({timer.summary()})")
+        finally:
+            _remove_upload(job)
+
+def _remove_upload(job):
+    """The uploaded file is only needed by its job"""
+    path = os.path.join(UPLOAD_DIR, job.filename or '')
+    if job.filename and os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,123 @@
+"""Add dashboard rollup tables
+
+Revision ID: a3c91d5e7b20
+Revises: 5ff63285ca2d
+Create Date: 2026-10-18 09:12:04.118532
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3c91d5e7b20'
+down_revision = '5ff63285ca2d'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+schedule = sa.table('schedule',
+    sa.column('site_id', sa.Integer), sa.column('student_name', sa.String), sa.column('machine_name', sa.String),
+    sa.column('start_time', sa.DateTime), sa.column('end_time', sa.DateTime),
+)
+inventory_usage = sa.table('inventory_usage',
+    sa.column('site_id', sa.Integer), sa.column('student_name', sa.String), sa.column('consumable', sa.String),
+    sa.column('quantity', sa.Integer), sa.column('unit_cost', sa.Float), sa.column('date_issued', sa.DateTime),
+)
+
+
+def upgrade():
+    op.create_table('rollup_machine_usage_daily',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('site_id', sa.Integer(), nullable=True),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('machine_name', sa.String(length=255), nullable=True),
+    sa.Column('slot_count', sa.Integer(), nullable=True),
+    sa.Column('total_seconds', sa.Float(), nullable=True),
+    sa.ForeignKeyConstraint(['site_id'], ['sites.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('site_id', 'day', 'machine_name', name='uq_rollup_machine_usage_daily')
+    )
+    op.create_table('rollup_student_machine_usage',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('site_id', sa.Integer(), nullable=True),
+    sa.Column('student_name', sa.String(length=255), nullable=True),
+    sa.Column('machine_name', sa.String(length=255), nullable=True),
+    sa.Column('slot_count', sa.Integer(), nullable=True),
+    sa.Column('total_seconds', sa.Float(), nullable=True),
+    sa.ForeignKeyConstraint(['site_id'], ['sites.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('site_id', 'student_name', 'machine_name', name='uq_rollup_student_machine_usage')
+    )
+    op.create_table('rollup_consumable_usage_daily',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('site_id', sa.Integer(), nullable=True),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('consumable', sa.String(length=255), nullable=True),
+    sa.Column('entry_count', sa.Integer(), nullable=True),
+    sa.Column('quantity', sa.Integer(), nullable=True),
+    sa.Column('cost', sa.Float(), nullable=True),
+    sa.ForeignKeyConstraint(['site_id'], ['sites.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('site_id', 'day', 'consumable', name='uq_rollup_consumable_usage_daily')
+    )
+    op.create_table('rollup_student_spend',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('site_id', sa.Integer(), nullable=True),
+    sa.Column('student_name', sa.String(length=255), nullable=True),
+    sa.Column('consumable', sa.String(length=255), nullable=True),
+    sa.Column('entry_count', sa.Integer(), nullable=True),
+    sa.Column('quantity', sa.Integer(), nullable=True),
+    sa.Column('cost', sa.Float(), nullable=True),
+    sa.ForeignKeyConstraint(['site_id'], ['sites.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('site_id', 'student_name', 'consumable', name='uq_rollup_student_spend')
+    )
+    populate_rollups(op.get_bind())
+
+
+def _add(totals, key, values):
+    bucket = totals.setdefault(key, dict.fromkeys(values, 0))
+    for name, value in values.items():
+        bucket[name] += value
+
+def _insert(bind, table_name, key_names, totals):
+    rows = [dict(zip(key_names, key), **values) for key, values in totals.items()]
+    if not rows:
+        return
+    table = sa.table(table_name, *[sa.column(name) for name in rows[0]])
+    for i in range(0, len(rows), BATCH_SIZE):
+        bind.execute(table.insert(), rows[i:i + BATCH_SIZE])
+
+def populate_rollups(bind):
+    """Fill the new tables from the existing schedule and inventory usage,
+    summed the same way rollups.py adds single rows"""
+    machine_daily, student_machine, consumable_daily, student_spend = {}, {}, {}, {}
+    for site_id, student_name, machine_name, start_time, end_time in bind.execute(sa.select(*schedule.c)):
+        seconds = (end_time - start_time).total_seconds() if start_time and end_time else 0.0
+        values = {'slot_count': 1, 'total_seconds': seconds}
+        _add(student_machine, (site_id, student_name, machine_name), values)
+        if start_time:
+            _add(machine_daily, (site_id, start_time.date(), machine_name), values)
+
+    for site_id, student_name, consumable, quantity, unit_cost, date_issued in bind.execute(
+        sa.select(*inventory_usage.c)
+    ):
+        quantity = quantity or 0
+        values = {'entry_count': 1, 'quantity': quantity, 'cost': quantity * (unit_cost or 0.0)}
+        _add(student_spend, (site_id, student_name, consumable), values)
+        if date_issued:
+            _add(consumable_daily, (site_id, date_issued.date(), consumable), values)
+
+    _insert(bind, 'rollup_machine_usage_daily', ('site_id', 'day', 'machine_name'), machine_daily)
+    _insert(bind, 'rollup_student_machine_usage', ('site_id', 'student_name', 'machine_name'), student_machine)
+    _insert(bind, 'rollup_consumable_usage_daily', ('site_id', 'day', 'consumable'), consumable_daily)
+    _insert(bind, 'rollup_student_spend', ('site_id', 'student_name', 'consumable'), student_spend)
+
+
+def downgrade():
+    op.drop_table('rollup_student_spend')
+    op.drop_table('rollup_consumable_usage_daily')
+    op.drop_table('rollup_student_machine_usage')
+    op.drop_table('rollup_machine_usage_daily')
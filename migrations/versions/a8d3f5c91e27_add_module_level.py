@@ -0,0 +1,26 @@
+"""Add the machine level a module needs
+
+Revision ID: a8d3f5c91e27
+Revises: f4b1e8c27d53
+Create Date: 2026-10-18 15:27:13.506219
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a8d3f5c91e27'
+down_revision = 'f4b1e8c27d53'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('modules', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('level', sa.String(length=50), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('modules', schema=None) as batch_op:
+        batch_op.drop_column('level')
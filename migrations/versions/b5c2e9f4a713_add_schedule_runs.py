@@ -0,0 +1,81 @@
+"""Add schedule runs and the staging table
+
+Revision ID: b5c2e9f4a713
+Revises: a8d3f5c91e27
+Create Date: 2026-10-18 16:42:08.318274
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5c2e9f4a713'
+down_revision = 'a8d3f5c91e27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('schedule_runs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('site_id', sa.Integer(), nullable=True),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('generator', sa.String(length=50), nullable=True),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('window_start', sa.DateTime(), nullable=True),
+    sa.Column('window_end', sa.DateTime(), nullable=True),
+    sa.Column('row_count', sa.Integer(), nullable=True),
+    sa.Column('replaced_count', sa.Integer(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('published_at', sa.DateTime(), nullable=True),
+    sa.Column('rolled_back_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['site_id'], ['sites.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('schedule_runs', schema=None) as batch_op:
+        batch_op.create_index('ix_schedule_runs_site_id', ['site_id'], unique=False)
+
+    op.create_table('schedule_run_rows',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('run_id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.String(length=10), nullable=False),
+    sa.Column('origin_run_id', sa.Integer(), nullable=True),
+    sa.Column('student_name', sa.String(length=255), nullable=False),
+    sa.Column('site_id', sa.Integer(), nullable=True),
+    sa.Column('group_name', sa.String(length=255), nullable=True),
+    sa.Column('machine_name', sa.String(length=255), nullable=True),
+    sa.Column('module_name', sa.String(length=255), nullable=True),
+    sa.Column('start_time', sa.DateTime(), nullable=True),
+    sa.Column('end_time', sa.DateTime(), nullable=True),
+    sa.Column('extra_time', sa.Integer(), nullable=True),
+    sa.Column('session_type', sa.String(length=50), nullable=True),
+    sa.Column('capacity', sa.Integer(), nullable=True),
+    sa.Column('notes', sa.Text(), nullable=True),
+    sa.ForeignKeyConstraint(['run_id'], ['schedule_runs.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('schedule_run_rows', schema=None) as batch_op:
+        batch_op.create_index('ix_schedule_run_rows_run_kind', ['run_id', 'kind'], unique=False)
+
+    with op.batch_alter_table('schedule', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('run_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_schedule_run_id', 'schedule_runs', ['run_id'], ['id'])
+        batch_op.create_index('ix_schedule_run_id', ['run_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('schedule', schema=None) as batch_op:
+        batch_op.drop_index('ix_schedule_run_id')
+        batch_op.drop_constraint('fk_schedule_run_id', type_='foreignkey')
+        batch_op.drop_column('run_id')
+
+    with op.batch_alter_table('schedule_run_rows', schema=None) as batch_op:
+        batch_op.drop_index('ix_schedule_run_rows_run_kind')
+
+    op.drop_table('schedule_run_rows')
+    with op.batch_alter_table('schedule_runs', schema=None) as batch_op:
+        batch_op.drop_index('ix_schedule_runs_site_id')
+
+    op.drop_table('schedule_runs')
@@ -0,0 +1,139 @@
+"""Link inventory usage to students and inventory items
+
+Revision ID: b7e24f90c1d3
+Revises: a3c91d5e7b20
+Create Date: 2026-10-18 10:03:51.640277
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e24f90c1d3'
+down_revision = 'a3c91d5e7b20'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+inventory_usage = sa.table('inventory_usage',
+    sa.column('id', sa.Integer), sa.column('site_id', sa.Integer),
+    sa.column('student_id', sa.Integer), sa.column('student_name', sa.String),
+    sa.column('inventory_id', sa.Integer), sa.column('consumable', sa.String),
+    sa.column('quantity', sa.Integer), sa.column('unit_cost', sa.Float),
+)
+students = sa.table('students',
+    sa.column('id', sa.Integer), sa.column('student_name', sa.String), sa.column('site_id', sa.Integer),
+)
+inventory = sa.table('inventory',
+    sa.column('id', sa.Integer), sa.column('item_name', sa.String), sa.column('site_id', sa.Integer),
+)
+student_spend = sa.table('rollup_student_spend',
+    sa.column('site_id', sa.Integer), sa.column('student_id', sa.Integer), sa.column('student_name', sa.String),
+    sa.column('consumable', sa.String), sa.column('entry_count', sa.Integer), sa.column('quantity', sa.Integer),
+    sa.column('cost', sa.Float),
+)
+
+
+def upgrade():
+    with op.batch_alter_table('inventory_usage', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('student_id', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('inventory_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_inventory_usage_student_id', 'students', ['student_id'], ['id'])
+        batch_op.create_foreign_key('fk_inventory_usage_inventory_id', 'inventory', ['inventory_id'], ['id'])
+        batch_op.create_index('ix_inventory_usage_student_id', ['student_id'], unique=False)
+        batch_op.create_index('ix_inventory_usage_inventory_id', ['inventory_id'], unique=False)
+
+    # Rollup rows are now keyed by student_id as well
+    with op.batch_alter_table('rollup_student_spend', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('student_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_rollup_student_spend_student_id', 'students', ['student_id'], ['id'])
+        batch_op.create_index('ix_rollup_student_spend_student_id', ['student_id'], unique=False)
+        batch_op.drop_constraint('uq_rollup_student_spend', type_='unique')
+        batch_op.create_unique_constraint('uq_rollup_student_spend', ['site_id', 'student_id', 'student_name', 'consumable'])
+
+    bind = op.get_bind()
+    link_usage(bind)
+    rebuild_student_spend(bind, by_student=True)
+
+
+def link_usage(bind):
+    """Resolve the student and item names of existing usage rows to ids in
+    batches, with the resolvers backfill_inventory_links.py uses (so
+    "AGT21006 Maila Frans" is matched on number and name). Names that are
+    ambiguous or match nothing on the row's site stay NULL.
+    """
+    from resolvers import StudentResolver, InventoryResolver
+
+    # student_number is added by a script, not a migration
+    has_number = any(column['name'] == 'student_number' for column in sa.inspect(bind).get_columns('students'))
+    number = sa.column('student_number') if has_number else sa.null()
+    student_resolver = StudentResolver(bind.execute(sa.select(
+        students.c.id, students.c.student_name, number.label('student_number'), students.c.site_id
+    ).select_from(students)).all())
+    item_resolver = InventoryResolver(bind.execute(
+        sa.select(inventory.c.id, inventory.c.item_name, inventory.c.site_id)
+    ).all())
+
+    statement = inventory_usage.update().where(inventory_usage.c.id == sa.bindparam('row_id')).values(
+        student_id=sa.bindparam('student_id'), inventory_id=sa.bindparam('inventory_id')
+    )
+    last_id = 0
+    while True:
+        rows = bind.execute(
+            sa.select(inventory_usage.c.id, inventory_usage.c.site_id, inventory_usage.c.student_name,
+                      inventory_usage.c.consumable)
+            .where(inventory_usage.c.id > last_id).order_by(inventory_usage.c.id).limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        updates = []
+        for row_id, site_id, student_name, consumable in rows:
+            student_id = student_resolver.resolve(student_name, site_id)
+            inventory_id = item_resolver.resolve(consumable, site_id)
+            if student_id or inventory_id:
+                updates.append({'row_id': row_id, 'student_id': student_id, 'inventory_id': inventory_id})
+        if updates:
+            bind.execute(statement, updates)
+        last_id = rows[-1][0]
+
+
+def rebuild_student_spend(bind, by_student):
+    """Recount the student spend rollup from inventory usage, per
+    student_id as well as name when ``by_student``"""
+    totals = {}
+    for site_id, student_id, student_name, consumable, quantity, unit_cost in bind.execute(sa.select(
+        inventory_usage.c.site_id, inventory_usage.c.student_id, inventory_usage.c.student_name,
+        inventory_usage.c.consumable, inventory_usage.c.quantity, inventory_usage.c.unit_cost
+    )):
+        key = (site_id, student_id if by_student else None, student_name, consumable)
+        entry_count, total_quantity, cost = totals.get(key, (0, 0, 0.0))
+        quantity = quantity or 0
+        totals[key] = (entry_count + 1, total_quantity + quantity, cost + quantity * (unit_cost or 0.0))
+
+    rows = [{'site_id': site_id, 'student_id': student_id, 'student_name': student_name,
+             'consumable': consumable, 'entry_count': entry_count, 'quantity': quantity, 'cost': cost}
+            for (site_id, student_id, student_name, consumable), (entry_count, quantity, cost) in totals.items()]
+    bind.execute(student_spend.delete())
+    for i in range(0, len(rows), BATCH_SIZE):
+        bind.execute(student_spend.insert(), rows[i:i + BATCH_SIZE])
+
+
+def downgrade():
+    rebuild_student_spend(op.get_bind(), by_student=False)
+
+    with op.batch_alter_table('rollup_student_spend', schema=None) as batch_op:
+        batch_op.drop_constraint('uq_rollup_student_spend', type_='unique')
+        batch_op.create_unique_constraint('uq_rollup_student_spend', ['site_id', 'student_name', 'consumable'])
+        batch_op.drop_index('ix_rollup_student_spend_student_id')
+        batch_op.drop_constraint('fk_rollup_student_spend_student_id', type_='foreignkey')
+        batch_op.drop_column('student_id')
+
+    with op.batch_alter_table('inventory_usage', schema=None) as batch_op:
+        batch_op.drop_index('ix_inventory_usage_inventory_id')
+        batch_op.drop_index('ix_inventory_usage_student_id')
+        batch_op.drop_constraint('fk_inventory_usage_inventory_id', type_='foreignkey')
+        batch_op.drop_constraint('fk_inventory_usage_student_id', type_='foreignkey')
+        batch_op.drop_column('inventory_id')
+        batch_op.drop_column('student_id')
@@ -0,0 +1,51 @@
+"""Scope dynamic field values by model and make (field, record) unique
+
+Revision ID: c5d8a2f6e914
+Revises: b7e24f90c1d3
+Create Date: 2026-10-18 11:24:09.318540
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5d8a2f6e914'
+down_revision = 'b7e24f90c1d3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('dynamic_field_values', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('model_name', sa.String(length=50), nullable=True))
+
+    op.execute(
+        "UPDATE dynamic_field_values SET model_name = ("
+        "SELECT model_name FROM dynamic_fields WHERE dynamic_fields.id = dynamic_field_values.field_id)"
+    )
+
+    # Orphans can never be read back
+    op.execute("DELETE FROM dynamic_field_values WHERE field_id IS NULL OR record_id IS NULL")
+
+    # Keep the oldest row per (field, record): it is the one the app has been reading and editing
+    op.execute(
+        "DELETE FROM dynamic_field_values WHERE id NOT IN ("
+        "SELECT keep_id FROM (SELECT MIN(id) AS keep_id FROM dynamic_field_values "
+        "GROUP BY field_id, record_id) AS keep)"
+    )
+
+    with op.batch_alter_table('dynamic_field_values', schema=None) as batch_op:
+        batch_op.alter_column('field_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.alter_column('record_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.create_unique_constraint('uq_dynamic_field_values_field_record', ['field_id', 'record_id'])
+        batch_op.create_index('ix_dynamic_field_values_model_record', ['model_name', 'record_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('dynamic_field_values', schema=None) as batch_op:
+        batch_op.drop_index('ix_dynamic_field_values_model_record')
+        batch_op.drop_constraint('uq_dynamic_field_values_field_record', type_='unique')
+        batch_op.alter_column('record_id', existing_type=sa.Integer(), nullable=True)
+        batch_op.alter_column('field_id', existing_type=sa.Integer(), nullable=True)
+        batch_op.drop_column('model_name')
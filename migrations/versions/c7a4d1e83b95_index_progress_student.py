@@ -0,0 +1,26 @@
+"""Index mini-task progress by student for the latest-progress lookup
+
+Revision ID: c7a4d1e83b95
+Revises: b5c2e9f4a713
+Create Date: 2026-10-18 17:20:51.604113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7a4d1e83b95'
+down_revision = 'b5c2e9f4a713'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('student_mini_task_progress', schema=None) as batch_op:
+        batch_op.create_index('ix_student_mini_task_progress_student', ['student_id', 'id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('student_mini_task_progress', schema=None) as batch_op:
+        batch_op.drop_index('ix_student_mini_task_progress_student')
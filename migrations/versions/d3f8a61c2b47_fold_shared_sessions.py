@@ -0,0 +1,134 @@
+"""Fold shared test sessions into one schedule row with participants
+
+Revision ID: d3f8a61c2b47
+Revises: c7a4d1e83b95
+Create Date: 2026-10-18 21:07:42.905316
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3f8a61c2b47'
+down_revision = 'c7a4d1e83b95'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+schedule = sa.table('schedule',
+    sa.column('id', sa.Integer), sa.column('student_name', sa.String), sa.column('site_id', sa.Integer),
+    sa.column('group_name', sa.String), sa.column('machine_name', sa.String), sa.column('module_name', sa.String),
+    sa.column('start_time', sa.DateTime), sa.column('end_time', sa.DateTime), sa.column('extra_time', sa.Integer),
+    sa.column('session_type', sa.String), sa.column('capacity', sa.Integer), sa.column('notes', sa.Text),
+    sa.column('run_id', sa.Integer),
+)
+participants = sa.table('schedule_participants',
+    sa.column('id', sa.Integer), sa.column('schedule_id', sa.Integer), sa.column('student_id', sa.Integer),
+)
+students = sa.table('students',
+    sa.column('id', sa.Integer), sa.column('student_name', sa.String), sa.column('site_id', sa.Integer),
+    sa.column('group_id', sa.Integer),
+)
+groups = sa.table('groups', sa.column('id', sa.Integer), sa.column('name', sa.String))
+
+
+def upgrade():
+    op.create_table('schedule_participants',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('schedule_id', sa.Integer(), nullable=False),
+    sa.Column('student_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['schedule_id'], ['schedule.id'], ),
+    sa.ForeignKeyConstraint(['student_id'], ['students.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('schedule_id', 'student_id', name='uq_schedule_participant')
+    )
+    with op.batch_alter_table('schedule_participants', schema=None) as batch_op:
+        batch_op.create_index('ix_schedule_participants_student', ['student_id'], unique=False)
+
+    op.create_table('schedule_run_participants',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('row_id', sa.Integer(), nullable=False),
+    sa.Column('student_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['row_id'], ['schedule_run_rows.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('schedule_run_participants', schema=None) as batch_op:
+        batch_op.create_index('ix_schedule_run_participants_row', ['row_id'], unique=False)
+
+    with op.batch_alter_table('schedule_run_rows', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('schedule_id', sa.Integer(), nullable=True))
+
+    fold_sessions(op.get_bind())
+
+
+def fold_sessions(bind):
+    """Keep the oldest row of each shared session and turn the other
+    students' rows into participants. Rows whose student no longer
+    resolves by (site, name) stay rows of their own. The rollups count
+    participants exactly as they counted the rows, so they need no rebuild.
+    """
+    student_ids = {}
+    for student_id, site_id, name in bind.execute(
+        sa.select(students.c.id, students.c.site_id, students.c.student_name).order_by(students.c.id)
+    ):
+        student_ids.setdefault((site_id, name), student_id)
+
+    rows = bind.execute(
+        sa.select(schedule.c.id, schedule.c.site_id, schedule.c.student_name, schedule.c.machine_name,
+                  schedule.c.start_time, schedule.c.end_time)
+        .where(schedule.c.capacity > 1)
+        .order_by(schedule.c.site_id, schedule.c.machine_name, schedule.c.start_time,
+                  schedule.c.end_time, schedule.c.id)
+    )
+    links, folded, session, seen = [], [], None, set()
+    for row_id, site_id, name, machine_name, start_time, end_time in rows:
+        key = (site_id, machine_name, start_time, end_time)
+        if session is None or session[0] != key:
+            session, seen = (key, row_id), {name}
+            continue
+        student_id = student_ids.get((site_id, name))
+        if student_id is None or name in seen:
+            continue
+        seen.add(name)
+        links.append({'schedule_id': session[1], 'student_id': student_id})
+        folded.append(row_id)
+
+    for i in range(0, len(folded), BATCH_SIZE):
+        bind.execute(participants.insert(), links[i:i + BATCH_SIZE])
+        bind.execute(schedule.delete().where(schedule.c.id.in_(folded[i:i + BATCH_SIZE])))
+
+
+def unfold_sessions(bind):
+    """Give every participant its own copy of the session row again"""
+    copied = [c for c in schedule.c if c.key not in ('id', 'student_name', 'group_name')]
+    rows = bind.execute(
+        sa.select(students.c.student_name, groups.c.name.label('group_name'), *copied)
+        .select_from(participants)
+        .join(schedule, schedule.c.id == participants.c.schedule_id)
+        .join(students, students.c.id == participants.c.student_id)
+        .outerjoin(groups, groups.c.id == students.c.group_id)
+        .order_by(participants.c.id)
+    ).mappings().all()
+    for i in range(0, len(rows), BATCH_SIZE):
+        bind.execute(schedule.insert(), [
+            dict(row, group_name=row['group_name'] or '') for row in rows[i:i + BATCH_SIZE]
+        ])
+    bind.execute(participants.delete())
+
+
+def downgrade():
+    unfold_sessions(op.get_bind())
+
+    with op.batch_alter_table('schedule_run_rows', schema=None) as batch_op:
+        batch_op.drop_column('schedule_id')
+
+    with op.batch_alter_table('schedule_run_participants', schema=None) as batch_op:
+        batch_op.drop_index('ix_schedule_run_participants_row')
+
+    op.drop_table('schedule_run_participants')
+    with op.batch_alter_table('schedule_participants', schema=None) as batch_op:
+        batch_op.drop_index('ix_schedule_participants_student')
+
+    op.drop_table('schedule_participants')
@@ -0,0 +1,28 @@
+"""Index students for the paginated list
+
+Revision ID: d91f3b7a0c6e
+Revises: c5d8a2f6e914
+Create Date: 2026-10-18 12:02:37.904113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd91f3b7a0c6e'
+down_revision = 'c5d8a2f6e914'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('students', schema=None) as batch_op:
+        batch_op.create_index('ix_students_site_name', ['site_id', 'student_name'], unique=False)
+        batch_op.create_index('ix_students_group_id', ['group_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('students', schema=None) as batch_op:
+        batch_op.drop_index('ix_students_group_id')
+        batch_op.drop_index('ix_students_site_name')
@@ -0,0 +1,189 @@
+"""Link schedule, macro plan and maintenance rows to students and machines
+
+Revision ID: e8b1c4f7a2d9
+Revises: d3f8a61c2b47
+Create Date: 2026-10-18 23:18:05.472910
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e8b1c4f7a2d9'
+down_revision = 'd3f8a61c2b47'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+schedule = sa.table('schedule',
+    sa.column('id', sa.Integer), sa.column('site_id', sa.Integer),
+    sa.column('student_id', sa.Integer), sa.column('student_name', sa.String),
+    sa.column('machine_id', sa.Integer), sa.column('machine_name', sa.String),
+    sa.column('start_time', sa.DateTime), sa.column('end_time', sa.DateTime),
+)
+macroplan = sa.table('macroplan',
+    sa.column('id', sa.Integer), sa.column('site_id', sa.Integer),
+    sa.column('machine_id', sa.Integer), sa.column('machine_name', sa.String),
+)
+machine_maintenance = sa.table('machine_maintenance',
+    sa.column('id', sa.Integer), sa.column('site_id', sa.Integer),
+    sa.column('machine_id', sa.Integer), sa.column('machine_name', sa.String),
+)
+participants = sa.table('schedule_participants',
+    sa.column('schedule_id', sa.Integer), sa.column('student_id', sa.Integer),
+)
+students = sa.table('students',
+    sa.column('id', sa.Integer), sa.column('student_name', sa.String), sa.column('site_id', sa.Integer),
+)
+machines = sa.table('machines',
+    sa.column('id', sa.Integer), sa.column('machine_name', sa.String), sa.column('site_id', sa.Integer),
+)
+usage = sa.table('rollup_student_machine_usage',
+    sa.column('site_id', sa.Integer), sa.column('student_id', sa.Integer), sa.column('student_name', sa.String),
+    sa.column('machine_name', sa.String), sa.column('slot_count', sa.Integer), sa.column('total_seconds', sa.Float),
+)
+
+
+def upgrade():
+    with op.batch_alter_table('schedule', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('student_id', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('machine_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_schedule_student_id', 'students', ['student_id'], ['id'])
+        batch_op.create_foreign_key('fk_schedule_machine_id', 'machines', ['machine_id'], ['id'])
+        batch_op.create_index('ix_schedule_student_id', ['student_id'], unique=False)
+        batch_op.create_index('ix_schedule_machine_id', ['machine_id'], unique=False)
+
+    with op.batch_alter_table('schedule_run_rows', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('student_id', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('machine_id', sa.Integer(), nullable=True))
+
+    with op.batch_alter_table('macroplan', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('machine_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_macroplan_machine_id', 'machines', ['machine_id'], ['id'])
+        batch_op.create_index('ix_macroplan_machine_id', ['machine_id'], unique=False)
+
+    with op.batch_alter_table('machine_maintenance', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('machine_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_machine_maintenance_machine_id', 'machines', ['machine_id'], ['id'])
+        batch_op.create_index('ix_machine_maintenance_machine_id', ['machine_id'], unique=False)
+
+    # Rollup rows are now keyed by student_id as well
+    with op.batch_alter_table('rollup_student_machine_usage', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('student_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_rollup_student_machine_usage_student_id', 'students', ['student_id'], ['id'])
+        batch_op.create_index('ix_rollup_student_machine_usage_student_id', ['student_id'], unique=False)
+        batch_op.drop_constraint('uq_rollup_student_machine_usage', type_='unique')
+        batch_op.create_unique_constraint('uq_rollup_student_machine_usage',
+                                          ['site_id', 'student_id', 'student_name', 'machine_name'])
+
+    bind = op.get_bind()
+    link_rows(bind)
+    rebuild_student_machine_usage(bind, by_student=True)
+
+
+def link_rows(bind):
+    """Fill the new id columns from the names, in batches, with the
+    resolvers backfill_schedule_links.py uses: "AGT21006 Maila Frans"
+    matches on number and name, and only records of the row's own site
+    count. Ambiguous or unknown names stay NULL.
+    """
+    from resolvers import StudentResolver, MachineResolver
+
+    # student_number is added by a script, not a migration
+    has_number = any(column['name'] == 'student_number' for column in sa.inspect(bind).get_columns('students'))
+    number = sa.column('student_number') if has_number else sa.null()
+    student_resolver = StudentResolver(bind.execute(sa.select(
+        students.c.id, students.c.student_name, number.label('student_number'), students.c.site_id
+    ).select_from(students)).all())
+    machine_resolver = MachineResolver(bind.execute(
+        sa.select(machines.c.id, machines.c.machine_name, machines.c.site_id)
+    ).all())
+    for table, links in (
+        (schedule, {'student_id': ('student_name', student_resolver),
+                    'machine_id': ('machine_name', machine_resolver)}),
+        (macroplan, {'machine_id': ('machine_name', machine_resolver)}),
+        (machine_maintenance, {'machine_id': ('machine_name', machine_resolver)}),
+    ):
+        columns = [table.c[name] for name, _ in links.values()]
+        statement = table.update().where(table.c.id == sa.bindparam('row_id')).values(
+            {id_column: sa.bindparam(id_column) for id_column in links}
+        )
+        last_id = 0
+        while True:
+            rows = bind.execute(
+                sa.select(table.c.id, table.c.site_id, *columns)
+                .where(table.c.id > last_id).order_by(table.c.id).limit(BATCH_SIZE)
+            ).all()
+            if not rows:
+                break
+            updates = []
+            for row_id, site_id, *names in rows:
+                resolved = {id_column: resolver.resolve(name, site_id)
+                            for (id_column, (_, resolver)), name in zip(links.items(), names)}
+                if any(resolved.values()):
+                    updates.append(dict(resolved, row_id=row_id))
+            if updates:
+                bind.execute(statement, updates)
+            last_id = rows[-1][0]
+
+
+def rebuild_student_machine_usage(bind, by_student):
+    """Recount the student machine usage rollup from the schedule, every
+    participant of a shared session included, per student_id as well as
+    name when ``by_student``"""
+    totals = {}
+    own = sa.select(schedule.c.site_id, schedule.c.student_id, schedule.c.student_name,
+                    schedule.c.machine_name, schedule.c.start_time, schedule.c.end_time)
+    shared = sa.select(schedule.c.site_id, students.c.id, students.c.student_name,
+                       schedule.c.machine_name, schedule.c.start_time, schedule.c.end_time).select_from(
+        participants.join(schedule, schedule.c.id == participants.c.schedule_id)
+        .join(students, students.c.id == participants.c.student_id))
+    for query in (own, shared):
+        for site_id, student_id, student_name, machine_name, start_time, end_time in bind.execute(query):
+            key = (site_id, student_id if by_student else None, student_name, machine_name)
+            slot_count, seconds = totals.get(key, (0, 0.0))
+            if start_time and end_time:
+                seconds += (end_time - start_time).total_seconds()
+            totals[key] = (slot_count + 1, seconds)
+
+    rows = [{'site_id': site_id, 'student_id': student_id, 'student_name': student_name,
+             'machine_name': machine_name, 'slot_count': slot_count, 'total_seconds': seconds}
+            for (site_id, student_id, student_name, machine_name), (slot_count, seconds) in totals.items()]
+    bind.execute(usage.delete())
+    for i in range(0, len(rows), BATCH_SIZE):
+        bind.execute(usage.insert(), rows[i:i + BATCH_SIZE])
+
+
+def downgrade():
+    rebuild_student_machine_usage(op.get_bind(), by_student=False)
+
+    with op.batch_alter_table('rollup_student_machine_usage', schema=None) as batch_op:
+        batch_op.drop_constraint('uq_rollup_student_machine_usage', type_='unique')
+        batch_op.create_unique_constraint('uq_rollup_student_machine_usage', ['site_id', 'student_name', 'machine_name'])
+        batch_op.drop_index('ix_rollup_student_machine_usage_student_id')
+        batch_op.drop_constraint('fk_rollup_student_machine_usage_student_id', type_='foreignkey')
+        batch_op.drop_column('student_id')
+
+    with op.batch_alter_table('machine_maintenance', schema=None) as batch_op:
+        batch_op.drop_index('ix_machine_maintenance_machine_id')
+        batch_op.drop_constraint('fk_machine_maintenance_machine_id', type_='foreignkey')
+        batch_op.drop_column('machine_id')
+
+    with op.batch_alter_table('macroplan', schema=None) as batch_op:
+        batch_op.drop_index('ix_macroplan_machine_id')
+        batch_op.drop_constraint('fk_macroplan_machine_id', type_='foreignkey')
+        batch_op.drop_column('machine_id')
+
+    with op.batch_alter_table('schedule_run_rows', schema=None) as batch_op:
+        batch_op.drop_column('machine_id')
+        batch_op.drop_column('student_id')
+
+    with op.batch_alter_table('schedule', schema=None) as batch_op:
+        batch_op.drop_index('ix_schedule_machine_id')
+        batch_op.drop_index('ix_schedule_student_id')
+        batch_op.drop_constraint('fk_schedule_machine_id', type_='foreignkey')
+        batch_op.drop_constraint('fk_schedule_student_id', type_='foreignkey')
+        batch_op.drop_column('machine_id')
+        batch_op.drop_column('student_id')
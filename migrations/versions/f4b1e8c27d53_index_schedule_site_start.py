@@ -0,0 +1,26 @@
+"""Index schedule rows by site and start time for the audit sweep
+
+Revision ID: f4b1e8c27d53
+Revises: e2a7c4d19b58
+Create Date: 2026-10-18 14:41:52.210384
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f4b1e8c27d53'
+down_revision = 'e2a7c4d19b58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('schedule', schema=None) as batch_op:
+        batch_op.create_index('ix_schedule_site_start', ['site_id', 'start_time'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('schedule', schema=None) as batch_op:
+        batch_op.drop_index('ix_schedule_site_start')
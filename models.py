@@ -2,6 +2,7 @@
 
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
+import json
 
 db = SQLAlchemy()
 
@@ -83,6 +84,12 @@ class Student(db.Model):
     # Many-to-many relationship with modules
     enrolled_modules = db.relationship("Module", secondary=student_module_enrollment, backref="enrolled_students")
 
+    # Serve the paginated students list
+    __table_args__ = (
+        db.Index('ix_students_site_name', 'site_id', 'student_name'),
+        db.Index('ix_students_group_id', 'group_id'),
+    )
+
     def __repr__(self):
         return f"<Student {self.id} - {self.student_number} {self.student_name}>"
 
@@ -107,6 +114,7 @@ class Module(db.Model):
     category = db.Column(db.String(100))  # FUNDAMENTALS, TOOLING U, THEORY MODULES, PRACTICAL MODULES
     status_type = db.Column(db.String(20))  # P/NYP or C/NYC
     credits = db.Column(db.String(20))  # e.g., "75%", "60%"
+    level = db.Column(db.String(50))  # Machine level the module needs, e.g. "Level I"
 
     # Relationship to MiniTask with cascade delete
     mini_tasks = db.relationship("MiniTask", backref="module", lazy=True, cascade="all, delete-orphan")
@@ -165,6 +173,11 @@ class StudentMiniTaskProgress(db.Model):
     error_logs = db.relationship("ErrorLog", backref="student_minitask", lazy=True)
     attempts = db.relationship("Attempt", backref="progress", lazy=True, cascade="all, delete-orphan")
 
+    __table_args__ = (
+        # Latest progress per student: newest id within each student
+        db.Index('ix_student_mini_task_progress_student', 'student_id', 'id'),
+    )
+
     def __repr__(self):
         return f"<StudentMiniTaskProgress ID={self.id} Student={self.student_id} Task={self.mini_task_id}>"
 
@@ -252,6 +265,12 @@ class InventoryUsage(db.Model):
     unit_cost = db.Column(db.Float, default=0.0)
     date_issued = db.Column(db.DateTime, default=datetime.utcnow)
 
+    # Resolved links; student_name/consumable are kept as issued for display
+    student_id = db.Column(db.Integer, db.ForeignKey('students.id'), nullable=True, index=True)
+    inventory_id = db.Column(db.Integer, db.ForeignKey('inventory.id'), nullable=True, index=True)
+    student = db.relationship('Student', backref='inventory_usage')
+    item = db.relationship('Inventory', backref='usage')
+
     # Optional: Link to mini-task progress
     student_task_id = db.Column(db.Integer, db.ForeignKey('student_mini_task_progress.id'))
     task = db.relationship('StudentMiniTaskProgress', backref='inventory_usage')
@@ -277,6 +296,10 @@ class MachineMaintenance(db.Model):
     performed_by = db.Column(db.String(255))
     notes = db.Column(db.Text)
 
+    # Resolved link; machine_name is kept as entered for display
+    machine_id = db.Column(db.Integer, db.ForeignKey('machines.id'), nullable=True, index=True)
+    machine = db.relationship('Machine', backref='maintenance_logs')
+
 # MACRO PLAN
 class MacroPlan(db.Model):
     __tablename__ = "macroplan"
@@ -289,6 +312,10 @@ class MacroPlan(db.Model):
     installed_capacity = db.Column(db.Float, default=0.0)
     usage = db.Column(db.Float, default=0.0)
 
+    # Resolved link; machine_name is kept as entered for display
+    machine_id = db.Column(db.Integer, db.ForeignKey('machines.id'), nullable=True, index=True)
+    machine = db.relationship('Machine', backref='macro_plans')
+
 # SCHEDULE
 class Schedule(db.Model):
     __tablename__ = "schedule"
@@ -304,5 +331,202 @@ class Schedule(db.Model):
     session_type = db.Column(db.String(50), default='practical')  # practical, practical_test, written_test
     capacity = db.Column(db.Integer, default=1)  # For tests with multiple students
     notes = db.Column(db.Text)
+    run_id = db.Column(db.Integer, db.ForeignKey('schedule_runs.id'), nullable=True)  # Generation run that published it
+
+    # Resolved links; student_name/group_name/machine_name are kept as booked for display
+    student_id = db.Column(db.Integer, db.ForeignKey('students.id'), nullable=True)
+    machine_id = db.Column(db.Integer, db.ForeignKey('machines.id'), nullable=True)
+    student = db.relationship('Student', backref='schedule_slots')
+    machine = db.relationship('Machine', backref='schedule_slots')
+
+    # Students sharing the session besides the one named above
+    participants = db.relationship("ScheduleParticipant", backref="schedule", lazy=True, cascade="all, delete-orphan")
+
+    __table_args__ = (
+        db.Index('ix_schedule_site_start', 'site_id', 'start_time'),
+        db.Index('ix_schedule_run_id', 'run_id'),
+        db.Index('ix_schedule_student_id', 'student_id'),
+        db.Index('ix_schedule_machine_id', 'machine_id'),
+    )
+
+    @property
+    def student_names(self):
+        """Everyone booked in the slot: the named student first"""
+        return [self.student_name] + [p.student.student_name for p in self.participants]
+
+class ScheduleParticipant(db.Model):
+    """Another student in a shared test session; the Schedule row names the first"""
+    __tablename__ = "schedule_participants"
+    id = db.Column(db.Integer, primary_key=True)
+    schedule_id = db.Column(db.Integer, db.ForeignKey('schedule.id'), nullable=False)
+    student_id = db.Column(db.Integer, db.ForeignKey('students.id'), nullable=False)
+
+    student = db.relationship("Student", backref=db.backref("session_participations", cascade="all, delete-orphan"))
+
+    __table_args__ = (
+        db.UniqueConstraint('schedule_id', 'student_id', name='uq_schedule_participant'),
+        db.Index('ix_schedule_participants_student', 'student_id'),
+    )
+
+class ScheduleRun(db.Model):
+    """One schedule generation: staged, then published in one short transaction"""
+    __tablename__ = "schedule_runs"
+    id = db.Column(db.Integer, primary_key=True)
+    site_id = db.Column(db.Integer, db.ForeignKey('sites.id'), nullable=True, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    generator = db.Column(db.String(50))  # 'basic', 'advanced'
+    status = db.Column(db.String(20), nullable=False, default='staged')  # staged, published, failed, rolled_back, expired
+    window_start = db.Column(db.DateTime)
+    window_end = db.Column(db.DateTime)
+    row_count = db.Column(db.Integer, default=0)
+    replaced_count = db.Column(db.Integer, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    published_at = db.Column(db.DateTime)
+    rolled_back_at = db.Column(db.DateTime)
+
+class ScheduleRunRow(db.Model):
+    """Staged schedule rows of a run, and the live rows its publish replaced"""
+    __tablename__ = "schedule_run_rows"
+    id = db.Column(db.Integer, primary_key=True)
+    run_id = db.Column(db.Integer, db.ForeignKey('schedule_runs.id'), nullable=False)
+    kind = db.Column(db.String(10), nullable=False)  # 'new', 'replaced'
+    origin_run_id = db.Column(db.Integer, nullable=True)  # run_id a replaced row had when live
+    schedule_id = db.Column(db.Integer, nullable=True)  # Schedule id a replaced row had when live
+    student_id = db.Column(db.Integer, nullable=True)  # No foreign keys: archived rows outlive students and machines
+    machine_id = db.Column(db.Integer, nullable=True)
+    student_name = db.Column(db.String(255), nullable=False)
+    site_id = db.Column(db.Integer, nullable=True)
+    group_name = db.Column(db.String(255))
+    machine_name = db.Column(db.String(255))
+    module_name = db.Column(db.String(255))
+    start_time = db.Column(db.DateTime)
+    end_time = db.Column(db.DateTime)
+    extra_time = db.Column(db.Integer, default=0)
+    session_type = db.Column(db.String(50), default='practical')
+    capacity = db.Column(db.Integer, default=1)
+    notes = db.Column(db.Text)
 
+    __table_args__ = (
+        db.Index('ix_schedule_run_rows_run_kind', 'run_id', 'kind'),
+    )
 
+class ScheduleRunParticipant(db.Model):
+    """Other participants of a shared session in the staging table"""
+    __tablename__ = "schedule_run_participants"
+    id = db.Column(db.Integer, primary_key=True)
+    row_id = db.Column(db.Integer, db.ForeignKey('schedule_run_rows.id'), nullable=False)
+    student_id = db.Column(db.Integer, nullable=False)  # No foreign key: archived rows outlive students
+
+    __table_args__ = (
+        db.Index('ix_schedule_run_participants_row', 'row_id'),
+    )
+
+
+
+
+# DASHBOARD ROLLUPS
+# Pre-aggregated totals for the home page, kept in step with Schedule and
+# InventoryUsage by rollups.py. Rebuild with `python rebuild_rollups.py`.
+class MachineUsageDaily(db.Model):
+    """Booked machine time per site, machine and day"""
+    __tablename__ = "rollup_machine_usage_daily"
+    id = db.Column(db.Integer, primary_key=True)
+    site_id = db.Column(db.Integer, db.ForeignKey('sites.id'), nullable=True)
+    day = db.Column(db.Date, nullable=False)
+    machine_name = db.Column(db.String(255))
+    slot_count = db.Column(db.Integer, default=0)
+    total_seconds = db.Column(db.Float, default=0.0)
+
+    __table_args__ = (
+        db.UniqueConstraint('site_id', 'day', 'machine_name', name='uq_rollup_machine_usage_daily'),
+    )
+
+class StudentMachineUsage(db.Model):
+    """Booked machine time per site, student and machine (all time)"""
+    __tablename__ = "rollup_student_machine_usage"
+    id = db.Column(db.Integer, primary_key=True)
+    site_id = db.Column(db.Integer, db.ForeignKey('sites.id'), nullable=True)
+    student_id = db.Column(db.Integer, db.ForeignKey('students.id'), nullable=True, index=True)
+    student_name = db.Column(db.String(255))
+    machine_name = db.Column(db.String(255))
+    slot_count = db.Column(db.Integer, default=0)
+    total_seconds = db.Column(db.Float, default=0.0)
+
+    __table_args__ = (
+        db.UniqueConstraint('site_id', 'student_id', 'student_name', 'machine_name',
+                            name='uq_rollup_student_machine_usage'),
+    )
+
+class ConsumableUsageDaily(db.Model):
+    """Consumables issued per site, consumable and day"""
+    __tablename__ = "rollup_consumable_usage_daily"
+    id = db.Column(db.Integer, primary_key=True)
+    site_id = db.Column(db.Integer, db.ForeignKey('sites.id'), nullable=True)
+    day = db.Column(db.Date, nullable=False)
+    consumable = db.Column(db.String(255))
+    entry_count = db.Column(db.Integer, default=0)
+    quantity = db.Column(db.Integer, default=0)
+    cost = db.Column(db.Float, default=0.0)
+
+    __table_args__ = (
+        db.UniqueConstraint('site_id', 'day', 'consumable', name='uq_rollup_consumable_usage_daily'),
+    )
+
+class StudentSpend(db.Model):
+    """Consumables issued per site, student and consumable (all time).
+
+    Group spend is derived from this at read time so moving a student to
+    another group never leaves stale group totals behind.
+    """
+    __tablename__ = "rollup_student_spend"
+    id = db.Column(db.Integer, primary_key=True)
+    site_id = db.Column(db.Integer, db.ForeignKey('sites.id'), nullable=True)
+    student_id = db.Column(db.Integer, db.ForeignKey('students.id'), nullable=True, index=True)
+    student_name = db.Column(db.String(255))
+    consumable = db.Column(db.String(255))
+    entry_count = db.Column(db.Integer, default=0)
+    quantity = db.Column(db.Integer, default=0)
+    cost = db.Column(db.Float, default=0.0)
+
+    __table_args__ = (
+        db.UniqueConstraint('site_id', 'student_id', 'student_name', 'consumable', name='uq_rollup_student_spend'),
+    )
+
+
+# BACKGROUND JOBS
+class ImportJob(db.Model):
+    """A confirmed spreadsheet import, run off the request thread by jobs.py"""
+    __tablename__ = "import_jobs"
+    id = db.Column(db.Integer, primary_key=True)
+    site_id = db.Column(db.Integer, db.ForeignKey('sites.id'), nullable=True, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    kind = db.Column(db.String(50), nullable=False)  # 'students', 'machines'
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    phase = db.Column(db.String(50))  # e.g. 'reading', 'importing'
+    filename = db.Column(db.String(255))
+    params = db.Column(db.Text)  # JSON: header row, intake group, selected fields...
+    rows_total = db.Column(db.Integer)
+    rows_processed = db.Column(db.Integer, default=0)
+    added = db.Column(db.Integer, default=0)
+    updated = db.Column(db.Integer, default=0)
+    errors = db.Column(db.Text)  # JSON list of messages
+    message = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'phase': self.phase,
+            'rows_total': self.rows_total,
+            'rows_processed': self.rows_processed or 0,
+            'added': self.added or 0,
+            'updated': self.updated or 0,
+            'errors': json.loads(self.errors) if self.errors else [],
+            'message': self.message,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
@@ -0,0 +1,44 @@
+"""
+Dashboard Rollup Maintenance
+============================
+Backfills the dashboard rollup tables from Schedule and InventoryUsage, or
+checks that the stored rollups still match the raw data.
+
+Usage:
+    python rebuild_rollups.py                 # rebuild every site
+    python rebuild_rollups.py --site 2        # rebuild one site
+    python rebuild_rollups.py --check         # compare only, exit 1 on drift
+"""
+
+import sys
+from app import app
+from rollups import rebuild_rollups, check_rollups
+
+def main(args):
+    site_id = None
+    if '--site' in args:
+        site_id = int(args[args.index('--site') + 1])
+
+    with app.app_context():
+        scope = f"site {site_id}" if site_id is not None else "all sites"
+
+        if '--check' in args:
+            print(f"Checking dashboard rollups for {scope}...")
+            problems = check_rollups(site_id)
+            for problem in problems[:50]:
+                print(f"  ✗ {problem}")
+            if len(problems) > 50:
+                print(f"  ...and {len(problems) - 50} more")
+            if problems:
+                print(f"\n✗ {len(problems)} discrepancies found. Run without --check to rebuild.")
+                return 1
+            print("✓ Rollups match the raw data")
+            return 0
+
+        print(f"Rebuilding dashboard rollups for {scope}...")
+        written = rebuild_rollups(site_id)
+        print(f"✓ Wrote {written} rollup rows")
+        return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,8 +1,9 @@
 # reports.py
 from flask import Blueprint, render_template, request, jsonify, send_file, session
 from flask_login import login_required, current_user
-from models import db, Site, Student, Machine, Module, Lecturer, Group, Schedule, Inventory, InventoryUsage, StudentMiniTaskProgress, MiniTask
+from models import db, Site, Student, Machine, Module, Lecturer, Group, Schedule, ScheduleParticipant, Inventory, InventoryUsage, StudentMiniTaskProgress, MiniTask
 from auth_models import DynamicField, DynamicFieldValue
+from dynamic_values import load_dynamic_values, dynamic_values_frame
 from functools import wraps
 from flask import flash, redirect, url_for
 
@@ -35,6 +36,7 @@ def require_site_access(f):
         return f(*args, **kwargs)
     return decorated_function
 from sqlalchemy import func, case, extract
+from sqlalchemy.orm import selectinload
 import pandas as pd
 import plotly.graph_objs as go
 import plotly.io as pio
@@ -346,12 +348,11 @@ def generate_machine_utilization_report(filters, chart_type):
     
     # Apply machine filters (multiple machines)
     if filters.get('machine_ids'):
-        # Filter by machine names - need to look up machine names from IDs
-        machine_names = [Machine.query.get(mid).machine_name for mid in filters['machine_ids'] if Machine.query.get(mid)]
-        if machine_names:
-            query = query.filter(Schedule.machine_name.in_(machine_names))
+        query = query.filter(Schedule.machine_id.in_(filters['machine_ids']))
     
-    schedules = query.all()
+    schedules = query.options(
+        selectinload(Schedule.participants).selectinload(ScheduleParticipant.student)
+    ).all()
     
     data = []
     machine_hours = {}
@@ -371,7 +372,7 @@ def generate_machine_utilization_report(filters, chart_type):
         
         data.append({
             'Machine': machine_name,
-            'Student': schedule.student_name or 'N/A',
+            'Student': ', '.join(schedule.student_names) or 'N/A',
             'Group': schedule.group_name or 'N/A',
             'Start Time': schedule.start_time.strftime('%Y-%m-%d %H:%M') if schedule.start_time else 'N/A',
             'End Time': schedule.end_time.strftime('%Y-%m-%d %H:%M') if schedule.end_time else 'N/A',
@@ -422,7 +423,9 @@ def generate_schedule_analysis_report(filters, chart_type):
     if site_id:
         query = query.filter(Schedule.site_id == site_id)
     
-    schedules = query.all()
+    schedules = query.options(
+        selectinload(Schedule.participants).selectinload(ScheduleParticipant.student)
+    ).all()
     
     data = []
     day_counts = {}
@@ -437,7 +440,7 @@ def generate_schedule_analysis_report(filters, chart_type):
         data.append({
             'Date': schedule.start_time.strftime('%Y-%m-%d') if schedule.start_time else 'N/A',
             'Day': day,
-            'Student': schedule.student_name or 'N/A',
+            'Student': ', '.join(schedule.student_names) or 'N/A',
             'Group': schedule.group_name or 'N/A',
             'Machine': schedule.machine_name or 'N/A',
             'Start Time': schedule.start_time.strftime('%H:%M') if schedule.start_time else 'N/A',
@@ -767,19 +770,14 @@ def generate_demographic_analysis_report(filters, chart_type):
     dynamic_fields = DynamicField.query.filter_by(model_name='Student').all()
     
     # Get demographic data
+    values = dynamic_values_frame('Student', [s.id for s in students], dynamic_fields)
     demographics = {}
-    for field in dynamic_fields:
-        field_values = []
-        for student in students:
-            field_value = DynamicFieldValue.query.filter_by(
-                field_id=field.id,
-                record_id=student.id
-            ).first()
-            if field_value and field_value.value:
-                field_values.append(field_value.value)
+    for field_name in values.columns:
+        column = values[field_name]
+        field_values = column[column.notna() & (column != '')]
         
-        if field_values:
-            demographics[field.field_name] = Counter(field_values)
+        if not field_values.empty:
+            demographics[field_name] = Counter(field_values)
     
     # Create data for the first demographic field
     data = []
@@ -1055,16 +1053,8 @@ def generate_custom_field_analysis_report(filters, chart_type):
     
     # Analyze first custom field
     field = dynamic_fields[0]
-    field_distribution = defaultdict(int)
-    
-    for student in students:
-        field_value = DynamicFieldValue.query.filter_by(
-            field_id=field.id,
-            record_id=student.id
-        ).first()
-        
-        if field_value and field_value.value:
-            field_distribution[field_value.value] += 1
+    values = dynamic_values_frame('Student', [s.id for s in students], [field])[field.field_name]
+    field_distribution = values[values.notna() & (values != '')].value_counts().to_dict()
     
     data = [{
         'Value': value,
@@ -1297,6 +1287,8 @@ def generate_custom_report(filters, chart_type):
     students = query.all()
     modules = Module.query.all()
     groups = Group.query.all()
+    dynamic_fields = DynamicField.query.filter_by(model_name='Student').all()
+    dynamic_data = load_dynamic_values('Student', [s.id for s in students], dynamic_fields)
     
     # Build custom data based on what's requested
     data = []
@@ -1320,15 +1312,12 @@ def generate_custom_report(filters, chart_type):
             row['Pass Rate (%)'] = 0
         
         # Get dynamic fields including demographics
-        dynamic_fields = DynamicField.query.filter_by(model_name='Student').all()
+        student_values = dynamic_data.get(student.id, {})
         for field in dynamic_fields:
-            field_value = DynamicFieldValue.query.filter_by(
-                field_id=field.id,
-                record_id=student.id
-            ).first()
-            row[field.field_name.replace('_', ' ').title()] = field_value.value if field_value else 'N/A'
+            value = student_values.get(field.field_name, 'N/A')
+            row[field.field_name.replace('_', ' ').title()] = value
             # Store raw field name too
-            row[field.field_name] = field_value.value if field_value else 'N/A'
+            row[field.field_name] = value
         
         data.append(row)
     
@@ -0,0 +1,212 @@
+"""
+Name resolvers
+==============
+Older rows identify students, machines and inventory items by free text
+only, e.g. InventoryUsage.student_name = "AGT21006 Maila Frans" or
+Schedule.machine_name. The resolvers here map that text onto real ids so
+queries can use indexed equality joins, and the backfill functions apply
+them to historical rows in batches.
+"""
+import re
+from collections import defaultdict
+
+from sqlalchemy import or_, update
+
+from models import db, Student, Machine, Inventory, InventoryUsage, Schedule, MacroPlan, MachineMaintenance
+
+# A student number token such as "AGT21006": letters and digits, at least one digit
+STUDENT_NUMBER = re.compile(r'^(?=.*\d)[a-z0-9]+$')
+
+
+def normalize(text):
+    """Case- and whitespace-insensitive form of a name for matching"""
+    if text is None:
+        return ""
+    return " ".join(str(text).split()).casefold()
+
+
+class _Index:
+    """Lookup from a normalized name to record ids, optionally per site"""
+
+    def __init__(self):
+        self.ids = defaultdict(set)
+        self.site_of = {}
+
+    def add(self, key, record_id, site_id):
+        key = normalize(key)
+        if key:
+            self.ids[key].add(record_id)
+            self.site_of[record_id] = site_id
+
+    def find(self, key, site_id=None):
+        """Return the single matching id on the given site (on any site when
+        ``site_id`` is None), else None"""
+        candidates = self.ids.get(normalize(key), set())
+        if site_id is not None:
+            candidates = {c for c in candidates if self.site_of.get(c) == site_id}
+        if len(candidates) == 1:
+            return next(iter(candidates))
+        return None
+
+
+class StudentResolver:
+    """Resolve free-text student names to Student ids.
+
+    Handles plain names ("Maila Frans"), number-prefixed names
+    ("AGT21006 Maila Frans") and bare student numbers. Ambiguous names
+    (two students called the same thing on the same site) are left
+    unresolved rather than guessed.
+    """
+
+    def __init__(self, students=None):
+        if students is None:
+            students = db.session.query(
+                Student.id, Student.student_name, Student.student_number, Student.site_id
+            ).all()
+        self.by_name = _Index()
+        self.by_number = _Index()
+        self.by_full_name = _Index()
+        for s in students:
+            self.by_name.add(s.student_name, s.id, s.site_id)
+            self.by_number.add(s.student_number, s.id, s.site_id)
+            if s.student_number:
+                self.by_full_name.add(f"{s.student_number} {s.student_name}", s.id, s.site_id)
+
+    def resolve(self, text, site_id=None):
+        if not normalize(text):
+            return None
+
+        student_id = (self.by_full_name.find(text, site_id) or
+                      self.by_name.find(text, site_id) or
+                      self.by_number.find(text, site_id))
+        if student_id:
+            return student_id
+
+        # "AGT21006 Maila Frans" where the number is not on the student record;
+        # any other two-word text ("Maila Frans") is not a number plus a name
+        parts = normalize(text).split(" ", 1)
+        if len(parts) == 2 and STUDENT_NUMBER.match(parts[0]):
+            return self.by_number.find(parts[0], site_id) or self.by_name.find(parts[1], site_id)
+        return None
+
+
+class InventoryResolver:
+    """Resolve consumable names to Inventory ids"""
+
+    def __init__(self, items=None):
+        if items is None:
+            items = db.session.query(Inventory.id, Inventory.item_name, Inventory.site_id).all()
+        self.by_name = _Index()
+        for item in items:
+            self.by_name.add(item.item_name, item.id, item.site_id)
+
+    def resolve(self, text, site_id=None):
+        return self.by_name.find(text, site_id)
+
+
+class MachineResolver:
+    """Resolve machine names to Machine ids"""
+
+    def __init__(self, machines=None):
+        if machines is None:
+            machines = db.session.query(Machine.id, Machine.machine_name, Machine.site_id).all()
+        self.by_name = _Index()
+        for machine in machines:
+            self.by_name.add(machine.machine_name, machine.id, machine.site_id)
+
+    def resolve(self, text, site_id=None):
+        return self.by_name.find(text, site_id)
+
+
+def _backfill(model, links, stats, batch_size, progress):
+    """Fill unresolved link columns of ``model`` in batches.
+
+    ``links`` maps each id column to ``(text column, resolver, label)``.
+    Walks rows with any link still NULL by id, one bulk UPDATE and commit
+    per batch, and counts ``<label>_resolved`` / ``<label>_unresolved``
+    into ``stats``. Rows whose names cannot be resolved unambiguously stay
+    NULL.
+    """
+    id_columns = list(links)
+    columns = [model.id, model.site_id]
+    for id_column, (text_column, _, _) in links.items():
+        columns += [getattr(model, id_column), getattr(model, text_column)]
+
+    last_id = 0
+    while True:
+        rows = db.session.query(*columns).filter(
+            model.id > last_id,
+            or_(*[getattr(model, name).is_(None) for name in id_columns])
+        ).order_by(model.id).limit(batch_size).all()
+        if not rows:
+            break
+
+        updates = []
+        for row in rows:
+            resolved = {}
+            for id_column, (text_column, resolver, label) in links.items():
+                resolved[id_column] = getattr(row, id_column)
+                if resolved[id_column] is None:
+                    resolved[id_column] = resolver.resolve(getattr(row, text_column), row.site_id)
+                    stats[f'{label}_resolved' if resolved[id_column] else f'{label}_unresolved'] += 1
+            if any(resolved[name] != getattr(row, name) for name in id_columns):
+                updates.append({'id': row.id, **resolved})
+
+        if updates:
+            db.session.execute(update(model), updates)
+        db.session.commit()
+
+        stats['rows'] += len(rows)
+        last_id = rows[-1].id
+        if progress:
+            progress(stats)
+    return stats
+
+
+def backfill_inventory_usage(batch_size=1000, progress=None):
+    """Fill InventoryUsage.student_id / inventory_id for historical rows.
+
+    Walks unresolved rows by id in batches, one bulk UPDATE and commit per
+    batch. Rows whose names cannot be resolved unambiguously stay NULL.
+    Returns counts of resolved and unresolved links.
+    """
+    from rollups import rebuild_rollups, INVENTORY_ROLLUPS
+
+    stats = {'rows': 0, 'students_resolved': 0, 'students_unresolved': 0,
+             'items_resolved': 0, 'items_unresolved': 0}
+    _backfill(InventoryUsage, {
+        'student_id': ('student_name', StudentResolver(), 'students'),
+        'inventory_id': ('consumable', InventoryResolver(), 'items'),
+    }, stats, batch_size, progress)
+
+    # Bulk UPDATEs bypass the rollup events
+    rebuild_rollups(models=INVENTORY_ROLLUPS)
+    return stats
+
+
+def backfill_schedule_links(batch_size=1000, progress=None):
+    """Fill Schedule.student_id / machine_id, and MacroPlan and
+    MachineMaintenance machine_id, for historical rows.
+
+    Same batching as ``backfill_inventory_usage``: only rows with a link
+    still NULL are read, so it is safe to re-run. Returns counts per table.
+    """
+    from rollups import rebuild_rollups, SCHEDULE_ROLLUPS
+
+    students = StudentResolver()
+    machines = MachineResolver()
+    stats = {}
+    for model, links in (
+        (Schedule, {'student_id': ('student_name', students, 'students'),
+                    'machine_id': ('machine_name', machines, 'machines')}),
+        (MacroPlan, {'machine_id': ('machine_name', machines, 'machines')}),
+        (MachineMaintenance, {'machine_id': ('machine_name', machines, 'machines')}),
+    ):
+        counts = {'rows': 0}
+        for _, _, label in links.values():
+            counts.update({f'{label}_resolved': 0, f'{label}_unresolved': 0})
+        stats[model.__tablename__] = _backfill(model, links, counts, batch_size, progress)
+
+    # The student machine usage rollup is keyed by student_id
+    rebuild_rollups(models=SCHEDULE_ROLLUPS)
+    return stats
@@ -0,0 +1,323 @@
+"""
+Dashboard rollups
+=================
+Keeps the pre-aggregated tables behind the home page (see the DASHBOARD
+ROLLUPS section of models.py) in step with Schedule and InventoryUsage.
+
+Single-row writes are folded in from mapper events inside the same flush,
+so they commit or roll back together with the row that caused them. The
+other participants of a shared session count as slots of their own: their
+rows come and go with ScheduleParticipant and follow the session when it
+moves. Bulk
+statements such as ``Schedule.query.delete()`` bypass mapper events; fold
+their rows in with ``apply_bulk()``, or call ``rebuild_rollups()`` after
+them.
+"""
+from collections import defaultdict
+from types import SimpleNamespace
+
+from sqlalchemy import event, inspect, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from conflicts import schedule_bookings
+from models import (
+    db, Schedule, ScheduleParticipant, Student, InventoryUsage,
+    MachineUsageDaily, StudentMachineUsage, ConsumableUsageDaily, StudentSpend
+)
+
+SCHEDULE_ROLLUPS = (MachineUsageDaily, StudentMachineUsage)
+INVENTORY_ROLLUPS = (ConsumableUsageDaily, StudentSpend)
+
+# Columns that feed the rollups; changes to anything else are ignored
+SCHEDULE_COLUMNS = ('site_id', 'student_id', 'student_name', 'machine_name', 'start_time', 'end_time')
+INVENTORY_COLUMNS = ('site_id', 'student_id', 'student_name', 'consumable', 'quantity', 'unit_cost', 'date_issued')
+
+# Key columns and additive value columns for each rollup table
+ROLLUP_KEYS = {
+    MachineUsageDaily: ('site_id', 'day', 'machine_name'),
+    StudentMachineUsage: ('site_id', 'student_id', 'student_name', 'machine_name'),
+    ConsumableUsageDaily: ('site_id', 'day', 'consumable'),
+    StudentSpend: ('site_id', 'student_id', 'student_name', 'consumable'),
+}
+ROLLUP_VALUES = {
+    MachineUsageDaily: ('slot_count', 'total_seconds'),
+    StudentMachineUsage: ('slot_count', 'total_seconds'),
+    ConsumableUsageDaily: ('entry_count', 'quantity', 'cost'),
+    StudentSpend: ('entry_count', 'quantity', 'cost'),
+}
+# A rollup row whose counter drops to zero no longer represents anything
+ROLLUP_COUNTER = {
+    MachineUsageDaily: 'slot_count',
+    StudentMachineUsage: 'slot_count',
+    ConsumableUsageDaily: 'entry_count',
+    StudentSpend: 'entry_count',
+}
+
+
+##############################################
+# CONTRIBUTIONS
+##############################################
+def schedule_contributions(row):
+    """Rollup rows a single schedule slot contributes to.
+
+    ``row`` is anything with the SCHEDULE_COLUMNS as attributes (a Schedule
+    instance or a result row). Returns a list of (model, key, values).
+    """
+    seconds = 0.0
+    if row.start_time and row.end_time:
+        seconds = (row.end_time - row.start_time).total_seconds()
+
+    contributions = [(
+        StudentMachineUsage,
+        {'site_id': row.site_id, 'student_id': row.student_id, 'student_name': row.student_name,
+         'machine_name': row.machine_name},
+        {'slot_count': 1, 'total_seconds': seconds}
+    )]
+    if row.start_time:
+        contributions.append((
+            MachineUsageDaily,
+            {'site_id': row.site_id, 'day': row.start_time.date(), 'machine_name': row.machine_name},
+            {'slot_count': 1, 'total_seconds': seconds}
+        ))
+    return contributions
+
+def inventory_contributions(row):
+    """Rollup rows a single inventory usage record contributes to"""
+    quantity = row.quantity or 0
+    cost = quantity * (row.unit_cost or 0.0)
+
+    contributions = [(
+        StudentSpend,
+        {'site_id': row.site_id, 'student_id': row.student_id, 'student_name': row.student_name,
+         'consumable': row.consumable},
+        {'entry_count': 1, 'quantity': quantity, 'cost': cost}
+    )]
+    if row.date_issued:
+        contributions.append((
+            ConsumableUsageDaily,
+            {'site_id': row.site_id, 'day': row.date_issued.date(), 'consumable': row.consumable},
+            {'entry_count': 1, 'quantity': quantity, 'cost': cost}
+        ))
+    return contributions
+
+def _apply(connection, contributions, sign):
+    """Add (sign=1) or remove (sign=-1) contributions from the rollup tables"""
+    for model, key, values in contributions:
+        table = model.__table__
+        where = [table.c[name] == value for name, value in key.items()]
+        deltas = {name: table.c[name] + sign * value for name, value in values.items()}
+
+        result = connection.execute(table.update().where(*where).values(deltas))
+        if result.rowcount == 0 and sign > 0:
+            connection.execute(_insert_or_add(connection, model, key, values))
+        elif sign < 0:
+            counter = table.c[ROLLUP_COUNTER[model]]
+            connection.execute(table.delete().where(*where, counter <= 0))
+
+
+def _insert_or_add(connection, model, key, values):
+    """INSERT for a new rollup row that adds to the row instead when another
+    transaction inserted the same key first (ON CONFLICT DO UPDATE on
+    PostgreSQL and SQLite), so a race never fails the write behind it.
+
+    NULLs never conflict in a unique constraint, which is why ``_apply``
+    still tries its UPDATE first.
+    """
+    table = model.__table__
+    dialect = connection.dialect.name
+    if dialect not in ('postgresql', 'sqlite'):
+        return table.insert().values(**key, **values)
+    insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+    stmt = insert(table).values(**key, **values)
+    return stmt.on_conflict_do_update(
+        index_elements=list(ROLLUP_KEYS[model]),
+        set_={name: table.c[name] + stmt.excluded[name] for name in values}
+    )
+
+
+##############################################
+# MAPPER EVENTS
+##############################################
+def _has_changes(target, columns):
+    state = inspect(target)
+    return any(state.attrs[name].history.has_changes() for name in columns)
+
+def _stored_row(connection, model, columns, pk):
+    """Current database values for a row, read before the flush changes it"""
+    table = model.__table__
+    return connection.execute(
+        select(*[table.c[name] for name in columns]).where(table.c.id == pk)
+    ).first()
+
+def _listen(model, columns, contributions):
+    @event.listens_for(model, 'after_insert')
+    def after_insert(mapper, connection, target):
+        _apply(connection, contributions(target), 1)
+
+    @event.listens_for(model, 'before_update')
+    def before_update(mapper, connection, target):
+        if not _has_changes(target, columns):
+            return
+        old = _stored_row(connection, model, columns, target.id)
+        if old is not None:
+            _apply(connection, contributions(old), -1)
+        _apply(connection, contributions(target), 1)
+
+    @event.listens_for(model, 'before_delete')
+    def before_delete(mapper, connection, target):
+        old = _stored_row(connection, model, columns, target.id)
+        if old is not None:
+            _apply(connection, contributions(old), -1)
+
+_listen(Schedule, SCHEDULE_COLUMNS, schedule_contributions)
+_listen(InventoryUsage, INVENTORY_COLUMNS, inventory_contributions)
+
+def _participant_rows(connection, where):
+    """Stored slots of shared-session participants: the session's
+    SCHEDULE_COLUMNS with the participant's id and name"""
+    schedule, participant, student = Schedule.__table__, ScheduleParticipant.__table__, Student.__table__
+    own = {'student_id': participant.c.student_id, 'student_name': student.c.student_name}
+    columns = [own.get(name, schedule.c[name]) for name in SCHEDULE_COLUMNS]
+    return connection.execute(select(*columns).select_from(
+        participant.join(schedule, schedule.c.id == participant.c.schedule_id)
+        .join(student, student.c.id == participant.c.student_id)
+    ).where(where)).all()
+
+@event.listens_for(ScheduleParticipant, 'after_insert')
+def _participant_added(mapper, connection, target):
+    for row in _participant_rows(connection, ScheduleParticipant.id == target.id):
+        _apply(connection, schedule_contributions(row), 1)
+
+@event.listens_for(ScheduleParticipant, 'before_delete')
+def _participant_removed(mapper, connection, target):
+    for row in _participant_rows(connection, ScheduleParticipant.id == target.id):
+        _apply(connection, schedule_contributions(row), -1)
+
+@event.listens_for(Schedule, 'before_update')
+def _session_moved(mapper, connection, target):
+    """Move the other participants' slots along with an edited session"""
+    if not _has_changes(target, SCHEDULE_COLUMNS):
+        return
+    for row in _participant_rows(connection, ScheduleParticipant.schedule_id == target.id):
+        moved = {name: getattr(target, name) for name in SCHEDULE_COLUMNS}
+        _apply(connection, schedule_contributions(row), -1)
+        own = {'student_id': row.student_id, 'student_name': row.student_name}
+        _apply(connection, schedule_contributions(SimpleNamespace(**dict(moved, **own))), 1)
+
+
+##############################################
+# BULK STATEMENTS
+##############################################
+def apply_bulk(rows, contributions, sign=1):
+    """Fold rows written or deleted by a bulk statement into the rollups.
+
+    ``rows`` are the raw rows (anything with the source columns as
+    attributes) and ``contributions`` the matching function, e.g.
+    ``schedule_contributions``. Contributions are summed per rollup key
+    first, so each touched rollup row gets one statement. Runs in the
+    current transaction and does not commit.
+    """
+    totals = defaultdict(dict)
+    for row in rows:
+        for model, key, values in contributions(row):
+            bucket = totals[model].setdefault(tuple(key.items()), dict.fromkeys(values, 0))
+            for name, value in values.items():
+                bucket[name] += value
+
+    connection = db.session.connection()
+    _apply(connection, [
+        (model, dict(key), values)
+        for model, buckets in totals.items()
+        for key, values in buckets.items()
+    ], sign)
+
+
+##############################################
+# REBUILD & CONSISTENCY CHECK
+##############################################
+def _aggregate(source, columns, contributions, site_id=None):
+    """Aggregate raw rows of a table or subquery in Python, streaming them
+    from the database"""
+    totals = {target: defaultdict(lambda target=target: dict.fromkeys(ROLLUP_VALUES[target], 0))
+              for target in ROLLUP_KEYS}
+    query = db.session.query(*[source.c[name] for name in columns])
+    if site_id is not None:
+        query = query.filter(source.c.site_id == site_id)
+
+    for row in query.yield_per(5000):
+        for target, key, values in contributions(row):
+            bucket = totals[target][tuple(key[name] for name in ROLLUP_KEYS[target])]
+            for name, value in values.items():
+                bucket[name] += value
+    return totals
+
+def _raw_totals(site_id=None):
+    totals = _aggregate(schedule_bookings(), SCHEDULE_COLUMNS, schedule_contributions, site_id)
+    inventory = _aggregate(InventoryUsage.__table__, INVENTORY_COLUMNS, inventory_contributions, site_id)
+    for model in INVENTORY_ROLLUPS:
+        totals[model] = inventory[model]
+    return totals
+
+def _stored_totals(model, site_id=None):
+    query = model.query
+    if site_id is not None:
+        query = query.filter(model.site_id == site_id)
+    return {
+        tuple(getattr(r, name) for name in ROLLUP_KEYS[model]):
+            {name: getattr(r, name) or 0 for name in ROLLUP_VALUES[model]}
+        for r in query.all()
+    }
+
+def rebuild_rollups(site_id=None, models=None):
+    """Recompute rollup tables from the raw data.
+
+    Rebuilds every site when ``site_id`` is None. ``models`` limits the
+    rebuild to some tables (e.g. SCHEDULE_ROLLUPS after a bulk delete).
+    Returns the number of rollup rows written.
+    """
+    models = models or tuple(ROLLUP_KEYS)
+    if all(m in SCHEDULE_ROLLUPS for m in models):
+        totals = _aggregate(schedule_bookings(), SCHEDULE_COLUMNS, schedule_contributions, site_id)
+    elif all(m in INVENTORY_ROLLUPS for m in models):
+        totals = _aggregate(InventoryUsage.__table__, INVENTORY_COLUMNS, inventory_contributions, site_id)
+    else:
+        totals = _raw_totals(site_id)
+
+    written = 0
+    for model in models:
+        query = model.query
+        if site_id is not None:
+            query = query.filter(model.site_id == site_id)
+        query.delete(synchronize_session=False)
+
+        rows = [
+            {**dict(zip(ROLLUP_KEYS[model], key)), **values}
+            for key, values in totals[model].items()
+        ]
+        if rows:
+            db.session.execute(model.__table__.insert(), rows)
+        written += len(rows)
+
+    db.session.commit()
+    return written
+
+def check_rollups(site_id=None, tolerance=0.01):
+    """Compare rollup tables against aggregates of the raw tables.
+
+    Returns a list of human readable discrepancies; empty when consistent.
+    """
+    problems = []
+    raw = _raw_totals(site_id)
+    for model in ROLLUP_KEYS:
+        expected = raw[model]
+        stored = _stored_totals(model, site_id)
+        for key in set(expected) | set(stored):
+            want = expected.get(key)
+            have = stored.get(key)
+            if want is None:
+                problems.append(f"{model.__tablename__} {key}: unexpected row {have}")
+            elif have is None:
+                problems.append(f"{model.__tablename__} {key}: missing, expected {want}")
+            elif any(abs((have[name] or 0) - want[name]) > tolerance for name in want):
+                problems.append(f"{model.__tablename__} {key}: stored {have}, expected {want}")
+    return problems
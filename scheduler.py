@@ -0,0 +1,1331 @@
+"""
+Schedule generation
+===================
+Generators plan the whole schedule in memory and hand back plain row dicts;
+nothing touches the database until they are written in one bulk statement
+per batch (``stage_run``, or ``insert_schedule_rows`` straight into
+Schedule inside the caller's transaction).
+
+``simulate_many`` plans several parameter sets side by side on a process
+pool for the what-if mode; it reads nothing and writes nothing.
+
+When every order takes the same time, ``plan_round_robin`` and
+``plan_parallel`` lay slots out on the calendar's minute ``Timeline`` with
+NumPy instead of walking it one datetime at a time, so a year-long horizon
+costs a handful of array operations.
+
+``plan_gap_fill`` places sessions only into the free gaps left between the
+bookings that stay, instead of after the last of them.
+
+``repair_outage`` moves just the sessions a machine outage hits into the
+nearest free time, leaving the rest of the schedule in place.
+
+Regeneration only replaces a scope: one site's rows starting inside the
+date window, optionally narrowed to some groups, machines or students
+(``schedule_scope``). Rows outside it are never touched. Both the delete
+and the insert fold their rows into the dashboard rollups directly, since
+bulk statements bypass the rollup mapper events.
+
+Planners hand back one row per student. Shared test sessions are folded as
+they are written (``fold_sessions``): one Schedule row naming the first
+student, plus a ScheduleParticipant for each of the others. Written rows
+carry their student's and machine's ids (``link_machines`` fills in the
+machine from the name the planner chose).
+
+The routes never write planned rows straight into Schedule. They stage them
+under a ScheduleRun (``stage_run``, committed on its own), then publish in
+one short delete+insert transaction (``publish_run``), so readers see the
+previous complete schedule until the switch. Publishing archives the rows
+it replaces with the run; the latest published run of a site can be rolled
+back (``rollback_run``) while its rows are kept, which is for the last
+SCHEDULE_RUNS_KEPT runs.
+"""
+import heapq
+import os
+import random
+import time
+from bisect import bisect_right
+from collections import deque, Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, time as dtime, timedelta
+from types import SimpleNamespace
+
+import numpy as np
+from sqlalchemy import insert, func, select, literal, or_
+from sqlalchemy.orm import selectinload
+
+from conflicts import Booking, ConflictIndex, schedule_bookings
+from models import (
+    db, Schedule, ScheduleParticipant, ScheduleRun, ScheduleRunRow, ScheduleRunParticipant, Student, Group,
+    Machine
+)
+from rollups import apply_bulk, schedule_contributions, SCHEDULE_COLUMNS
+
+MINUTES_PER_DAY = 24 * 60
+
+# Rows per INSERT statement
+INSERT_BATCH_SIZE = 1000
+
+# Order keys used for planning only, never written to Schedule
+PLAN_KEYS = ('processing_time', 'levels')
+
+# Local search runs inside the request: seconds allowed, well under gunicorn's 30 s worker timeout
+MAX_TIME_BUDGET = 10
+
+# What-if scenarios per request, and the processes planning them
+MAX_SCENARIOS = 12
+SIMULATION_WORKERS = int(os.environ.get("SIMULATION_WORKERS", min(os.cpu_count() or 1, 4)))
+
+# How far past an outage repair looks for free time
+REPAIR_HORIZON_DAYS = 14
+
+# Runs per site whose rows are kept for rollback
+SCHEDULE_RUNS_KEPT = 5
+
+# Schedule columns copied between Schedule and the staging table
+STAGED_COLUMNS = ('student_id', 'student_name', 'site_id', 'group_name', 'machine_id', 'machine_name',
+                  'module_name', 'start_time', 'end_time', 'extra_time', 'session_type', 'capacity', 'notes')
+
+
+##############################################
+# WORKING CALENDAR
+##############################################
+class WorkCalendar:
+    """Working hours between two dates: a daily window, a lunch break and
+    the weekdays (0 = Monday) sessions may fall on."""
+
+    def __init__(self, start_date, end_date, day_start, day_end,
+                 lunch_start=None, lunch_minutes=0, allowed_days=None):
+        self.day_start = day_start
+        self.day_end = day_end
+        self.lunch_start = lunch_start if lunch_minutes else None
+        self.lunch_length = timedelta(minutes=lunch_minutes or 0)
+        self.allowed_days = set(allowed_days) if allowed_days else None
+        self.first = datetime.combine(start_date, day_start)
+        self.final = datetime.combine(end_date, day_end)
+        self._timeline = None
+
+    def __getstate__(self):
+        # The timeline is rebuilt on demand rather than pickled to workers
+        return dict(self.__dict__, _timeline=None)
+
+    def timeline(self):
+        """The calendar as a minute ``Timeline``, built on first use"""
+        if self._timeline is None:
+            self._timeline = Timeline(self)
+        return self._timeline
+
+    def is_working_day(self, day):
+        return self.allowed_days is None or day.weekday() in self.allowed_days
+
+    def hours(self, day):
+        """Opening and closing datetimes for a day"""
+        return datetime.combine(day, self.day_start), datetime.combine(day, self.day_end)
+
+    def lunch(self, day):
+        """Lunch break (start, end) for a day, or None"""
+        if self.lunch_start is None:
+            return None
+        start = datetime.combine(day, self.lunch_start)
+        return start, start + self.lunch_length
+
+    def earliest_fit(self, dt, minutes):
+        """Earliest start at or after ``dt`` where a session of ``minutes``
+        fits inside working hours without touching lunch; None when it no
+        longer fits before the end of the calendar."""
+        length = timedelta(minutes=minutes)
+        dt = max(dt, self.first)
+        while dt < self.final:
+            day = dt.date()
+            opens, closes = self.hours(day)
+            if not self.is_working_day(day) or dt >= closes:
+                dt = datetime.combine(day + timedelta(days=1), self.day_start)
+                continue
+            dt = max(dt, opens)
+
+            lunch = self.lunch(day)
+            if lunch and dt < lunch[1] and lunch[0] < dt + length:
+                dt = lunch[1]
+
+            if dt + length > closes:
+                dt = datetime.combine(day + timedelta(days=1), self.day_start)
+                continue
+            return dt
+        return None
+
+    def working_minutes(self, start, end):
+        """Minutes of working time (outside lunch) between two datetimes"""
+        total = 0.0
+        day = start.date()
+        while day <= end.date():
+            if self.is_working_day(day):
+                opens, closes = self.hours(day)
+                total += _overlap(opens, closes, start, end)
+                lunch = self.lunch(day)
+                if lunch:
+                    total -= _overlap(max(opens, lunch[0]), min(closes, lunch[1]), start, end)
+            day += timedelta(days=1)
+        return total
+
+def _overlap(a_start, a_end, b_start, b_end):
+    """Minutes two intervals share"""
+    seconds = (min(a_end, b_end) - max(a_start, b_start)).total_seconds()
+    return max(seconds, 0) / 60
+
+
+##############################################
+# MINUTE TIMELINE
+##############################################
+class Timeline:
+    """A WorkCalendar as whole minutes since midnight of its first day.
+
+    ``mask`` holds one flag per minute of the horizon, set on working
+    minutes (allowed weekday, inside the daily window, outside lunch), and
+    ``starts``/``ends`` are the working windows it splits into. Both are
+    built with array operations once per calendar.
+    """
+
+    def __init__(self, calendar):
+        self.origin = datetime.combine(calendar.first.date(), dtime())
+        days = (calendar.final.date() - calendar.first.date()).days + 1
+        of_day = np.arange(MINUTES_PER_DAY)
+        hours = (of_day >= _minute_of_day(calendar.day_start)) & (of_day < _minute_of_day(calendar.day_end))
+        if calendar.lunch_start is not None:
+            lunch = _minute_of_day(calendar.lunch_start)
+            hours &= ~((of_day >= lunch) & (of_day < lunch + calendar.lunch_length // timedelta(minutes=1)))
+
+        weekdays = np.ones(7, dtype=bool)
+        if calendar.allowed_days is not None:
+            weekdays[:] = False
+            weekdays[sorted(calendar.allowed_days)] = True
+        working_days = weekdays[(calendar.first.weekday() + np.arange(days)) % 7]
+
+        # One row of minutes per day: the daily hours on working days only
+        self.mask = np.outer(working_days, hours).ravel()
+
+        edges = np.flatnonzero(np.diff(self.mask.astype(np.int8), prepend=0, append=0))
+        self.starts, self.ends = edges[0::2], edges[1::2]
+
+    def minute(self, dt):
+        """Minute offset of a datetime, or None when it is not on a whole minute"""
+        offset, rest = divmod(dt - self.origin, timedelta(minutes=1))
+        return None if rest else offset
+
+    def datetimes(self, minutes):
+        """Datetimes for an array of minute offsets"""
+        offsets = np.asarray(minutes, dtype='timedelta64[m]')
+        return (np.datetime64(self.origin, 'm') + offsets).astype('datetime64[us]').tolist()
+
+    def slots(self, begin, length, step, limit):
+        """Starts of up to ``limit`` slots of ``length`` minutes, each one
+        ``step`` minutes after the start of the one before, from minute
+        ``begin`` on: what repeated ``earliest_fit`` calls with a cursor at
+        each slot's end plus the changeover would return.
+        """
+        keep = self.ends > begin
+        starts, ends = self.starts[keep], self.ends[keep]
+        if len(starts) > 1 and (starts[1:] - ends[:-1]).min() < step - length:
+            # A changeover longer than the breaks carries into the next window
+            return self._carried_slots(starts, ends, begin, length, step, limit)
+
+        first = np.maximum(starts, begin)
+        counts = np.where(first + length <= ends, (ends - length - first) // step + 1, 0)
+        cut = np.searchsorted(np.cumsum(counts), limit) + 1
+        first, counts = first[:cut], counts[:cut]
+        skip = np.repeat(np.cumsum(counts) - counts, counts)
+        return (np.repeat(first, counts) + (np.arange(skip.size) - skip) * step)[:limit]
+
+    @staticmethod
+    def _carried_slots(starts, ends, begin, length, step, limit):
+        found, cursor, total = [], begin, 0
+        for opens, closes in zip(starts.tolist(), ends.tolist()):
+            if total >= limit:
+                break
+            first = max(opens, cursor)
+            if first + length > closes:
+                continue
+            window = np.arange(first, closes - length + 1, step)[:limit - total]
+            found.append(window)
+            total += window.size
+            cursor = int(window[-1]) + step
+        return np.concatenate(found) if found else np.empty(0, dtype=np.int64)
+
+def _minute_of_day(value):
+    return value.hour * 60 + value.minute
+
+def _uniform_minutes(orders):
+    """The processing time every order shares, or None"""
+    minutes = {order['processing_time'] for order in orders}
+    if len(minutes) == 1:
+        minutes = minutes.pop()
+        if isinstance(minutes, int) and minutes > 0:
+            return minutes
+    return None
+
+
+##############################################
+# PLANNING
+##############################################
+def dispatch_order(orders, rule):
+    """Orders in the sequence a priority rule releases them.
+
+    Sorting is stable, so ties (and FIFO) keep the input order.
+    """
+    if rule == 'SPT':
+        return sorted(orders, key=lambda o: o['processing_time'])
+    if rule == 'LPT':
+        return sorted(orders, key=lambda o: o['processing_time'], reverse=True)
+    if rule == 'GROUP':
+        return sorted(orders, key=lambda o: o.get('group_name') or 'ZZZ')
+    if rule == 'MODULE':
+        return sorted(orders, key=lambda o: o.get('module_name') or 'ZZZ')
+    return list(orders)
+
+def normalize_level(level):
+    """Comparable form of a level label ('Level  I' matches 'level i'); None when blank"""
+    if level is None:
+        return None
+    return ' '.join(str(level).split()).casefold() or None
+
+def _session_levels(session):
+    """Machine levels every order in a session accepts; None when any will do.
+
+    An order's ``levels`` is a set of normalized levels, or None/absent.
+    """
+    levels = None
+    for order in session:
+        wanted = order.get('levels')
+        if wanted is not None:
+            levels = set(wanted) if levels is None else levels & set(wanted)
+    return levels
+
+def student_key(record):
+    """Who a planned order or row is for: the student's id, or the name
+    for a row not linked to a student"""
+    return record.get('student_id') or record['student_name']
+
+def _row(order, machine_name, start, end):
+    """Schedule row for an order: every order key except the PLAN_KEYS"""
+    row = {key: value for key, value in order.items() if key not in PLAN_KEYS}
+    row.update(machine_name=machine_name, start_time=start, end_time=end)
+    return row
+
+def plan_round_robin(orders, machine_names, calendar, allowance=0):
+    """Place orders one after another on a single time cursor.
+
+    Each order is a dict of Schedule columns plus ``processing_time`` in
+    minutes. Machines are taken in turn. Returns ``(rows, unscheduled)``:
+    the planned rows and the orders that did not fit before the calendar
+    ran out.
+    """
+    minutes = _uniform_minutes(orders)
+    if minutes:
+        timeline = calendar.timeline()
+        starts = timeline.slots(timeline.minute(calendar.first), minutes, minutes + allowance, len(orders))
+        names = [machine_names[i % len(machine_names)] if machine_names else 'N/A' for i in range(starts.size)]
+        return _timeline_rows(orders, names, starts, minutes, timeline, 1), list(orders[starts.size:])
+
+    pending = deque(orders)
+    gap = timedelta(minutes=allowance)
+    rows = []
+    cursor = calendar.first
+
+    while pending:
+        order = pending[0]
+        start = calendar.earliest_fit(cursor, order['processing_time'])
+        if start is None:
+            break
+        pending.popleft()
+
+        end = start + timedelta(minutes=order['processing_time'])
+        machine_name = machine_names[len(rows) % len(machine_names)] if machine_names else 'N/A'
+        rows.append(_row(order, machine_name, start, end))
+        cursor = end + gap
+
+    return rows, list(pending)
+
+def plan_parallel(orders, machine_names, calendar, allowance=0, session_size=1,
+                  machine_free=None, student_free=None, machine_levels=None):
+    """List-schedule orders onto machines running in parallel.
+
+    Orders are released in list order (see ``dispatch_order``), in sessions
+    of ``session_size`` students sharing one machine and time slot. Each
+    session goes to the machine that frees up first, kept in a heap of
+    next-free times, and starts once that machine and every student in it
+    are free and the calendar has room. ``allowance`` is the changeover
+    break a machine needs after each session.
+
+    ``machine_free`` maps machine names and ``student_free`` student keys
+    (see ``student_key``) to the time they are already booked until (see
+    ``booked_until`` and ``students_booked_until``). With ``machine_levels``
+    (machine name -> normalized level) a session only goes to machines
+    whose level its orders accept. Returns ``(rows, unscheduled)`` like
+    ``plan_round_robin``.
+    """
+    machine_free = machine_free or {}
+    planned = _plan_parallel_timeline(orders, machine_names, calendar, allowance, session_size,
+                                      machine_free, student_free, machine_levels)
+    if planned is not None:
+        return planned
+
+    student_free = dict(student_free or {})
+    gap = timedelta(minutes=allowance)
+    heap = [(max(machine_free.get(name, calendar.first), calendar.first), index, name)
+            for index, name in enumerate(machine_names)]
+    heapq.heapify(heap)
+    rows, unscheduled = [], []
+
+    for i in range(0, len(orders), session_size):
+        session = orders[i:i + session_size]
+        minutes = max(order['processing_time'] for order in session)
+        ready = max(student_free.get(student_key(order), calendar.first) for order in session)
+        levels = _session_levels(session) if machine_levels else None
+
+        # Set aside machines of the wrong level until the session is placed
+        skipped = []
+        while heap and levels is not None and machine_levels.get(heap[0][2]) not in levels:
+            skipped.append(heapq.heappop(heap))
+
+        # Every other suitable machine frees up later, so if the first one
+        # has no room left for a session this long, none has
+        start = None
+        if heap:
+            free_at, index, name = heap[0]
+            start = calendar.earliest_fit(max(free_at, ready), minutes)
+        if start is None:
+            unscheduled.extend(session)
+        else:
+            end = start + timedelta(minutes=minutes)
+            heapq.heapreplace(heap, (end + gap, index, name))
+            for order in session:
+                rows.append(_row(order, name, start, end))
+                student_free[student_key(order)] = end
+
+        for entry in skipped:
+            heapq.heappush(heap, entry)
+
+    return rows, unscheduled
+
+def _plan_parallel_timeline(orders, machine_names, calendar, allowance, session_size,
+                            machine_free, student_free, machine_levels):
+    """``plan_parallel`` on the minute timeline, or None when it does not apply.
+
+    With one processing time, no level limits and every student once and
+    free from the start, each machine just runs back-to-back slots from the
+    time it frees up. The heap only interleaves those sequences by free
+    time (ties to the earlier machine), which is a sort, and once the first
+    machine runs out of room every later session goes unplaced.
+    """
+    minutes = _uniform_minutes(orders)
+    keys = [student_key(order) for order in orders]
+    if not minutes or not machine_names or len(set(keys)) < len(keys):
+        return None
+    if machine_levels and any(order.get('levels') is not None for order in orders):
+        return None
+    if student_free and any(student_free.get(key, calendar.first) > calendar.first for key in keys):
+        return None
+    timeline = calendar.timeline()
+    begins = [timeline.minute(max(machine_free.get(name, calendar.first), calendar.first))
+              for name in machine_names]
+    if None in begins:
+        return None
+
+    sessions = -(-len(orders) // session_size)
+    step = minutes + allowance
+    keys, starts, machines = [], [], []
+    for index, begin in enumerate(begins):
+        slots = timeline.slots(begin, minutes, step, sessions)
+        # The free time before each slot; the one after the last slot is a
+        # dead end (-1) unless the machine could take every session anyway
+        free = np.concatenate(([begin], slots + step))
+        slots = np.append(slots, -1)
+        if slots.size > sessions:
+            free, slots = free[:sessions], slots[:sessions]
+        keys.append(free)
+        starts.append(slots)
+        machines.append(np.full(free.size, index))
+
+    keys, starts, machines = np.concatenate(keys), np.concatenate(starts), np.concatenate(machines)
+    order = np.lexsort((machines, keys))[:sessions]
+    starts, machines = starts[order], machines[order]
+    placed = int(np.argmax(starts < 0)) if (starts < 0).any() else starts.size
+
+    session_machines = [machine_names[i] for i in machines[:placed].tolist()]
+    rows = _timeline_rows(orders, session_machines, starts[:placed], minutes, timeline, session_size)
+    return rows, orders[placed * session_size:]
+
+def _timeline_rows(orders, machine_names, starts, minutes, timeline, session_size):
+    """Rows for consecutive sessions of orders given each session's machine and start minute"""
+    rows = []
+    ends = timeline.datetimes(starts + minutes)
+    for i, (name, start) in enumerate(zip(machine_names, timeline.datetimes(starts))):
+        for order in orders[i * session_size:(i + 1) * session_size]:
+            rows.append(_row(order, name, start, ends[i]))
+    return rows
+
+def booked_until(column, names, calendar, site_id=None, replacing=None):
+    """Latest end time of existing bookings inside the calendar, per name.
+
+    ``column`` is Schedule.machine_name (students go through
+    ``students_booked_until``); every participant of a shared session
+    counts. Rows of the ``replacing`` scope
+    query are left out, as publishing removes them. Planning from these
+    times keeps new sessions clear of bookings that stay.
+    """
+    if not names:
+        return {}
+    bookings = schedule_bookings().c
+    column = bookings[column.key]
+    query = db.session.query(column, func.max(bookings.end_time)).filter(
+        column.in_(list(names)),
+        bookings.end_time > calendar.first,
+        bookings.start_time < calendar.final
+    )
+    if site_id is not None:
+        query = query.filter(bookings.site_id == site_id)
+    if replacing is not None:
+        query = query.filter(bookings.id.notin_(replacing.with_entities(Schedule.id)))
+    return dict(query.group_by(column).all())
+
+def _booking_students(orders):
+    """Match a booking's (student_id, student_name) to the keys of the
+    orders' students: by id, and by name only where the booking or the
+    order is not linked to a student"""
+    ids = {order['student_id'] for order in orders if order.get('student_id')}
+    ids_by_name, unlinked = {}, set()
+    for order in orders:
+        if order.get('student_id'):
+            ids_by_name.setdefault(order['student_name'], set()).add(order['student_id'])
+        else:
+            unlinked.add(order['student_name'])
+
+    def keys(student_id, student_name):
+        if student_id is None:
+            found = set(ids_by_name.get(student_name, ()))
+        else:
+            found = {student_id} if student_id in ids else set()
+        if student_name in unlinked:
+            found.add(student_name)
+        return found
+
+    return ids, keys
+
+def students_booked_until(orders, calendar, site_id=None, replacing=None):
+    """``booked_until`` for the orders' students, keyed by ``student_key``"""
+    if not orders:
+        return {}
+    ids, keys = _booking_students(orders)
+    bookings = schedule_bookings().c
+    query = db.session.query(bookings.student_id, bookings.student_name, func.max(bookings.end_time)).filter(
+        or_(bookings.student_id.in_(list(ids)),
+            bookings.student_name.in_([order['student_name'] for order in orders])),
+        bookings.end_time > calendar.first,
+        bookings.start_time < calendar.final
+    )
+    if site_id is not None:
+        query = query.filter(bookings.site_id == site_id)
+    if replacing is not None:
+        query = query.filter(bookings.id.notin_(replacing.with_entities(Schedule.id)))
+    free = {}
+    for student_id, student_name, end in query.group_by(bookings.student_id, bookings.student_name):
+        for key in keys(student_id, student_name):
+            free[key] = max(free.get(key, end), end)
+    return free
+
+
+
+##############################################
+# GAP FILLING
+##############################################
+class FreeList:
+    """Free intervals of one machine or student, sorted and disjoint.
+
+    Each interval remembers whether its end is soft (the working day or
+    lunch closes) or hard (a booking follows, so a machine's changeover
+    allowance must fit before it). Pieces shorter than ``min_minutes``
+    can never take a session and are dropped, which keeps the front of a
+    dense list usable.
+    """
+
+    def __init__(self, intervals, min_minutes=0):
+        self.min_length = timedelta(minutes=min_minutes)
+        pieces = self._usable((start, end, True) for start, end in intervals)
+        self.starts = [start for start, _, _ in pieces]
+        self.ends = [end for _, end, _ in pieces]
+        self.soft = [soft for _, _, soft in pieces]
+
+    def _usable(self, pieces):
+        return [(start, end, soft) for start, end, soft in pieces
+                if end > start and end - start >= self.min_length]
+
+    def first_fit(self, t, length, tail=timedelta(0)):
+        """Earliest (start, leftover) at or after ``t`` with ``length`` free,
+        plus ``tail`` before a hard end; None when nothing fits"""
+        i = max(bisect_right(self.starts, t) - 1, 0)
+        for k in range(i, len(self.starts)):
+            start = max(t, self.starts[k])
+            room = self.ends[k] - (timedelta(0) if self.soft[k] else tail)
+            if start + length <= room:
+                return start, room - start - length
+        return None
+
+    def reserve(self, start, end, tail=timedelta(0)):
+        """Take [start, end) out of the free time. Free time ending less
+        than ``tail`` before ``start`` (say, at lunch when the booking
+        starts inside it) now ends at a booking too."""
+        i = max(bisect_right(self.starts, start) - 1, 0)
+        while i > 0 and self.ends[i - 1] + tail > start:
+            i -= 1
+        j = i
+        while j < len(self.starts) and self.starts[j] < end:
+            j += 1
+        pieces = []
+        for k in range(i, j):
+            free_start, free_end, soft = self.starts[k], self.ends[k], self.soft[k]
+            if free_end <= start:
+                pieces.append((free_start, free_end, soft and free_end + tail <= start))
+                continue
+            # What is left before the reservation now ends at a booking
+            pieces.append((free_start, min(start, free_end), False))
+            pieces.append((max(end, free_start), free_end, soft))
+        pieces = self._usable(pieces)
+        self.starts[i:j] = [piece[0] for piece in pieces]
+        self.ends[i:j] = [piece[1] for piece in pieces]
+        self.soft[i:j] = [piece[2] for piece in pieces]
+
+def working_intervals(calendar):
+    """The calendar's working time as (start, end) pieces, split at lunch"""
+    day = calendar.first.date()
+    while day <= calendar.final.date():
+        if calendar.is_working_day(day):
+            opens, closes = calendar.hours(day)
+            lunch = calendar.lunch(day)
+            if lunch and opens < lunch[1] and lunch[0] < closes:
+                yield opens, max(opens, lunch[0])
+                yield min(closes, lunch[1]), closes
+            else:
+                yield opens, closes
+        day += timedelta(days=1)
+
+def plan_gap_fill(orders, machine_names, calendar, bookings=(), allowance=0, session_size=1,
+                  machine_levels=None, fit='first'):
+    """Place sessions only into the free time left around ``bookings``.
+
+    ``bookings`` are the (student key, machine_name, start, end) tuples
+    that stay (see ``existing_bookings``). They are loaded once into a
+    FreeList per machine (working time, lunch excluded, minus bookings and
+    their changeover ``allowance``) and per student (the whole calendar
+    minus bookings), and each placed session is reserved in those lists.
+
+    For each session, every suitable machine offers its earliest gap where
+    the machine and all the session's students are free. ``fit='first'``
+    takes the earliest of those; ``fit='best'`` the one leaving the least
+    unused time in its gap, then the earliest. Sessions and levels work as
+    in ``plan_parallel``. Returns ``(rows, unscheduled)``.
+    """
+    shortest = min((order['processing_time'] for order in orders), default=0)
+    gap = timedelta(minutes=allowance)
+    working = list(working_intervals(calendar))
+    machines = {name: FreeList(working, shortest) for name in machine_names}
+    students = {}
+
+    def student_list(key):
+        if key not in students:
+            students[key] = FreeList([(calendar.first, calendar.final)], shortest)
+        return students[key]
+
+    for key, machine_name, start, end in bookings:
+        if machine_name in machines:
+            machines[machine_name].reserve(start, end + gap, gap)
+        if key:
+            student_list(key).reserve(start, end)
+
+    # Machine -> shortest session length it no longer has room for
+    full = {}
+    rows, unscheduled = [], []
+    for i in range(0, len(orders), session_size):
+        session = orders[i:i + session_size]
+        length = timedelta(minutes=max(order['processing_time'] for order in session))
+        levels = _session_levels(session) if machine_levels else None
+        free_students = [student_list(student_key(order)) for order in session]
+
+        best = None
+        for index, name in enumerate(machine_names):
+            if levels is not None and machine_levels.get(name) not in levels:
+                continue
+            if name in full and full[name] <= length:
+                continue
+            # First fit: a machine whose free time starts later cannot win
+            if fit == 'first' and best is not None and (not machines[name].starts
+                                                        or machines[name].starts[0] >= best[1]):
+                continue
+            found = _common_fit(machines[name], free_students, calendar.first, length, gap)
+            if found is None:
+                if machines[name].first_fit(calendar.first, length, gap) is None:
+                    full[name] = min(length, full.get(name, length))
+                continue
+            start, leftover = found
+            key = (start, index) if fit == 'first' else (leftover, start, index)
+            if best is None or key < best[0]:
+                best = (key, start, name)
+
+        if best is None:
+            unscheduled.extend(session)
+            continue
+        _, start, name = best
+        end = start + length
+        machines[name].reserve(start, end + gap, gap)
+        for order, free in zip(session, free_students):
+            free.reserve(start, end)
+            rows.append(_row(order, name, start, end))
+
+    return rows, unscheduled
+
+def _common_fit(machine, students, t, length, tail):
+    """Earliest start at or after ``t`` free on the machine and for every
+    student, with the machine's leftover in that gap"""
+    while True:
+        found = machine.first_fit(t, length, tail)
+        if found is None:
+            return None
+        start, leftover = found
+        latest = start
+        for free in students:
+            student_fit = free.first_fit(start, length)
+            if student_fit is None:
+                return None
+            latest = max(latest, student_fit[0])
+        if latest == start:
+            return found
+        t = latest
+
+def existing_bookings(site_id, calendar, machine_names, orders, replacing=None):
+    """(student key, machine_name, start, end) of the site's bookings in
+    the calendar that involve any of the machines or the orders' students,
+    one per student of a shared session, leaving out the ``replacing``
+    scope. The key is None for a booking of none of the orders' students."""
+    ids, keys = _booking_students(orders)
+    bookings = schedule_bookings().c
+    query = db.session.query(
+        bookings.student_id, bookings.student_name, bookings.machine_name, bookings.start_time, bookings.end_time
+    ).filter(
+        bookings.site_id == site_id,
+        bookings.start_time < calendar.final,
+        bookings.end_time > calendar.first,
+        or_(bookings.machine_name.in_(list(machine_names)),
+            bookings.student_id.in_(list(ids)),
+            bookings.student_name.in_([order['student_name'] for order in orders]))
+    )
+    if replacing is not None:
+        query = query.filter(bookings.id.notin_(replacing.with_entities(Schedule.id)))
+    found = []
+    for student_id, student_name, machine_name, start, end in query:
+        found.extend((key, machine_name, start, end) for key in keys(student_id, student_name) or [None])
+    return found
+
+
+##############################################
+# OPTIMIZATION
+##############################################
+# Stop early after this many moves in a row without an improvement
+OPTIMIZE_PATIENCE = 5000
+
+def optimize_parallel(orders, rows, machine_names, calendar, allowance=0, session_size=1,
+                      machine_free=None, student_free=None, machine_levels=None,
+                      time_budget=2.0, seed=None):
+    """Improve a ``plan_parallel`` result by local search.
+
+    ``orders`` and the planning arguments are the ones ``rows`` was planned
+    with; each student has one order, as the generators build them. The
+    plan is read back as an ordered queue of sessions per machine, and each
+    queue is placed on its own (a machine's sessions run back to back,
+    starting once their students are free). Random moves (relocate a
+    session, swap two, or fit in an unscheduled one) are kept when they do
+    not make the objective worse: fewest unscheduled sessions, then the
+    earliest makespan, then the most even finish times across machines.
+
+    Runs for ``time_budget`` seconds at most. Returns ``(rows,
+    unscheduled, moves)`` for the best plan found.
+    """
+    machine_free = machine_free or {}
+    student_free = student_free or {}
+    first = calendar.first
+    gap = timedelta(minutes=allowance)
+    rng = random.Random(seed)
+
+    sessions = [orders[i:i + session_size] for i in range(0, len(orders), session_size)]
+    minutes = [max(order['processing_time'] for order in session) for session in sessions]
+    ready = [max(student_free.get(student_key(order), first) for order in session) for session in sessions]
+    eligible = []
+    for session in sessions:
+        levels = _session_levels(session) if machine_levels else None
+        eligible.append([name for name in machine_names
+                         if levels is None or machine_levels.get(name) in levels])
+
+    # Read the plan back as queues: a session is known by its first student
+    by_student = {student_key(session[0]): index for index, session in enumerate(sessions)}
+    placed = {}
+    for row in rows:
+        index = by_student.get(student_key(row))
+        if index is not None:
+            placed[index] = (row['machine_name'], row['start_time'])
+    queues = {name: [] for name in machine_names}
+    for index, (name, start) in sorted(placed.items(), key=lambda item: item[1][1]):
+        queues[name].append(index)
+    pool = [index for index in range(len(sessions)) if index not in placed]
+
+    def decode(name, queue):
+        """Place a machine's queue in order: (placed, overflow, finish)"""
+        cursor = max(machine_free.get(name, first), first)
+        slots, overflow = [], []
+        for index in queue:
+            start = calendar.earliest_fit(max(cursor, ready[index]), minutes[index])
+            if start is None:
+                overflow.append(index)
+                continue
+            end = start + timedelta(minutes=minutes[index])
+            slots.append((index, start, end))
+            cursor = end + gap
+        return slots, overflow, slots[-1][2] if slots else None
+
+    def cost(decoded, pool):
+        missing = len(pool) + sum(len(overflow) for _, overflow, _ in decoded.values())
+        finishes = [(finish - first).total_seconds() / 60 for _, _, finish in decoded.values() if finish]
+        return (missing, max(finishes, default=0.0), sum(f * f for f in finishes))
+
+    decoded = {name: decode(name, queue) for name, queue in queues.items()}
+    current = cost(decoded, pool)
+    best = (current, {name: list(queue) for name, queue in queues.items()}, list(pool))
+    deadline = time.perf_counter() + time_budget
+    moves = stale = 0
+
+    while time.perf_counter() < deadline and stale < OPTIMIZE_PATIENCE and machine_names:
+        moves += 1
+        stale += 1
+        changed = {}
+        new_pool = pool
+
+        busy = [name for name in machine_names if queues[name]]
+        if pool and (not busy or rng.random() < 0.3):
+            # Fit an unscheduled session in at the end of the least loaded suitable machine
+            index = rng.choice(pool)
+            if not eligible[index]:
+                continue
+            target = min(eligible[index], key=lambda name: decoded[name][2] or first)
+            changed[target] = queues[target] + [index]
+            new_pool = [i for i in pool if i != index]
+        elif busy:
+            # Usually take from the machine finishing last
+            if rng.random() < 0.7:
+                source = max(busy, key=lambda name: decoded[name][2] or first)
+            else:
+                source = rng.choice(busy)
+            position = rng.randrange(len(queues[source]))
+            index = queues[source][position]
+            targets = [name for name in eligible[index] if name != source]
+            if not targets:
+                continue
+            target = rng.choice(targets)
+            source_queue = list(queues[source])
+            target_queue = list(queues[target])
+
+            if target_queue and rng.random() < 0.5:
+                # Swap with a session on the target
+                other_position = rng.randrange(len(target_queue))
+                other = target_queue[other_position]
+                if source not in eligible[other]:
+                    continue
+                source_queue[position], target_queue[other_position] = other, index
+            else:
+                # Relocate to a random position on the target
+                del source_queue[position]
+                target_queue.insert(rng.randrange(len(target_queue) + 1), index)
+            changed[source] = source_queue
+            changed[target] = target_queue
+        else:
+            break
+
+        trial = dict(decoded)
+        for name, queue in changed.items():
+            trial[name] = decode(name, queue)
+        candidate = cost(trial, new_pool)
+        if candidate <= current:
+            queues.update(changed)
+            decoded, pool, current = trial, new_pool, candidate
+            if candidate < best[0]:
+                best = (candidate, {name: list(queue) for name, queue in queues.items()}, list(pool))
+                stale = 0
+
+    _, queues, pool = best
+    rows, unscheduled = [], [order for index in pool for order in sessions[index]]
+    for name, queue in queues.items():
+        slots, overflow, _ = decode(name, queue)
+        for index, start, end in slots:
+            rows.extend(_row(order, name, start, end) for order in sessions[index])
+        unscheduled.extend(order for index in overflow for order in sessions[index])
+    rows.sort(key=lambda row: (row['start_time'], row['machine_name']))
+    return rows, unscheduled, moves
+
+##############################################
+# REPORTING
+##############################################
+def schedule_stats(rows, calendar, machine_names, allowance=0):
+    """Makespan, per-machine utilization and idle gaps of a planned schedule.
+
+    Makespan runs from the start of the calendar to the end of the last
+    session. Utilization is booked time over the working time (lunch
+    excluded) in that span; students sharing a session count once. Load
+    spread is the gap between the busiest and the idlest machine. An idle
+    gap is working time a machine stands unused between two of its
+    sessions, beyond the ``allowance`` kept between sessions anyway.
+    """
+    busy = dict.fromkeys(machine_names, 0.0)
+    sessions = Counter()
+    booked = {}
+    for machine_name, start, end in {(r['machine_name'], r['start_time'], r['end_time']) for r in rows}:
+        busy[machine_name] = busy.get(machine_name, 0.0) + (end - start).total_seconds() / 60
+        sessions[machine_name] += 1
+        booked.setdefault(machine_name, []).append((start, end))
+
+    gaps = {}
+    for machine_name, spans in booked.items():
+        spans.sort()
+        idle = [calendar.working_minutes(before_end, after_start) - allowance
+                for (_, before_end), (after_start, _) in zip(spans, spans[1:])
+                if after_start > before_end]
+        gaps[machine_name] = [minutes for minutes in idle if minutes > 0]
+
+    end = max((r['end_time'] for r in rows), default=None)
+    available = calendar.working_minutes(calendar.first, end) if end else 0.0
+    machines = [{
+        'machine_name': name,
+        'sessions': sessions[name],
+        'busy_minutes': minutes,
+        'utilization': minutes / available if available else 0.0,
+        'idle_gaps': len(gaps.get(name, ())),
+        'idle_minutes': sum(gaps.get(name, ())),
+    } for name, minutes in busy.items()]
+    all_gaps = [minutes for machine_gaps in gaps.values() for minutes in machine_gaps]
+
+    return {
+        'sessions': sum(sessions.values()),
+        'start': calendar.first,
+        'end': end,
+        'makespan_minutes': (end - calendar.first).total_seconds() / 60 if end else 0.0,
+        'available_minutes': available,
+        'utilization': sum(busy.values()) / (available * len(busy)) if available and busy else 0.0,
+        'load_spread_minutes': max(busy.values()) - min(busy.values()) if busy else 0.0,
+        'idle_gaps': len(all_gaps),
+        'idle_minutes': sum(all_gaps),
+        'longest_gap_minutes': max(all_gaps, default=0.0),
+        'machines': machines,
+    }
+
+
+##############################################
+# WHAT-IF SIMULATION
+##############################################
+def simulate(base, variant):
+    """Plan one what-if scenario in memory.
+
+    ``base`` holds what every scenario shares: ``orders`` (without
+    ``processing_time``), ``machine_names``, ``calendar``, ``allowance``,
+    ``session_size``, ``machine_free``, ``student_free``,
+    ``machine_levels``, ``placement`` and ``bookings`` (see
+    ``existing_bookings``). ``variant`` sets ``priority_rule``,
+    ``slot_duration``, ``optimize`` and ``time_budget``. As in the
+    generator, levels are only matched when optimizing, and greedy variants
+    fill the gaps between ``bookings`` when ``placement`` is 'first' or
+    'best'. Returns the proposed rows, the unscheduled student names and
+    ``schedule_stats``.
+    """
+    started = time.perf_counter()
+    orders = dispatch_order([dict(order, processing_time=variant['slot_duration']) for order in base['orders']],
+                            variant['priority_rule'])
+    plan_args = (orders, base['machine_names'], base['calendar'], base['allowance'], base['session_size'],
+                 base['machine_free'], base['student_free'],
+                 base['machine_levels'] if variant['optimize'] else None)
+    if base.get('placement') in ('first', 'best') and not variant['optimize']:
+        rows, unscheduled = plan_gap_fill(orders, base['machine_names'], base['calendar'], base['bookings'],
+                                          base['allowance'], base['session_size'], fit=base['placement'])
+    else:
+        rows, unscheduled = plan_parallel(*plan_args)
+    moves = 0
+    if variant['optimize']:
+        rows, unscheduled, moves = optimize_parallel(orders, rows, *plan_args[1:],
+                                                     time_budget=variant['time_budget'], seed=0)
+    return {
+        'variant': variant,
+        'rows': rows,
+        'unscheduled': [order['student_name'] for order in unscheduled],
+        'stats': schedule_stats(rows, base['calendar'], base['machine_names'], base['allowance']),
+        'moves': moves,
+        'seconds': time.perf_counter() - started,
+    }
+
+def simulate_many(base, variants, workers=SIMULATION_WORKERS):
+    """``simulate`` each variant, in parallel processes when there are
+    several. Results come back in the order of ``variants``."""
+    variants = list(variants)[:MAX_SCENARIOS]
+    if len(variants) < 2 or workers < 2:
+        return [simulate(base, variant) for variant in variants]
+    with ProcessPoolExecutor(max_workers=min(workers, len(variants))) as pool:
+        return list(pool.map(simulate, [base] * len(variants), variants))
+
+
+##############################################
+# OUTAGE REPAIR
+##############################################
+def repair_outage(site_id, machine_name, outage_start, outage_end, calendar, machine_names):
+    """Move the sessions a machine outage hits, and nothing else.
+
+    Affected sessions are the site's slots on ``machine_name`` overlapping
+    [outage_start, outage_end); students sharing a session move together.
+    In order of their original start, each goes to the earliest time at or
+    after that start, inside ``calendar``, where one of ``machine_names``
+    (the compatible machines; the broken one counts once it is back) and
+    all of the session's students are free. Bookings up to the end of the
+    calendar are checked against a ConflictIndex, and every move is added
+    to it so later sessions see it.
+
+    Rows are updated through the ORM, so the rollups follow. Does not
+    commit. Returns ``(moved, stranded)``, one dict per session; stranded
+    sessions found no room before the end of the calendar and stay put.
+    """
+    affected = Schedule.query.options(
+        selectinload(Schedule.participants).joinedload(ScheduleParticipant.student)
+    ).filter(
+        Schedule.site_id == site_id,
+        Schedule.machine_name == machine_name,
+        Schedule.start_time < outage_end,
+        Schedule.end_time > outage_start
+    ).order_by(Schedule.start_time, Schedule.id).all()
+    if not affected:
+        return [], []
+
+    sessions = {}
+    for row in affected:
+        sessions.setdefault((row.start_time, row.end_time), []).append(row)
+    machine_ids = _machine_ids([site_id])
+
+    index = ConflictIndex.load(
+        min(row.start_time for row in affected), calendar.final,
+        students=[name for row in affected for name in row.student_names], machines=machine_names,
+        exclude_ids=[row.id for row in affected], site_id=site_id
+    )
+    index.machines.add(machine_name, outage_start, outage_end,
+                       Booking(None, None, machine_name, outage_start, outage_end, 1))
+
+    moved, stranded = [], []
+    for (start, end), rows in sessions.items():
+        minutes = (end - start).total_seconds() / 60
+        students = [name for row in rows for name in row.student_names]
+        options = [(t, name) for name in machine_names
+                   for t in [_next_free(index, name, students, start, minutes, calendar)] if t]
+        summary = {'students': students, 'machine_name': machine_name, 'start_time': start, 'end_time': end}
+        if not options:
+            stranded.append(summary)
+            continue
+
+        new_start, new_machine = min(options, key=lambda option: option[0])
+        new_end = new_start + (end - start)
+        for row in rows:
+            row.machine_name, row.start_time, row.end_time = new_machine, new_start, new_end
+            row.machine_id = machine_ids.get((site_id, new_machine))
+            for name in row.student_names:
+                index.add(name, new_machine, new_start, new_end, row.capacity)
+        moved.append(dict(summary, new_machine_name=new_machine, new_start_time=new_start, new_end_time=new_end))
+    return moved, stranded
+
+def _next_free(index, machine_name, students, start, minutes, calendar):
+    """Earliest working time at or after ``start`` when the machine and all
+    the students are free for ``minutes``; None when nothing fits"""
+    length = timedelta(minutes=minutes)
+    t = start
+    while True:
+        t = calendar.earliest_fit(t, minutes)
+        if t is None:
+            return None
+        blocking = index.machines.overlapping(machine_name, t, t + length)
+        for student in students:
+            blocking += index.students.overlapping(student, t, t + length)
+        if not blocking:
+            return t
+        t = max(booking.end_time for booking in blocking)
+
+
+##############################################
+# PERSISTENCE
+##############################################
+def schedule_scope(site_id, calendar, group_names=None, machine_names=None, student_names=None):
+    """Query for a site's rows starting inside the calendar window.
+
+    Each optional list narrows the scope to rows of those groups, machines
+    or students; None leaves that dimension open. A shared session is in
+    scope when any of its students is.
+    """
+    query = Schedule.query.filter(
+        Schedule.site_id == site_id,
+        Schedule.start_time >= calendar.first,
+        Schedule.start_time < calendar.final
+    )
+    if group_names is not None:
+        query = query.filter(or_(
+            Schedule.group_name.in_(list(group_names)),
+            Schedule.participants.any(ScheduleParticipant.student.has(
+                Student.group.has(Group.name.in_(list(group_names)))))
+        ))
+    if machine_names is not None:
+        query = query.filter(Schedule.machine_name.in_(list(machine_names)))
+    if student_names is not None:
+        query = query.filter(or_(
+            Schedule.student_name.in_(list(student_names)),
+            Schedule.participants.any(ScheduleParticipant.student.has(
+                Student.student_name.in_(list(student_names))))
+        ))
+    return query
+
+def _machine_ids(site_ids):
+    """Machine id per (site_id, machine_name); the oldest machine wins a duplicate name"""
+    ids = {}
+    for machine_id, name, site_id in db.session.query(Machine.id, Machine.machine_name, Machine.site_id).filter(
+        Machine.site_id.in_(list(site_ids))
+    ).order_by(Machine.id):
+        ids.setdefault((site_id, name), machine_id)
+    return ids
+
+def link_machines(rows):
+    """Set each planned row's ``machine_id`` from the machine name the
+    planner chose, looked up among the machines of the row's site"""
+    ids = _machine_ids({row.get('site_id') for row in rows})
+    for row in rows:
+        row['machine_id'] = ids.get((row.get('site_id'), row.get('machine_name')))
+    return rows
+
+def fold_sessions(rows):
+    """Planned rows with every shared session folded into one row.
+
+    Rows with a ``capacity`` above 1 on the same machine and time become
+    the first student's row, which carries the others' rows as
+    ``participants``. Rows without a ``student_id`` cannot be linked to a
+    participant and stay rows of their own.
+    """
+    folded, sessions = [], {}
+    for row in rows:
+        if (row.get('capacity') or 1) > 1 and row.get('student_id'):
+            key = (row.get('site_id'), row.get('machine_name'), row['start_time'], row['end_time'])
+            lead = sessions.get(key)
+            if lead is not None:
+                lead['participants'].append(row)
+                continue
+            row = sessions[key] = dict(row, participants=[])
+        folded.append(row)
+    return folded
+
+def clear_scope(query, batch_size=INSERT_BATCH_SIZE):
+    """Delete the rows of a Schedule query (usually ``schedule_scope``)
+    with their other participants, and take them out of the rollups. Does
+    not commit. Returns the number of rows deleted."""
+    ids = [row_id for (row_id,) in query.with_entities(Schedule.id)]
+    bookings = schedule_bookings().c
+    removed = []
+    for i in range(0, len(ids), batch_size):
+        chunk = ids[i:i + batch_size]
+        removed += db.session.execute(
+            select(*[bookings[name] for name in SCHEDULE_COLUMNS]).where(bookings.id.in_(chunk))
+        ).all()
+        ScheduleParticipant.query.filter(ScheduleParticipant.schedule_id.in_(chunk)).delete(synchronize_session=False)
+        Schedule.query.filter(Schedule.id.in_(chunk)).delete(synchronize_session=False)
+    apply_bulk(removed, schedule_contributions, -1)
+    return len(ids)
+
+def insert_schedule_rows(rows, batch_size=INSERT_BATCH_SIZE):
+    """Bulk-insert planned rows, shared sessions folded, and add them to
+    the rollups.
+
+    Runs in the current transaction and does not commit. Returns the
+    number of Schedule rows written.
+    """
+    sessions = fold_sessions(link_machines(rows))
+    _insert_folded(Schedule, ScheduleParticipant, 'schedule_id', sessions, {}, batch_size)
+    apply_bulk((SimpleNamespace(**row) for row in rows), schedule_contributions)
+    return len(sessions)
+
+def _insert_folded(model, link_model, link_key, rows, extra, batch_size):
+    """Bulk-insert folded rows into ``model`` (with the ``extra`` columns),
+    and their participants into ``link_model`` under the shared rows' new
+    ids, read back with RETURNING"""
+    def stored(row):
+        return dict({key: value for key, value in row.items() if key != 'participants'}, **extra)
+
+    single = [stored(row) for row in rows if not row.get('participants')]
+    shared = [row for row in rows if row.get('participants')]
+    for i in range(0, len(single), batch_size):
+        db.session.execute(insert(model), single[i:i + batch_size])
+    if shared:
+        ids = db.session.scalars(
+            insert(model).returning(model.id, sort_by_parameter_order=True), [stored(row) for row in shared]
+        ).all()
+        db.session.execute(insert(link_model), [
+            {link_key: row_id, 'student_id': other['student_id']}
+            for row_id, row in zip(ids, shared) for other in row['participants']
+        ])
+
+
+##############################################
+# RUNS: STAGE, PUBLISH, ROLL BACK
+##############################################
+def stage_run(site_id, generator, calendar, rows, user_id=None, batch_size=INSERT_BATCH_SIZE):
+    """Write planned rows to the staging table under a new run and commit.
+
+    Shared sessions are folded (``fold_sessions``). Schedule itself is not
+    touched, so readers are unaffected however long this takes. Returns
+    the ScheduleRun.
+    """
+    sessions = fold_sessions(link_machines(rows))
+    run = ScheduleRun(site_id=site_id, user_id=user_id, generator=generator, status='staged',
+                      window_start=calendar.first, window_end=calendar.final, row_count=len(sessions))
+    db.session.add(run)
+    db.session.flush()
+    _insert_folded(ScheduleRunRow, ScheduleRunParticipant, 'row_id', sessions,
+                   {'run_id': run.id, 'kind': 'new'}, batch_size)
+    db.session.commit()
+    return run
+
+def publish_run(run, scope=None):
+    """Swap a staged run in for the rows of ``scope`` in one transaction.
+
+    The replaced rows are archived with the run first, then deleted; the
+    staged rows are copied into Schedule with one INSERT ... SELECT, and
+    the participants of shared sessions with another. Both sides are
+    folded into the rollups. Commits, then expires runs beyond
+    SCHEDULE_RUNS_KEPT. A publish that fails is rolled back and its run
+    marked failed. Returns the number of rows replaced.
+    """
+    if run.status != 'staged':
+        raise ValueError(f"Run {run.id} is {run.status}, not staged")
+
+    try:
+        replaced = 0
+        if scope is not None:
+            archived = scope.with_entities(
+                literal(run.id), literal('replaced'), Schedule.run_id, Schedule.id,
+                *[getattr(Schedule, name) for name in STAGED_COLUMNS]
+            )
+            db.session.execute(insert(ScheduleRunRow).from_select(
+                ['run_id', 'kind', 'origin_run_id', 'schedule_id', *STAGED_COLUMNS], archived.statement
+            ))
+            staged, participants = ScheduleRunRow.__table__, ScheduleParticipant.__table__
+            db.session.execute(insert(ScheduleRunParticipant).from_select(
+                ['row_id', 'student_id'],
+                select(staged.c.id, participants.c.student_id).join(
+                    participants, participants.c.schedule_id == staged.c.schedule_id
+                ).where(staged.c.run_id == run.id, staged.c.kind == 'replaced')
+            ))
+            replaced = clear_scope(scope)
+
+        _copy_staged(run.id, 'new', literal(run.id))
+
+        run.status = 'published'
+        run.published_at = datetime.utcnow()
+        run.replaced_count = replaced
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        run.status = 'failed'
+        db.session.commit()
+        raise
+
+    prune_runs(run.site_id)
+    return replaced
+
+def rollback_run(run):
+    """Put back what the site's latest published run replaced.
+
+    Deletes the rows the run published (including later edits to them) and
+    restores the archived rows with the run ids they had, all in one
+    transaction. Returns (removed, restored).
+    """
+    latest = ScheduleRun.query.filter_by(site_id=run.site_id, status='published').order_by(
+        ScheduleRun.id.desc()
+    ).first()
+    if latest is None or latest.id != run.id:
+        raise ValueError("Only the latest published run of a site can be rolled back")
+
+    removed = clear_scope(Schedule.query.filter(Schedule.run_id == run.id))
+    restored = _copy_staged(run.id, 'replaced', ScheduleRunRow.origin_run_id)
+
+    run.status = 'rolled_back'
+    run.rolled_back_at = datetime.utcnow()
+    db.session.commit()
+    return removed, restored
+
+def prune_runs(site_id, keep=SCHEDULE_RUNS_KEPT):
+    """Drop the staged and archived rows of a site's failed runs and of all
+    but its newest ``keep`` published or rolled back runs, and mark those
+    runs expired. Runs still staged are left alone. Commits."""
+    runs = db.session.query(ScheduleRun.id).filter(ScheduleRun.site_id == site_id)
+    old_ids = [run_id for (run_id,) in runs.filter(
+        ScheduleRun.status.in_(('published', 'rolled_back'))
+    ).order_by(ScheduleRun.id.desc()).offset(keep)]
+    old_ids += [run_id for (run_id,) in runs.filter(ScheduleRun.status == 'failed')]
+    if not old_ids:
+        return 0
+    ScheduleRunParticipant.query.filter(ScheduleRunParticipant.row_id.in_(
+        select(ScheduleRunRow.id).where(ScheduleRunRow.run_id.in_(old_ids))
+    )).delete(synchronize_session=False)
+    ScheduleRunRow.query.filter(ScheduleRunRow.run_id.in_(old_ids)).delete(synchronize_session=False)
+    ScheduleRun.query.filter(ScheduleRun.id.in_(old_ids)).update(
+        {'status': 'expired'}, synchronize_session=False
+    )
+    db.session.commit()
+    return len(old_ids)
+
+def _copy_staged(run_id, kind, live_run_id):
+    """Copy a run's staging rows of one kind into Schedule, with
+    ``live_run_id`` (an SQL expression) as their run_id, and relink their
+    participants. Links to students or machines deleted since are
+    dropped. Returns the count."""
+    table, student, machine = ScheduleRunRow.__table__, Student.__table__, Machine.__table__
+    where = (table.c.run_id == run_id, table.c.kind == kind)
+    source = table.outerjoin(student, student.c.id == table.c.student_id).outerjoin(
+        machine, machine.c.id == table.c.machine_id)
+    linked = {'student_id': student.c.id.label('student_id'), 'machine_id': machine.c.id.label('machine_id')}
+    columns = [linked.get(name, table.c[name]) for name in STAGED_COLUMNS]
+    rows = db.session.execute(select(*columns).select_from(source).where(*where)).all()
+    if rows:
+        shared = table.c.id.in_(select(ScheduleRunParticipant.row_id))
+        db.session.execute(insert(Schedule).from_select(
+            [*STAGED_COLUMNS, 'run_id'], select(*columns, live_run_id).select_from(source).where(*where, ~shared)
+        ))
+        apply_bulk(rows + _copy_shared(table, source, columns, where + (shared,), live_run_id),
+                   schedule_contributions)
+    return len(rows)
+
+def _copy_shared(table, source, columns, where, live_run_id):
+    """Copy the staging rows of shared sessions matching ``where`` into
+    Schedule and link their staged participants to the new ids, read back
+    with RETURNING. Students deleted since are dropped. Returns the
+    participants' slots for the rollups."""
+    staged, student = ScheduleRunParticipant.__table__, Student.__table__
+    rows = db.session.execute(
+        select(table.c.id.label('row_id'), *columns, live_run_id.label('run_id')).select_from(source).where(*where)
+    ).mappings().all()
+    if not rows:
+        return []
+    ids = db.session.scalars(insert(Schedule).returning(Schedule.id, sort_by_parameter_order=True), [
+        {key: value for key, value in row.items() if key != 'row_id'} for row in rows
+    ]).all()
+    copied = {row['row_id']: (schedule_id, row) for schedule_id, row in zip(ids, rows)}
+
+    participants = db.session.execute(
+        select(staged.c.row_id, staged.c.student_id, student.c.student_name)
+        .join(table, table.c.id == staged.c.row_id).join(student, student.c.id == staged.c.student_id)
+        .where(*where)
+    ).all()
+    if participants:
+        db.session.execute(insert(ScheduleParticipant), [
+            {'schedule_id': copied[row_id][0], 'student_id': student_id} for row_id, student_id, _ in participants
+        ])
+    return [SimpleNamespace(**dict(copied[row_id][1], student_id=student_id, student_name=student_name))
+            for row_id, student_id, student_name in participants]
@@ -145,6 +145,7 @@ def seed():
                 continue
 
             machine_usage = {m.machine_name: 0.0 for m in all_machines}
+            machine_ids = {m.machine_name: m.id for m in all_machines}
             scheduled_students = random.sample(all_students, k=min(len(all_students), len(time_slots)*len(all_machines)))
             idx = 0
 
@@ -159,8 +160,10 @@ def seed():
                     idx += 1
                     sch = Schedule(
                         student_name=student.student_name,
+                        student_id=student.id,
                         group_name=student.group.name,
                         machine_name=machine.machine_name,
+                        machine_id=machine.id,
                         start_time=slot_start,
                         end_time=slot_end,
                         extra_time=random.choice([0, 15])
@@ -171,6 +174,7 @@ def seed():
             for mname, total_usage in machine_usage.items():
                 macro = MacroPlan(
                     machine_name=mname,
+                    machine_id=machine_ids[mname],
                     date=current_day,
                     planned_maintenance=random.choice([0.5, 1.0]),
                     breakdown=random.choice([0, 0.5]),
@@ -0,0 +1,101 @@
+"""
+Streaming workbook reader
+=========================
+Reads the first sheet of an uploaded .xlsx with openpyxl's read-only mode,
+which parses rows lazily from the zip instead of building the whole sheet.
+The wizard previews only touch the first few rows and imports consume the
+sheet in fixed-size DataFrame chunks, so memory stays flat however long the
+sheet is.
+
+Fully blank rows are skipped everywhere, as pandas does, so a row index
+picked in the preview means the same row to ``iter_chunks``.
+"""
+from contextlib import contextmanager
+from itertools import islice
+
+import pandas as pd
+from openpyxl import load_workbook
+
+# Rows per DataFrame handed to the importers
+CHUNK_SIZE = 2000
+
+
+@contextmanager
+def open_sheet(path):
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        yield workbook.worksheets[0]
+    finally:
+        workbook.close()
+
+def _is_blank(value):
+    return value is None or (isinstance(value, str) and value.strip() == '')
+
+def iter_rows(sheet):
+    """Non-blank rows of a read-only sheet as tuples of cell values"""
+    for row in sheet.iter_rows(values_only=True):
+        if not all(_is_blank(v) for v in row):
+            yield row
+
+def read_rows(path, limit):
+    """The first ``limit`` non-blank rows, for previews"""
+    with open_sheet(path) as sheet:
+        return [list(row) for row in islice(iter_rows(sheet), limit)]
+
+def count_rows(path):
+    """Number of non-blank rows in the sheet, in one streaming pass.
+
+    The dimension recorded in the file (``max_row``) would be instant but
+    counts formatted blank rows, which ``iter_rows`` skips.
+    """
+    with open_sheet(path) as sheet:
+        return sum(1 for _ in iter_rows(sheet))
+
+def column_names(header):
+    """Column labels for a header row, named the way read_excel names them"""
+    names, seen = [], {}
+    for i, value in enumerate(header):
+        name = f"Unnamed: {i}" if _is_blank(value) else str(value)
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+def _pad(row, width):
+    return tuple(row[:width]) + (None,) * (width - len(row))
+
+def read_frame(path, header_row=0, limit=5):
+    """The header and first ``limit`` data rows as a DataFrame, for previews"""
+    rows = read_rows(path, header_row + 1 + limit)
+    if len(rows) <= header_row:
+        return pd.DataFrame()
+    columns = column_names(rows[header_row])
+    data = [_pad(row, len(columns)) for row in rows[header_row + 1:]]
+    return pd.DataFrame(data, columns=columns, dtype=object)
+
+def iter_chunks(path, header_row=0, chunk_size=CHUNK_SIZE):
+    """Yield DataFrames of up to ``chunk_size`` data rows below ``header_row``.
+
+    Cells keep the types openpyxl gives them (str, int, float, datetime,
+    None); no per-column type inference happens across chunks.
+    """
+    with open_sheet(path) as sheet:
+        rows = iter_rows(sheet)
+        header = None
+        for index, row in enumerate(rows):
+            if index == header_row:
+                header = row
+                break
+        if header is None:
+            return
+        columns = column_names(header)
+        width = len(columns)
+
+        while True:
+            batch = [_pad(row, width) for row in islice(rows, chunk_size)]
+            if not batch:
+                break
+            yield pd.DataFrame(batch, columns=columns, dtype=object)